@@ -133,6 +133,33 @@ class BaseAligner(object):
     def align(self, refset, targetset, get_matrix=True):
         """ Perform the alignment on the referenceset
         and the targetset
+
+        If the matrix is not normalized, the threshold is given to the
+        processings during the alignment, so the distances above it may be
+        capped (e.g. by the bounded levenshtein distance) in the returned
+        matrix when there is no blocking. The processings are restored after
+        the alignment, and their caches are dropped (see BaseProcessing.reset).
+        """
+        # Only the processings based on BaseProcessing may be bounded
+        bounded = [processing for processing in self.processings
+                   if hasattr(processing, 'set_threshold')]
+        if self.normalize_matrix:
+            bounded = []
+        # The distances above the threshold are not needed exactly
+        for processing in bounded:
+            processing.set_threshold(self.threshold)
+        try:
+            return self._align(refset, targetset, get_matrix)
+        finally:
+            for processing in bounded:
+                processing.set_threshold(None)
+            # Drop the data cached by the processings during the alignment
+            for processing in self.processings:
+                if hasattr(processing, 'reset'):
+                    processing.reset()
+
+    def _align(self, refset, targetset, get_matrix=True):
+        """ Internal alignment of the referenceset and the targetset
         """
         start_time = time.time()
         refset = self.apply_normalization(refset, self.ref_normalizer)
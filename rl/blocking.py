@@ -28,12 +28,255 @@ Additional information:
 
 """
 from functools import partial
+from itertools import chain, islice
+from math import ceil
+from collections import deque
+from os import path as osp
+import cPickle
+import heapq
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
 import warnings
 
-from scipy.spatial import KDTree
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
 
 from nazca.utils.minhashing import Minlsh
-from nazca.utils.distances import soundexcode
+from nazca.utils.distances import (soundexcode, soundex_codes, geographical_array,
+                                   PHONETIC_CODES)
+from nazca.utils.normalize import tokenize
+
+
+###############################################################################
+### UTILITY FUNCTIONS #########################################################
+###############################################################################
+def iter_terms(text, analyzer='word', ngram_size=1, tokenizer=None):
+    """ Iterator over the terms of a text, i.e. its word n-grams
+    (analyzer='word') or its characters n-grams (analyzer='char')
+    """
+    if analyzer == 'word':
+        tokens = tokenize(text, tokenizer)
+        for ind in xrange(len(tokens) - ngram_size + 1):
+            yield ' '.join(tokens[ind:ind+ngram_size])
+    elif analyzer == 'char':
+        for ind in xrange(max(len(text) - ngram_size + 1, 1)):
+            yield text[ind:ind+ngram_size]
+    else:
+        raise ValueError("Unknown analyzer %s, should be 'word' or 'char'" % analyzer)
+
+def tfidf_matrix(texts, analyzer='word', ngram_size=1, tokenizer=None):
+    """ Return the sparse (CSR) TF-IDF matrix of a list of texts,
+    whose rows are normalized (so the dot product of two rows is their cosine
+    similarity), and the vocabulary (term -> column)
+
+    See iter_terms for the parameters. None texts give empty rows.
+    """
+    vocabulary = {}
+    indptr, indices, data = [0], [], []
+    for text in texts:
+        counts = {}
+        if text:
+            for term in iter_terms(text, analyzer, ngram_size, tokenizer):
+                column = vocabulary.setdefault(term, len(vocabulary))
+                counts[column] = counts.get(column, 0) + 1
+        indices.extend(counts.iterkeys())
+        data.extend(counts.itervalues())
+        indptr.append(len(indices))
+    matrix = csr_matrix((np.array(data, dtype=np.float64),
+                         np.array(indices, dtype=np.int64),
+                         np.array(indptr, dtype=np.int64)),
+                        shape=(len(texts), len(vocabulary)))
+    if matrix.nnz:
+        idf = np.log(float(len(texts)) / np.bincount(matrix.indices)) + 1
+        matrix.data *= idf[matrix.indices]
+        norms = np.sqrt(np.bincount(np.repeat(np.arange(len(texts)), np.diff(matrix.indptr)),
+                                    weights=matrix.data ** 2, minlength=len(texts)))
+        matrix.data /= np.repeat(norms, np.diff(matrix.indptr))
+    return matrix, vocabulary
+
+def set_similarity_join(ref_tokens, target_tokens, threshold):
+    """ Exact Jaccard set-similarity join between two lists of token sets,
+    using the prefix, length and positional filters of PPJoin.
+
+    Yield, for each reference having at least one target with a Jaccard
+    similarity above `threshold` (i.e. a jaccard distance below 1 - threshold),
+    (reference index, sorted array of the target indexes, similarities array).
+    Empty token sets are ignored.
+
+    Additional information:
+
+       C. Xiao, W. Wang, X. Lin and J. X. Yu, Efficient similarity joins
+       for near duplicate detection, WWW 2008
+    """
+    if not 0 < threshold <= 1:
+        raise ValueError('The threshold should be in ]0, 1]')
+    # Tolerance on the float bounds, so that the pairs exactly at the threshold
+    # (e.g. 3/15 for 0.2) are not pruned by rounding errors
+    eps = 1e-9
+    ref_tokens = [set(tokens) for tokens in ref_tokens]
+    target_tokens = [set(tokens) for tokens in target_tokens]
+    # Global ordering of the tokens, by increasing frequency
+    frequencies = {}
+    for tokens in chain(ref_tokens, target_tokens):
+        for token in tokens:
+            frequencies[token] = frequencies.get(token, 0) + 1
+    ranks = dict((token, rank) for rank, token
+                 in enumerate(sorted(frequencies, key=frequencies.get)))
+    refs = [sorted(ranks[token] for token in tokens) for tokens in ref_tokens]
+    targets = [sorted(ranks[token] for token in tokens) for tokens in target_tokens]
+    # Index of the prefixes of the targets: token -> [(target, position)]
+    index = {}
+    for target, tokens in enumerate(targets):
+        prefix = len(tokens) - int(ceil(threshold * len(tokens) - eps)) + 1
+        for position, token in enumerate(tokens[:prefix]):
+            index.setdefault(token, []).append((target, position))
+    for ref, tokens in enumerate(refs):
+        size = len(tokens)
+        if not size:
+            continue
+        prefix = size - int(ceil(threshold * size - eps)) + 1
+        # Overlaps of the candidates in the prefixes (-1 for pruned candidates)
+        overlaps = {}
+        for ref_position, token in enumerate(tokens[:prefix]):
+            for target, position in index.get(token, ()):
+                target_size = len(targets[target])
+                if not threshold * size - eps <= target_size <= size / threshold + eps:
+                    continue
+                overlap = overlaps.get(target, 0)
+                if overlap < 0:
+                    continue
+                alpha = ceil(threshold / (1 + threshold) * (size + target_size) - eps)
+                upper_bound = 1 + min(size - ref_position - 1, target_size - position - 1)
+                overlaps[target] = overlap + 1 if overlap + upper_bound >= alpha else -1
+        # Verification of the candidates
+        tokens = set(tokens)
+        matches, similarities = [], []
+        for target in sorted(overlaps):
+            if overlaps[target] < 0:
+                continue
+            common = len(tokens.intersection(targets[target]))
+            similarity = common / float(size + len(targets[target]) - common)
+            if similarity >= threshold - eps:
+                matches.append(target)
+                similarities.append(similarity)
+        if matches:
+            yield ref, np.array(matches, dtype=np.int64), np.array(similarities)
+
+def flatten_index(index, keys):
+    """ Flatten an index key -> block of (index, id) records into the arrays
+    (offsets, indices), the block of keys[i] being indices[offsets[i]:offsets[i+1]]
+    """
+    offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    indices = []
+    for ind, key in enumerate(keys):
+        indices.extend(r[0] for r in index.get(key, ()))
+        offsets[ind+1] = len(indices)
+    return offsets, np.array(indices, dtype=np.int64)
+
+
+def suffix_ranks(values):
+    """ Rank all the suffixes of the values, by prefix doubling on integer
+    arrays (i.e. without building the suffixes strings).
+
+    Return the arrays (records, offsets, ranks) of the suffixes values[r][o:],
+    where two suffixes have the same rank iff they are equal, the ranks being
+    in the lexicographic order (so that argsort(ranks) is the suffix array).
+    """
+    lengths = np.array([len(value) for value in values], dtype=np.int64)
+    size = int(lengths.sum())
+    records = np.repeat(np.arange(len(values), dtype=np.int64), lengths)
+    offsets = np.arange(size, dtype=np.int64) - np.repeat(np.cumsum(lengths) - lengths,
+                                                          lengths)
+    remaining = lengths[records] - offsets
+    # The characters codes start at 1, 0 marking the end of a value
+    ranks = np.fromiter((ord(c) + 1 for value in values for c in value),
+                        dtype=np.int64, count=size)
+    covered = 1
+    while size and covered < lengths.max():
+        # Rank the suffixes on their first 2 * covered characters
+        following = np.zeros(size, dtype=np.int64)
+        valid = np.flatnonzero(remaining > covered)
+        following[valid] = ranks[valid + covered]
+        order = np.lexsort((following, ranks))
+        changes = np.ones(size, dtype=np.int64)
+        changes[1:] = ((ranks[order][1:] != ranks[order][:-1])
+                       | (following[order][1:] != following[order][:-1]))
+        ranks = np.empty(size, dtype=np.int64)
+        ranks[order] = np.cumsum(changes)
+        covered *= 2
+    return records, offsets, ranks
+
+
+class SuffixKeys(object):
+    """ The list of the keys of a SuffixArrayBlocking, the suffixes being
+    only built when accessed, from their (value, offset) arrays
+    """
+
+    def __init__(self, values, records, offsets):
+        self.values = values
+        self.records = records
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, ind):
+        return self.values[self.records[ind]][self.offsets[ind]:]
+
+
+class ArrayIndex(object):
+    """ A read-only index key -> block of (index, id) records, built on the
+    flat arrays of flatten_index (that may be memory-mapped)
+    """
+
+    def __init__(self, keys, offsets, indices, records):
+        self.positions = dict((key, ind) for ind, key in enumerate(keys))
+        self.offsets = offsets
+        self.indices = indices
+        self.records = records
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    def __getitem__(self, key):
+        ind = self.positions[key]
+        return [self.records[i]
+                for i in self.indices[self.offsets[ind]:self.offsets[ind+1]]]
+
+    def get(self, key, default=None):
+        if key not in self.positions:
+            return default
+        return self[key]
+
+    def iteritems(self):
+        for key in self.positions:
+            yield key, self[key]
+
+
+class RecordIds(object):
+    """ A read-only sequence of the (index, id) records of a dataset, the ids
+    being read in the dataset when needed instead of being copied in a list
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, ind):
+        return ind, self.dataset[ind][0]
+
+    def __iter__(self):
+        for ind, record in enumerate(self.dataset):
+            yield ind, record[0]
 
 
 ###############################################################################
@@ -62,6 +305,7 @@ class BaseBlocking(object):
         self.refids = None
         self.targetids = None
         self.is_fitted = False
+        self.logger = logging.getLogger('nazca.blocking')
 
     def _fit(self, refset, targetset):
         raise NotImplementedError
@@ -178,6 +422,186 @@ class BaseBlocking(object):
                 for val2 in block2:
                     yield val1, val2
 
+    def _iter_array_blocks(self):
+        """ Internal iteration function over blocks of indexes arrays
+        """
+        for block1, block2 in self._iter_blocks():
+            yield (np.array([r[0] for r in block1], dtype=np.int64),
+                   np.array([r[0] for r in block2], dtype=np.int64))
+
+    def iter_array_blocks(self):
+        """ Iterator over the different possible blocks.
+
+        Returns
+        -------
+
+        (block1, block2): The blocks are always (reference_block, target_block)
+                          and are the arrays of the indexes of the records in
+                          the corresponding dataset.
+        """
+        assert self.is_fitted
+        return self._iter_array_blocks()
+
+    def block_membership(self):
+        """ Return the blocks as CSR-like arrays
+
+        Returns
+        -------
+
+        (ref_ptr, ref_indices, target_ptr, target_indices): the block i contains
+            the references ref_indices[ref_ptr[i]:ref_ptr[i+1]] and the targets
+            target_indices[target_ptr[i]:target_ptr[i+1]].
+        """
+        blocks1, blocks2 = [], []
+        for block1, block2 in self.iter_array_blocks():
+            blocks1.append(block1)
+            blocks2.append(block2)
+        membership = []
+        for blocks in (blocks1, blocks2):
+            ptr = np.zeros(len(blocks) + 1, dtype=np.int64)
+            ptr[1:] = np.cumsum([len(block) for block in blocks])
+            membership.append(ptr)
+            membership.append(np.concatenate(blocks) if blocks
+                              else np.zeros(0, dtype=np.int64))
+        return tuple(membership)
+
+    def _pairs_dtype(self):
+        """ Smallest integer type of the pairs arrays
+        """
+        if max(len(self.refids), len(self.targetids)) < np.iinfo(np.int32).max:
+            return np.int32
+        return np.int64
+
+    def iter_pair_arrays(self, chunk_size=1000000):
+        """ Iterator over the different possible pairs, by chunks.
+
+        Parameters
+        ----------
+
+        chunk_size: approximative number of pairs of a chunk
+
+        Returns
+        -------
+
+        (refs, targets): arrays of the indexes of the records in the
+                         corresponding dataset, the pairs being
+                         (refs[i], targets[i]).
+        """
+        dtype = self._pairs_dtype()
+        buffer1, buffer2, nb_pairs = [], [], 0
+        for block1, block2 in self.iter_array_blocks():
+            if not len(block2):
+                continue
+            # Split the blocks bigger than a chunk on the references
+            step = max(chunk_size // len(block2), 1)
+            for start in xrange(0, len(block1), step):
+                subblock1 = block1[start:start+step]
+                buffer1.append(np.repeat(subblock1.astype(dtype), len(block2)))
+                buffer2.append(np.tile(block2.astype(dtype), len(subblock1)))
+                nb_pairs += len(buffer1[-1])
+                if nb_pairs >= chunk_size:
+                    yield np.concatenate(buffer1), np.concatenate(buffer2)
+                    buffer1, buffer2, nb_pairs = [], [], 0
+        if nb_pairs:
+            yield np.concatenate(buffer1), np.concatenate(buffer2)
+
+    def pair_arrays(self):
+        """ Return all the possible pairs as two arrays (refs, targets)
+        of the indexes of the records in the corresponding dataset.
+        """
+        chunks = list(self.iter_pair_arrays())
+        if not chunks:
+            dtype = self._pairs_dtype()
+            return np.zeros(0, dtype=dtype), np.zeros(0, dtype=dtype)
+        return (np.concatenate([chunk[0] for chunk in chunks]),
+                np.concatenate([chunk[1] for chunk in chunks]))
+
+    def count_pairs(self):
+        """ Return the number of possible pairs, computed from the blocks
+        sizes (i.e. without building the pairs, in O(number of blocks))
+        """
+        _, sizes1, sizes2 = self.block_sizes()
+        return self._count_pairs(sizes1, sizes2)
+
+    def _count_pairs(self, sizes1, sizes2):
+        """ Internal count of the possible pairs, given the blocks sizes
+        """
+        return int((sizes1 * sizes2).sum())
+
+    def _block_sizes(self):
+        """ Internal computation of the blocks sizes
+        """
+        sizes = np.array([(len(block1), len(block2))
+                          for block1, block2 in self._iter_blocks()],
+                         dtype=np.int64).reshape(-1, 2)
+        return None, sizes[:, 0], sizes[:, 1]
+
+    def block_sizes(self):
+        """ Sizes of the different possible blocks.
+
+        Returns
+        -------
+
+        (keys, sizes1, sizes2): the keys of the blocks (None if the blocking
+                                has no keys), and the arrays of the sizes of
+                                the reference and target blocks.
+        """
+        assert self.is_fitted
+        return self._block_sizes()
+
+    def _dump(self):
+        """ Internal export of the fitted indexes, as a dictionnary of arrays
+        and a (small) picklable metadata object
+        """
+        raise NotImplementedError
+
+    def _load(self, arrays, metadata):
+        """ Internal import of the fitted indexes
+        """
+        raise NotImplementedError
+
+    def save(self, path):
+        """ Save the fitted blocking in the directory `path`, the indexes being
+        stored as flat arrays (one .npy file per array).
+
+        The blocking may then be loaded in a blocking built with the same
+        parameters, without fitting it again.
+        """
+        assert self.is_fitted
+        arrays, metadata = self._dump()
+        if not osp.isdir(path):
+            os.makedirs(path)
+        for name, array in arrays.iteritems():
+            np.save(osp.join(path, name + '.npy'), array)
+        with open(osp.join(path, 'blocking.pickle'), 'wb') as fobj:
+            pickler = cPickle.Pickler(fobj, cPickle.HIGHEST_PROTOCOL)
+            pickler.dump({'arrays': sorted(arrays),
+                          'refids': [r[1] for r in self.refids],
+                          'targetids': [r[1] for r in self.targetids],
+                          'metadata': metadata})
+
+    def load(self, path, mmap=True):
+        """ Load a blocking saved in the directory `path`
+
+        Parameters
+        ----------
+
+        path: the directory of the saved blocking
+
+        mmap: if True, the arrays are memory-mapped (read-only), so they are
+              loaded lazily and shared between the processes through the
+              page cache
+        """
+        with open(osp.join(path, 'blocking.pickle'), 'rb') as fobj:
+            data = cPickle.Unpickler(fobj).load()
+        self.refids = list(enumerate(data['refids']))
+        self.targetids = list(enumerate(data['targetids']))
+        arrays = dict((name, np.load(osp.join(path, name + '.npy'),
+                                     mmap_mode='r' if mmap else None))
+                      for name in data['arrays'])
+        self._load(arrays, data['metadata'])
+        self.is_fitted = True
+
     def cleanup(self):
         """ Cleanup blocking for further use (e.g. in pipeline)
         """
@@ -202,26 +626,110 @@ class KeyBlocking(BaseBlocking):
         the identifiers of the records of the both sets for this value.
     """
 
-    def __init__(self, ref_attr_index, target_attr_index, callback, ignore_none=False):
+    def __init__(self, ref_attr_index, target_attr_index, callback, ignore_none=False,
+                 max_comparisons=None, split_callback=None):
+        """ Build the blocking object
+
+        Parameters
+        ----------
+
+        ref_attr_index: index of the attribute of interest in a record
+                        for the reference dataset
+
+        target_attr_index: index of the attribute of interest in a record
+                           for the target dataset
+
+        callback: function computing the key of an attribute value
+
+        ignore_none: if True, records with an empty key are skipped
+
+        max_comparisons: if given, the blocks requiring more comparisons
+                         (len(block1) * len(block2)) are purged
+
+        split_callback: if given (with max_comparisons), the purged blocks are
+                        re-split using this secondary key function (applied on
+                        the same attribute) instead of being dropped
+        """
         super(KeyBlocking, self).__init__(ref_attr_index, target_attr_index)
         self.callback = callback
         self.ignore_none = ignore_none
+        self.max_comparisons = max_comparisons
+        self.split_callback = split_callback
         self.reference_index = {}
         self.target_index = {}
+        self.purge_stats = {}
+
+    def compute_keys(self, dataset, attr_index):
+        """ Return the list of the keys of the records of a dataset
+        """
+        return [self.callback(rec[attr_index]) for rec in dataset]
 
     def _fit(self, refset, targetset):
         """ Fit a dataset in an index using the callback
         """
-        for ind, rec in enumerate(refset):
-            key = self.callback(rec[self.ref_attr_index])
+        # New indexes (the previous ones may be loaded read-only indexes)
+        self.reference_index = {}
+        self.target_index = {}
+        self.purge_stats = {}
+        for ind, key in enumerate(self.compute_keys(refset, self.ref_attr_index)):
             if not key and self.ignore_none:
                 continue
-            self.reference_index.setdefault(key, []).append((ind, rec[0]))
-        for ind, rec in enumerate(targetset):
-            key = self.callback(rec[self.target_attr_index])
+            self.reference_index.setdefault(key, []).append((ind, refset[ind][0]))
+        for ind, key in enumerate(self.compute_keys(targetset, self.target_attr_index)):
             if not key and self.ignore_none:
                 continue
-            self.target_index.setdefault(key, []).append((ind, rec[0]))
+            self.target_index.setdefault(key, []).append((ind, targetset[ind][0]))
+        if self.max_comparisons is not None:
+            self._purge(refset, targetset)
+
+    def _split_block(self, block, dataset, attr_index, key):
+        """ Split a block using the secondary key
+        """
+        subindex = {}
+        for ind, _id in block:
+            subkey = self.split_callback(dataset[ind][attr_index])
+            if not subkey and self.ignore_none:
+                continue
+            subindex.setdefault((key, subkey), []).append((ind, _id))
+        return subindex
+
+    def _purge(self, refset, targetset):
+        """ Purge (or re-split) the blocks with too many comparisons
+        """
+        stats = dict(purged_blocks=0, purged_comparisons=0,
+                     split_blocks=0, split_comparisons=0)
+        for key in self.reference_index.keys():
+            block1 = self.reference_index[key]
+            block2 = self.target_index.get(key, ())
+            comparisons = len(block1) * len(block2)
+            if comparisons <= self.max_comparisons:
+                continue
+            del self.reference_index[key]
+            del self.target_index[key]
+            if self.split_callback is None:
+                stats['purged_blocks'] += 1
+                stats['purged_comparisons'] += comparisons
+                continue
+            stats['split_blocks'] += 1
+            stats['split_comparisons'] += comparisons
+            subindex1 = self._split_block(block1, refset, self.ref_attr_index, key)
+            subindex2 = self._split_block(block2, targetset, self.target_attr_index, key)
+            for subkey, subblock1 in subindex1.iteritems():
+                subblock2 = subindex2.get(subkey)
+                if not subblock2:
+                    continue
+                comparisons = len(subblock1) * len(subblock2)
+                if comparisons > self.max_comparisons:
+                    stats['purged_blocks'] += 1
+                    stats['purged_comparisons'] += comparisons
+                    continue
+                self.reference_index[subkey] = subblock1
+                self.target_index[subkey] = subblock2
+        self.purge_stats = stats
+        self.logger.info('Purged blocks : %(purged_blocks)s '
+                         '(%(purged_comparisons)s comparisons)' % stats)
+        self.logger.info('Split blocks : %(split_blocks)s '
+                         '(%(split_comparisons)s comparisons)' % stats)
 
     def _iter_blocks(self):
         """ Iterator over the different possible blocks.
@@ -238,18 +746,441 @@ class KeyBlocking(BaseBlocking):
             if block1 and block2:
                 yield (block1, block2)
 
+    def _block_sizes(self):
+        """ Blocks sizes, computed from the index
+        """
+        keys = [key for key, block1 in self.reference_index.iteritems()
+                if block1 and self.target_index.get(key)]
+        return (keys,
+                np.array([len(self.reference_index[key]) for key in keys], dtype=np.int64),
+                np.array([len(self.target_index[key]) for key in keys], dtype=np.int64))
+
+    def _dump(self):
+        """ Export the indexes on the table of the reference keys
+        """
+        keys = [key for key, _ in self.reference_index.iteritems()]
+        ref_offsets, ref_indices = flatten_index(self.reference_index, keys)
+        target_offsets, target_indices = flatten_index(self.target_index, keys)
+        return ({'ref_offsets': ref_offsets, 'ref_indices': ref_indices,
+                 'target_offsets': target_offsets, 'target_indices': target_indices},
+                {'keys': keys, 'purge_stats': self.purge_stats})
+
+    def _load(self, arrays, metadata):
+        """ Import the indexes, as array-based indexes
+        """
+        keys = metadata['keys']
+        self.reference_index = ArrayIndex(keys, arrays['ref_offsets'],
+                                          arrays['ref_indices'], self.refids)
+        self.target_index = ArrayIndex(keys, arrays['target_offsets'],
+                                       arrays['target_indices'], self.targetids)
+        self.purge_stats = metadata['purge_stats']
+
     def _cleanup(self):
         """ Cleanup blocking for further use (e.g. in pipeline)
         """
         self.reference_index = {}
         self.target_index = {}
+        self.purge_stats = {}
 
 
 class SoundexBlocking(KeyBlocking):
+    """ A key blocking on the soundex codes, computed in a single pass
+    and packed in integers (see distances.soundex_codes), the empty code
+    being 0.
+    """
 
-    def __init__(self, ref_attr_index, target_attr_index, language='french',):
+    def __init__(self, ref_attr_index, target_attr_index, language='french',
+                 max_comparisons=None, split_callback=None):
         super(SoundexBlocking, self).__init__(ref_attr_index, target_attr_index,
-                                              partial(soundexcode, language=language))
+                                              partial(soundexcode, language=language),
+                                              max_comparisons=max_comparisons,
+                                              split_callback=split_callback)
+        self.language = language
+
+    def compute_keys(self, dataset, attr_index):
+        """ Return the list of the packed soundex codes of the records
+        """
+        return soundex_codes([rec[attr_index] for rec in dataset],
+                             self.language).tolist()
+
+
+###############################################################################
+### MULTI-KEY BLOCKING ########################################################
+###############################################################################
+class MultiKeyBlocking(BaseBlocking):
+    """ This blocking technique is a generalization of the KeyBlocking,
+    where the callback may return several keys for a single record
+    (e.g. all the tokens of a name), so a record may belong to several blocks.
+
+    The main idea here is:
+
+    1 - to compute the keys f(x) of each x in the reference set,
+        and to build an inverted index key -> array of record indices.
+
+    2 - to do the same for each y in the target set.
+
+    3 - to iterate on each key shared by both sets, and to return
+        the identifiers of the records of the both sets for this key.
+
+    If `deduplicate` is True, a pair of records sharing several keys is only
+    returned in the block of the first of these keys, so that the same pair is
+    never compared twice.
+
+    If `max_comparisons` (resp. `max_block_size`) is given, the blocks of the
+    keys requiring more comparisons (resp. having more records) are purged,
+    e.g. the blocks of very common tokens.
+    """
+
+    def __init__(self, ref_attr_index, target_attr_index, callback,
+                 ignore_none=False, deduplicate=True, max_comparisons=None,
+                 max_block_size=None):
+        super(MultiKeyBlocking, self).__init__(ref_attr_index, target_attr_index)
+        self.callback = callback
+        self.ignore_none = ignore_none
+        self.deduplicate = deduplicate
+        self.max_comparisons = max_comparisons
+        self.max_block_size = max_block_size
+        self.purge_stats = {}
+        self.keys = None
+        # Sparse (record x key) matrices and their transposed
+        # (key x record) inverted indexes
+        self.ref_matrix = None
+        self.target_matrix = None
+        self.reference_index = None
+        self.target_index = None
+        # Number of keys of each record
+        self.ref_nb_keys = None
+        self.target_nb_keys = None
+
+    def _fit_dataset(self, dataset, attr_index, key_ids, extend):
+        """ Build the (record x key) matrix of a dataset.
+        If `extend` is True, unknown keys are added to `key_ids`,
+        otherwise they are dropped.
+        """
+        indptr, indices = [0], []
+        for rec in dataset:
+            value = rec[attr_index]
+            seen = set()
+            for key in (self.callback(value) if value is not None else ()) or ():
+                if (not key and self.ignore_none) or key in seen:
+                    continue
+                seen.add(key)
+                key_id = key_ids.get(key)
+                if key_id is None:
+                    if not extend:
+                        continue
+                    key_id = key_ids[key] = len(key_ids)
+                indices.append(key_id)
+            indptr.append(len(indices))
+        return indptr, indices
+
+    def _fit(self, refset, targetset):
+        """ Fit the two sets (reference set and target set)
+        """
+        key_ids = {}
+        ref_indptr, ref_indices = self._fit_dataset(refset, self.ref_attr_index,
+                                                    key_ids, True)
+        target_indptr, target_indices = self._fit_dataset(targetset,
+                                                          self.target_attr_index,
+                                                          key_ids, False)
+        self.keys = [None] * len(key_ids)
+        for key, key_id in key_ids.iteritems():
+            self.keys[key_id] = key
+        self.ref_matrix = self._build_matrix(ref_indptr, ref_indices, len(key_ids))
+        self.target_matrix = self._build_matrix(target_indptr, target_indices,
+                                                len(key_ids))
+        self._index_matrices()
+
+    def _index_matrices(self):
+        """ Build the inverted indexes of the (record x key) matrices,
+        purge them and count the keys of each record
+        """
+        self.reference_index = self.ref_matrix.tocsc()
+        self.target_index = self.target_matrix.tocsc()
+        if self.max_comparisons is not None or self.max_block_size is not None:
+            self._purge()
+        self.ref_nb_keys = np.diff(self.ref_matrix.indptr)
+        self.target_nb_keys = np.diff(self.target_matrix.indptr)
+
+    def _purge(self):
+        """ Remove the keys whose blocks have too many comparisons or records
+        """
+        ref_sizes = np.diff(self.reference_index.indptr).astype(np.int64)
+        target_sizes = np.diff(self.target_index.indptr).astype(np.int64)
+        comparisons = ref_sizes * target_sizes
+        purged = np.zeros(len(comparisons), dtype=bool)
+        if self.max_comparisons is not None:
+            purged |= comparisons > self.max_comparisons
+        if self.max_block_size is not None:
+            purged |= ref_sizes + target_sizes > self.max_block_size
+        for matrix in (self.ref_matrix, self.target_matrix):
+            matrix.data[purged[matrix.indices]] = 0
+            matrix.eliminate_zeros()
+        self.reference_index = self.ref_matrix.tocsc()
+        self.target_index = self.target_matrix.tocsc()
+        stats = dict(purged_blocks=int(purged.sum()),
+                     purged_comparisons=int(comparisons[purged].sum()))
+        self.purge_stats = stats
+        self.logger.info('Purged blocks : %(purged_blocks)s '
+                         '(%(purged_comparisons)s comparisons)' % stats)
+
+    def _build_matrix(self, indptr, indices, nb_keys):
+        """ Build a binary sparse matrix from its CSR structure
+        """
+        indices = np.array(indices, dtype=np.int64)
+        return csr_matrix((np.ones(len(indices), dtype=np.int32), indices,
+                           np.array(indptr, dtype=np.int64)),
+                          shape=(len(indptr) - 1, nb_keys))
+
+    def _iter_key_blocks(self):
+        """ Iterator over the keys and the corresponding arrays
+        of reference and target record indices.
+        """
+        ref_ptr, ref_ind = self.reference_index.indptr, self.reference_index.indices
+        target_ptr, target_ind = self.target_index.indptr, self.target_index.indices
+        for key_id in xrange(len(self.keys)):
+            block1 = ref_ind[ref_ptr[key_id]:ref_ptr[key_id+1]]
+            block2 = target_ind[target_ptr[key_id]:target_ptr[key_id+1]]
+            if len(block1) and len(block2):
+                yield key_id, block1, block2
+
+    def _earlier_keys(self, matrix, indices, key_id):
+        """ Return the sub-matrix of the given records,
+        restricted to the keys preceding `key_id`
+        """
+        submatrix = matrix[indices]
+        submatrix.data[submatrix.indices >= key_id] = 0
+        submatrix.eliminate_zeros()
+        return submatrix
+
+    def _deduplicate_block(self, key_id, block1, block2):
+        """ Split a block so that it does not contain any pair
+        already returned in the block of a previous key.
+        """
+        # Only records with several keys may appear in previous blocks
+        multi1 = block1[self.ref_nb_keys[block1] > 1]
+        multi2 = block2[self.target_nb_keys[block2] > 1]
+        if not len(multi1) or not len(multi2):
+            yield block1, block2
+            return
+        seen = (self._earlier_keys(self.ref_matrix, multi1, key_id)
+                * self._earlier_keys(self.target_matrix, multi2, key_id).T).tocsr()
+        if not seen.nnz:
+            yield block1, block2
+            return
+        rows = np.flatnonzero(np.diff(seen.indptr))
+        clean = block1[~np.in1d(block1, multi1[rows])]
+        if len(clean):
+            yield clean, block2
+        for row in rows:
+            seen_targets = multi2[seen.indices[seen.indptr[row]:seen.indptr[row+1]]]
+            remaining = block2[~np.in1d(block2, seen_targets)]
+            if len(remaining):
+                yield multi1[row:row+1], remaining
+
+    def _iter_array_blocks(self):
+        """ Iteration over the blocks of indexes arrays
+        """
+        for key_id, block1, block2 in self._iter_key_blocks():
+            if self.deduplicate:
+                subblocks = self._deduplicate_block(key_id, block1, block2)
+            else:
+                subblocks = ((block1, block2),)
+            for subblock1, subblock2 in subblocks:
+                yield subblock1, subblock2
+
+    def _iter_blocks(self):
+        """ Iterator over the different possible blocks.
+
+        Returns
+        -------
+
+        (block1, block2): The blocks are always (reference_block, target_block)
+                          and containts the indexes of the record in the
+                          corresponding dataset.
+        """
+        for block1, block2 in self._iter_array_blocks():
+            yield ([self.refids[i] for i in block1],
+                   [self.targetids[i] for i in block2])
+
+    def count_pairs(self, chunk_size=10000):
+        """ Return the number of possible pairs. If `deduplicate` is True,
+        the pairs sharing several keys are only counted once: the count is the
+        number of non-zero elements of the (reference x target) product of the
+        key matrices, computed by chunks of `chunk_size` references.
+        """
+        if not self.deduplicate:
+            return super(MultiKeyBlocking, self).count_pairs()
+        return self._count_pairs(None, None, chunk_size)
+
+    def _count_pairs(self, sizes1, sizes2, chunk_size=10000):
+        """ Internal count of the possible pairs (see count_pairs), the blocks
+        sizes being only used without deduplication
+        """
+        if not self.deduplicate:
+            return super(MultiKeyBlocking, self)._count_pairs(sizes1, sizes2)
+        target_matrix = self.target_matrix.T.tocsr()
+        return sum((self.ref_matrix[start:start+chunk_size] * target_matrix).nnz
+                   for start in xrange(0, self.ref_matrix.shape[0], chunk_size))
+
+    def _block_sizes(self):
+        """ Blocks sizes, computed from the inverted indexes (i.e. before
+        the deduplication of the pairs shared by several blocks)
+        """
+        sizes1 = np.diff(self.reference_index.indptr).astype(np.int64)
+        sizes2 = np.diff(self.target_index.indptr).astype(np.int64)
+        key_ids = np.flatnonzero((sizes1 > 0) & (sizes2 > 0))
+        return [self.keys[i] for i in key_ids], sizes1[key_ids], sizes2[key_ids]
+
+    def _cleanup(self):
+        """ Cleanup blocking for further use (e.g. in pipeline)
+        """
+        self.keys = None
+        self.ref_matrix = None
+        self.target_matrix = None
+        self.reference_index = None
+        self.target_index = None
+        self.ref_nb_keys = None
+        self.target_nb_keys = None
+        self.purge_stats = {}
+
+
+class TokenBlocking(MultiKeyBlocking):
+    """ A multi-key blocking where the keys of a record are
+    the tokens of its attribute
+    """
+
+    def __init__(self, ref_attr_index, target_attr_index, tokenizer=None,
+                 deduplicate=True, max_comparisons=None):
+        super(TokenBlocking, self).__init__(ref_attr_index, target_attr_index,
+                                            partial(tokenize, tokenizer=tokenizer),
+                                            ignore_none=True, deduplicate=deduplicate,
+                                            max_comparisons=max_comparisons)
+
+
+class PhoneticBlocking(MultiKeyBlocking):
+    """ A multi-key blocking where the keys of a record are the phonetic codes
+    of the tokens of its attribute, so multi-word names are blocked on each
+    of their parts.
+
+    The codes are computed in a single pass over both datasets, once per
+    distinct token (they are cached during the fit), and the records are
+    stored as integer code ids in the sparse inverted index of the
+    MultiKeyBlocking.
+    """
+
+    def __init__(self, ref_attr_index, target_attr_index, encoding='soundex',
+                 language='french', tokenizer=None, per_token=True,
+                 deduplicate=True, max_comparisons=None):
+        """ Build the blocking object
+
+        Parameters
+        ----------
+
+        ref_attr_index: index of the attribute of interest in a record
+                        for the reference dataset
+
+        target_attr_index: index of the attribute of interest in a record
+                           for the target dataset
+
+        encoding: phonetic code, one of 'soundex', 'metaphone', 'nysiis'
+                  or 'phonex' (see distances.PHONETIC_CODES)
+
+        language: language of the soundex code ('french' or 'english')
+
+        tokenizer: tokenizer of the attributes
+
+        per_token: if False, a single code is computed on the whole attribute
+
+        deduplicate, max_comparisons: see MultiKeyBlocking
+        """
+        if encoding not in PHONETIC_CODES:
+            raise ValueError('Unknown encoding %s, should be one of %s'
+                             % (encoding, ', '.join(sorted(PHONETIC_CODES))))
+        super(PhoneticBlocking, self).__init__(ref_attr_index, target_attr_index,
+                                               self.phonetic_keys, ignore_none=True,
+                                               deduplicate=deduplicate,
+                                               max_comparisons=max_comparisons)
+        if encoding == 'soundex':
+            self.encoder = partial(soundexcode, language=language)
+        else:
+            self.encoder = PHONETIC_CODES[encoding]
+        self.tokenizer = tokenizer
+        self.per_token = per_token
+        self.token_codes = {}
+
+    def phonetic_keys(self, value):
+        """ Return the phonetic codes of a value
+        """
+        tokens = tokenize(value, self.tokenizer) if self.per_token else (value,)
+        codes = []
+        for token in tokens:
+            code = self.token_codes.get(token)
+            if code is None:
+                code = self.token_codes[token] = self.encoder(token)
+            codes.append(code)
+        return codes
+
+    def _fit(self, refset, targetset):
+        """ Fit the two sets (reference set and target set)
+        """
+        super(PhoneticBlocking, self)._fit(refset, targetset)
+        self.token_codes = {}
+
+
+class SuffixArrayBlocking(MultiKeyBlocking):
+    """ A multi-key blocking where the keys of a record are the suffixes
+    of its attribute (with a minimal length), e.g. for long identifiers or titles.
+
+    The suffixes of the union of both datasets are ranked in integer arrays
+    (see suffix_ranks), each suffix being represented by its (record, offset)
+    and not by a string, and the ranks of the suffixes shared by both
+    datasets are the keys of the sparse inverted index of the MultiKeyBlocking.
+    The blocks of the suffixes shared by more than `max_block_size` records
+    (e.g. common words endings) are purged.
+    As the records sharing a suffix share all its shorter suffixes, the pairs
+    are only returned once (in the block of their first common suffix).
+
+    Additional information:
+
+       A. Aizawa and K. Oyama, A fast linkage detection scheme for multi-source
+       information integration, WIRI 2005
+    """
+
+    def __init__(self, ref_attr_index, target_attr_index, min_suffix_length=4,
+                 max_block_size=None):
+        # The keys are not computed by a callback, but by _fit
+        super(SuffixArrayBlocking, self).__init__(ref_attr_index, target_attr_index,
+                                                  None, ignore_none=True,
+                                                  max_block_size=max_block_size)
+        self.min_suffix_length = min_suffix_length
+
+    def _fit(self, refset, targetset):
+        """ Rank the suffixes of both sets, and index the shared ones
+        """
+        values = ([r[self.ref_attr_index] or '' for r in refset]
+                  + [r[self.target_attr_index] or '' for r in targetset])
+        records, offsets, ranks = suffix_ranks(values)
+        lengths = np.array([len(value) for value in values], dtype=np.int64)
+        kept = np.flatnonzero(lengths[records] - offsets >= self.min_suffix_length)
+        records, offsets, ranks = records[kept], offsets[kept], ranks[kept]
+        is_ref = records < len(refset)
+        shared = np.intersect1d(ranks[is_ref], ranks[~is_ref])
+        kept = np.flatnonzero(np.in1d(ranks, shared))
+        records, offsets, ranks, is_ref = (records[kept], offsets[kept],
+                                           ranks[kept], is_ref[kept])
+        key_ids = np.searchsorted(shared, ranks)
+        # The first suffix of each key gives its value
+        _, first = np.unique(key_ids, return_index=True)
+        self.keys = SuffixKeys(values, records[first], offsets[first])
+        matrices = []
+        for rows, cols, nb_rows in ((records[is_ref], key_ids[is_ref], len(refset)),
+                                    (records[~is_ref] - len(refset), key_ids[~is_ref],
+                                     len(targetset))):
+            matrices.append(csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)),
+                                       shape=(nb_rows, len(shared))))
+        self.ref_matrix, self.target_matrix = matrices
+        self._index_matrices()
 
 
 ###############################################################################
@@ -266,6 +1197,14 @@ class NGramBlocking(BaseBlocking):
         self.reference_index = {}
         self.target_index = {}
 
+    def compute_keys(self, dataset, attr_index):
+        """ Return the list of the keys of the records of a dataset,
+        i.e. the tuples of their first `depth` n-grams
+        """
+        return [tuple(r[attr_index][i*self.ngram_size:(i+1)*self.ngram_size]
+                      for i in range(self.depth))
+                for r in dataset]
+
     def _fit_dataset(self, dataset, cur_index, attr_index):
         """ Fit a dataset
         """
@@ -281,6 +1220,9 @@ class NGramBlocking(BaseBlocking):
     def _fit(self, refset, targetset):
         """ Fit the two sets (reference set and target set)
         """
+        # New indexes (the previous ones may be loaded read-only indexes)
+        self.reference_index = {}
+        self.target_index = {}
         self._fit_dataset(refset, self.reference_index, self.ref_attr_index)
         self._fit_dataset(targetset, self.target_index, self.target_attr_index)
 
@@ -307,10 +1249,48 @@ class NGramBlocking(BaseBlocking):
                           and containts the indexes of the record in the
                           corresponding dataset.
         """
-        for block1, block2 in self._iter_dict(self.reference_index, self.target_index):
+        if isinstance(self.reference_index, ArrayIndex):
+            # Loaded blocking, whose keys are the tuples of n-grams
+            blocks = ((block1, self.target_index.get(key))
+                      for key, block1 in self.reference_index.iteritems())
+        else:
+            blocks = self._iter_dict(self.reference_index, self.target_index)
+        for block1, block2 in blocks:
             if block1 and block2:
                 yield block1, block2
 
+    def _flat_index(self, cur_dict, prefix=()):
+        """ Flatten the n-grams tree in a dictionnary tuple of n-grams -> block
+        """
+        index = {}
+        for key, sub_dict in cur_dict.iteritems():
+            if isinstance(sub_dict, dict):
+                index.update(self._flat_index(sub_dict, prefix + (key,)))
+            else:
+                index[prefix + (key,)] = sub_dict
+        return index
+
+    def _dump(self):
+        """ Export the flattened n-grams trees
+        """
+        reference_index = self._flat_index(self.reference_index)
+        target_index = self._flat_index(self.target_index)
+        keys = reference_index.keys()
+        ref_offsets, ref_indices = flatten_index(reference_index, keys)
+        target_offsets, target_indices = flatten_index(target_index, keys)
+        return ({'ref_offsets': ref_offsets, 'ref_indices': ref_indices,
+                 'target_offsets': target_offsets, 'target_indices': target_indices},
+                {'keys': keys})
+
+    def _load(self, arrays, metadata):
+        """ Import the n-grams trees, as flat array-based indexes
+        """
+        keys = metadata['keys']
+        self.reference_index = ArrayIndex(keys, arrays['ref_offsets'],
+                                          arrays['ref_indices'], self.refids)
+        self.target_index = ArrayIndex(keys, arrays['target_offsets'],
+                                       arrays['target_indices'], self.targetids)
+
     def _cleanup(self):
         """ Cleanup blocking for further use (e.g. in pipeline)
         """
@@ -319,48 +1299,398 @@ class NGramBlocking(BaseBlocking):
 
 
 ###############################################################################
-### SORTKEY BLOCKING ##########################################################
+### QGRAM BLOCKING ############################################################
 ###############################################################################
-class SortedNeighborhoodBlocking(BaseBlocking):
-    """ This blocking technique is based on a a sorting blocking criteria
-    (or blocking key), that will be used to divide the datasets.
+class QGramBlocking(BaseBlocking):
+    """ This blocking technique is based on all the q-grams of the values.
+
+    The q-grams of the values are indexed in sparse (record x q-gram) matrices,
+    and the candidate pairs are the pairs sharing at least T q-grams, the counts
+    of shared q-grams being computed by sparse matrix products on chunks of the
+    reference set.
+
+    T is derived from a maximal edit distance k (count filtering): if
+    levenshtein(a, b) <= k, a and b (padded with q-1 characters on each side)
+    share at least max(len(a), len(b)) + q - 1 - k * q q-grams. The repeated
+    q-grams of a value are numbered, so the counts are the multiset intersections.
+    Pairs sharing no q-gram at all are never returned.
     """
 
-    def __init__(self, ref_attr_index, target_attr_index, key_func=lambda x: x, window_width=20):
-        super(SortedNeighborhoodBlocking, self).__init__(ref_attr_index, target_attr_index)
-        self.key_func = key_func
-        self.window_width = window_width
-        self.sorted_dataset = None
+    def __init__(self, ref_attr_index, target_attr_index, q=2, max_distance=None,
+                 min_common=None, chunk_size=10000):
+        """ Build the blocking object
+
+        Parameters
+        ----------
+
+        ref_attr_index: index of the attribute of interest in a record
+                        for the reference dataset
+
+        target_attr_index: index of the attribute of interest in a record
+                           for the target dataset
+
+        q: size of the q-grams
+
+        max_distance: maximal edit distance between the values of a pair,
+                      used for the count filtering and the length filtering
+
+        min_common: minimal number of shared q-grams of a pair
+                    (used instead of the count filtering)
+
+        chunk_size: number of reference records processed at once
+
+        Exactly one of max_distance and min_common should be given.
+        """
+        if (max_distance is None) == (min_common is None):
+            raise ValueError('Exactly one of max_distance and min_common '
+                             'should be given')
+        super(QGramBlocking, self).__init__(ref_attr_index, target_attr_index)
+        self.q = q
+        self.max_distance = max_distance
+        self.min_common = min_common
+        self.chunk_size = chunk_size
+        self.ref_matrix = None
+        self.target_matrix = None
+        self.ref_lengths = None
+        self.target_lengths = None
+
+    def _iter_qgrams(self, value):
+        """ Iterator over the numbered q-grams of a (padded) value
+        """
+        padded = u'\x02' * (self.q - 1) + value + u'\x03' * (self.q - 1)
+        occurrences = {}
+        for ind in xrange(len(padded) - self.q + 1):
+            qgram = padded[ind:ind+self.q]
+            occurrences[qgram] = occurrences.get(qgram, 0) + 1
+            yield qgram, occurrences[qgram]
+
+    def _fit_dataset(self, dataset, attr_index, vocabulary, extend):
+        """ Build the (record x q-gram) matrix of a dataset,
+        and the array of the lengths of the values
+        """
+        indptr, indices, lengths = [0], [], []
+        for rec in dataset:
+            value = rec[attr_index] or u''
+            lengths.append(len(value))
+            if value:
+                for qgram in self._iter_qgrams(value):
+                    column = vocabulary.get(qgram)
+                    if column is None:
+                        if not extend:
+                            continue
+                        column = vocabulary[qgram] = len(vocabulary)
+                    indices.append(column)
+            indptr.append(len(indices))
+        return indptr, indices, np.array(lengths, dtype=np.int64)
 
     def _fit(self, refset, targetset):
-        """ Fit a dataset in an index using the callback
+        """ Fit the two sets (reference set and target set)
+        """
+        vocabulary = {}
+        ref_indptr, ref_indices, self.ref_lengths = self._fit_dataset(
+            refset, self.ref_attr_index, vocabulary, True)
+        target_indptr, target_indices, self.target_lengths = self._fit_dataset(
+            targetset, self.target_attr_index, vocabulary, False)
+        matrices = []
+        for indptr, indices in ((ref_indptr, ref_indices), (target_indptr, target_indices)):
+            matrices.append(csr_matrix((np.ones(len(indices), dtype=np.int32),
+                                        np.array(indices, dtype=np.int64),
+                                        np.array(indptr, dtype=np.int64)),
+                                       shape=(len(indptr) - 1, len(vocabulary))))
+        self.ref_matrix, self.target_matrix = matrices
+
+    def _iter_chunk_pairs(self):
+        """ Iterator over the candidate pairs of each chunk of the reference set,
+        as (reference indexes, target indexes) arrays sorted by reference index
         """
-        self.sorted_dataset = [((ind, r[0]), r[self.ref_attr_index], 0)
-                               for ind, r in enumerate(refset)]
-        self.sorted_dataset.extend([((ind, r[0]), r[self.target_attr_index], 1)
-                                    for ind, r in enumerate(targetset)])
-        self.sorted_dataset.sort(key=lambda x: self.key_func(x[1]))
+        target_matrix = self.target_matrix.T.tocsr()
+        for start in xrange(0, self.ref_matrix.shape[0], self.chunk_size):
+            common = (self.ref_matrix[start:start+self.chunk_size] * target_matrix).tocoo()
+            refs, targets = common.row.astype(np.int64) + start, common.col.astype(np.int64)
+            ref_lengths, target_lengths = self.ref_lengths[refs], self.target_lengths[targets]
+            if self.min_common is not None:
+                kept = common.data >= self.min_common
+            else:
+                kept = (common.data >= np.maximum(ref_lengths, target_lengths)
+                        + self.q - 1 - self.max_distance * self.q)
+            if self.max_distance is not None:
+                kept &= np.abs(ref_lengths - target_lengths) <= self.max_distance
+            refs, targets = refs[kept], targets[kept]
+            order = np.lexsort((targets, refs))
+            yield refs[order], targets[order]
 
     def _iter_blocks(self):
         """ Iterator over the different possible blocks.
-        """
-        for ind, (rid, record, dset) in enumerate(self.sorted_dataset):
-            # Only keep reference set record
-            if dset == 1:
-                continue
-            block1 = [rid,]
-            minind = (ind - self.window_width)
-            minind = minind if minind >=0 else 0
-            maxind = (ind + self.window_width + 1)
-            block2 = [ri for ri, re, d in self.sorted_dataset[minind:maxind]
-                      if d == 1]
-            if block1 and block2:
-                yield (block1, block2)
+
+        Returns
+        -------
+
+        (block1, block2): The blocks are always (reference_block, target_block)
+                          and containts the indexes of the record in the
+                          corresponding dataset.
+        """
+        for refs, targets in self._iter_chunk_pairs():
+            starts = np.flatnonzero(np.r_[True, refs[1:] != refs[:-1]])
+            stops = np.r_[starts[1:], len(refs)]
+            for start, stop in zip(starts, stops):
+                if start < stop:
+                    yield ([self.refids[refs[start]]],
+                           [self.targetids[i] for i in targets[start:stop]])
+
+    def _cleanup(self):
+        """ Cleanup blocking for further use (e.g. in pipeline)
+        """
+        self.ref_matrix = None
+        self.target_matrix = None
+        self.ref_lengths = None
+        self.target_lengths = None
+
+
+###############################################################################
+### SORTKEY BLOCKING ##########################################################
+###############################################################################
+class SortedNeighborhoodBlocking(BaseBlocking):
+    """ This blocking technique is based on a a sorting blocking criteria
+    (or blocking key), that will be used to divide the datasets.
+    """
+
+    def __init__(self, ref_attr_index, target_attr_index, key_func=lambda x: x, window_width=20):
+        super(SortedNeighborhoodBlocking, self).__init__(ref_attr_index, target_attr_index)
+        self.key_func = key_func
+        self.window_width = window_width
+        # Sorted union of both datasets: indexes of the records in their
+        # dataset, and dataset flags (0 for the reference set, 1 for the target set)
+        self.sorted_indices = None
+        self.sorted_flags = None
+
+    def _fit(self, refset, targetset):
+        """ Fit a dataset in an index using the callback
+        """
+        values = [r[self.ref_attr_index] for r in refset]
+        values.extend(r[self.target_attr_index] for r in targetset)
+        order = np.array(sorted(xrange(len(values)),
+                                key=lambda ind: self.key_func(values[ind])),
+                         dtype=np.int64).reshape(-1)
+        self.sorted_flags = (order >= len(refset)).astype(np.int8)
+        self.sorted_indices = np.where(self.sorted_flags, order - len(refset), order)
+
+    def _iter_blocks(self):
+        """ Iterator over the different possible blocks.
+        """
+        target_positions = np.flatnonzero(self.sorted_flags)
+        ref_positions = np.flatnonzero(self.sorted_flags == 0)
+        starts = np.searchsorted(target_positions, ref_positions - self.window_width)
+        stops = np.searchsorted(target_positions, ref_positions + self.window_width,
+                                side='right')
+        for position, start, stop in zip(ref_positions, starts, stops):
+            if start == stop:
+                continue
+            block1 = [self.refids[self.sorted_indices[position]],]
+            block2 = [self.targetids[i]
+                      for i in self.sorted_indices[target_positions[start:stop]]]
+            yield (block1, block2)
+
+    def _dump(self):
+        """ Export the sorted union of the datasets
+        """
+        return ({'sorted_indices': self.sorted_indices,
+                 'sorted_flags': self.sorted_flags}, None)
+
+    def _load(self, arrays, metadata):
+        """ Import the sorted union of the datasets
+        """
+        self.sorted_indices = arrays['sorted_indices']
+        self.sorted_flags = arrays['sorted_flags']
+
+    def _cleanup(self):
+        """ Cleanup blocking for further use (e.g. in pipeline)
+        """
+        self.sorted_indices = None
+        self.sorted_flags = None
+
+
+class ExternalSortedNeighborhoodBlocking(SortedNeighborhoodBlocking):
+    """ A sorted neighborhood blocking for datasets larger than the memory.
+
+    The (key, dataset flag, index) entries of both datasets are sorted by runs
+    of `buffer_size` entries, written in temporary files, and the runs are
+    merged (k-way merge) while iterating over the blocks, the windows being
+    built on the merged stream. The blocks are the same as the ones of the
+    SortedNeighborhoodBlocking. The ids of the records are read in the
+    datasets when building the blocks, instead of being copied in memory.
+
+    The temporary files are removed by `cleanup()`, which should be called once
+    the blocking is no longer used (they are otherwise removed when the
+    blocking is garbage collected).
+    """
+
+    def __init__(self, ref_attr_index, target_attr_index, key_func=lambda x: x,
+                 window_width=20, buffer_size=1000000, tmpdir=None):
+        """ Build the blocking object
+
+        Parameters
+        ----------
+
+        ref_attr_index: index of the attribute of interest in a record
+                        for the reference dataset
+
+        target_attr_index: index of the attribute of interest in a record
+                           for the target dataset
+
+        key_func: function computing the sort key of an attribute value
+
+        window_width: number of records before and after each reference
+                      in the sorted union of the datasets
+
+        buffer_size: number of entries sorted in memory, i.e. size of the runs
+
+        tmpdir: directory of the temporary files of the runs
+        """
+        super(ExternalSortedNeighborhoodBlocking, self).__init__(ref_attr_index,
+                                                                 target_attr_index,
+                                                                 key_func, window_width)
+        self.buffer_size = buffer_size
+        self.tmpdir = tmpdir
+        self.rundir = None
+        self.runs = []
+        self.nb_entries = 0
+
+    def __del__(self):
+        if getattr(self, 'rundir', None) is not None:
+            shutil.rmtree(self.rundir, ignore_errors=True)
+
+    def fit(self, refset, targetset):
+        """ Fit the blocking technique on the reference and target datasets,
+        keeping references to the datasets for the ids of the records
+
+        Parameters
+        ----------
+        refset: a dataset (list of records)
+
+        targetset: a dataset (list of records)
+        """
+        self._fit(refset, targetset)
+        self.refids = RecordIds(refset)
+        self.targetids = RecordIds(targetset)
+        self.is_fitted = True
+
+    def _write_run(self, entries):
+        """ Sort the entries and write them in a new run file
+        """
+        entries.sort()
+        filename = osp.join(self.rundir, 'run%s' % len(self.runs))
+        with open(filename, 'wb') as fobj:
+            pickler = cPickle.Pickler(fobj, cPickle.HIGHEST_PROTOCOL)
+            for start in xrange(0, len(entries), 10000):
+                pickler.dump(entries[start:start+10000])
+                # Avoid keeping references to all the dumped entries
+                pickler.clear_memo()
+        self.runs.append(filename)
+
+    def _iter_run(self, filename):
+        """ Iterator over the sorted entries of a run file
+        """
+        with open(filename, 'rb') as fobj:
+            unpickler = cPickle.Unpickler(fobj)
+            while True:
+                try:
+                    entries = unpickler.load()
+                except EOFError:
+                    return
+                for entry in entries:
+                    yield entry
+
+    def _fit(self, refset, targetset):
+        """ Write the sorted runs of both datasets
+        """
+        self._cleanup()
+        self.rundir = tempfile.mkdtemp(prefix='nazca-snb-', dir=self.tmpdir)
+        entries = []
+        for flag, dataset, attr_index in ((0, refset, self.ref_attr_index),
+                                          (1, targetset, self.target_attr_index)):
+            for ind, r in enumerate(dataset):
+                entries.append((self.key_func(r[attr_index]), flag, ind))
+                self.nb_entries += 1
+                if len(entries) >= self.buffer_size:
+                    self._write_run(entries)
+                    entries = []
+        if entries:
+            self._write_run(entries)
+
+    def _iter_merged_runs(self):
+        """ Iterator over the (key, flag, index) entries of the merged runs
+        """
+        return heapq.merge(*[self._iter_run(f) for f in self.runs])
+
+    def _iter_blocks(self):
+        """ Iterator over the different possible blocks.
+        """
+        if self.sorted_indices is not None:
+            # Loaded blocking, see _dump
+            for block in super(ExternalSortedNeighborhoodBlocking, self)._iter_blocks():
+                yield block
+            return
+        # Sliding window on the merged stream: the entry at the center of the
+        # window (of length 2 * window_width + 1) is followed by window_width
+        # entries
+        window = deque(maxlen=2 * self.window_width + 1)
+        for _, flag, ind in self._iter_merged_runs():
+            window.append((flag, ind))
+            center = len(window) - self.window_width - 1
+            if center >= 0:
+                block = self._window_block(window, center, 0)
+                if block:
+                    yield block
+        # The last entries, followed by less than window_width entries
+        for center in xrange(max(len(window) - self.window_width, 0), len(window)):
+            block = self._window_block(window, center, max(center - self.window_width, 0))
+            if block:
+                yield block
+
+    def _window_block(self, window, center, start):
+        """ Return the block of the reference at the center of the window,
+        the window starting at `start` (or None if the center is a target
+        or if there is no target in the window)
+        """
+        flag, ind = window[center]
+        if flag == 1:
+            return None
+        block2 = [self.targetids[i] for f, i in islice(window, start, None) if f == 1]
+        if block2:
+            return [self.refids[ind],], block2
+
+    def _dump(self):
+        """ Export the merged runs as the sorted union of the datasets of the
+        SortedNeighborhoodBlocking, the arrays being filled by chunks in
+        memory-mapped files of the runs directory
+        """
+        if self.sorted_indices is not None:
+            return super(ExternalSortedNeighborhoodBlocking, self)._dump()
+        arrays = {}
+        for name, dtype in (('sorted_indices', np.int64), ('sorted_flags', np.int8)):
+            if self.nb_entries:
+                arrays[name] = np.lib.format.open_memmap(
+                    osp.join(self.rundir, name + '.npy'), mode='w+',
+                    dtype=dtype, shape=(self.nb_entries,))
+            else:
+                arrays[name] = np.zeros(0, dtype=dtype)
+        merged = self._iter_merged_runs()
+        for start in xrange(0, self.nb_entries, self.buffer_size):
+            entries = list(islice(merged, self.buffer_size))
+            stop = start + len(entries)
+            arrays['sorted_flags'][start:stop] = [flag for _, flag, _ in entries]
+            arrays['sorted_indices'][start:stop] = [ind for _, _, ind in entries]
+        return arrays, None
 
     def _cleanup(self):
         """ Cleanup blocking for further use (e.g. in pipeline)
         """
-        self.sorted_dataset = None
+        super(ExternalSortedNeighborhoodBlocking, self)._cleanup()
+        if self.rundir is not None:
+            shutil.rmtree(self.rundir, ignore_errors=True)
+        self.rundir = None
+        self.runs = []
+        self.nb_entries = 0
 
 
 ###############################################################################
@@ -379,44 +1709,87 @@ class MergeBlocking(BaseBlocking):
 
       ('http://fr.wikipedia.org/wiki/Paris', 'Paris', 12223100)
 
+    If the score is an attribute of the records, `score_index` may be given
+    instead of `score_func`, and the best record of each value is found by
+    a vectorized group-by-argmax on the scores array.
+
+    The merge produces a single block, that may be split by using this
+    blocking as the first blocking of a PipelineBlocking,
+    e.g. PipelineBlocking((MergeBlocking(...), KeyBlocking(...))).
+
     !!! WARNING !!! This is only done on ONE set (the one with a non null attr index)
     """
 
-    def __init__(self, ref_attr_index, target_attr_index, score_func):
+    def __init__(self, ref_attr_index, target_attr_index, score_func=None,
+                 score_index=None):
         super(MergeBlocking, self).__init__(ref_attr_index, target_attr_index)
         self.score_func = score_func
+        self.score_index = score_index
+        self.merged_indices = None
         self.merged_dataset = None
         self.other_dataset = None
         if ref_attr_index is None and target_attr_index is None:
             raise ValueError('At least one of ref_attr_index or target_attr_index '
                              'should not be None')
+        if score_func is None and score_index is None:
+            raise ValueError('At least one of score_func or score_index '
+                             'should not be None')
 
     def _fit(self, refset, targetset):
         """ Fit a dataset in an index using the callback
         """
         if self.ref_attr_index is not None:
             # Merge refset
-            self.merged_dataset = self._merge_dataset(refset, self.ref_attr_index)
+            self.merged_indices = self._merge_dataset(refset, self.ref_attr_index)
+            self.merged_dataset = [(ind, refset[ind][0]) for ind in self.merged_indices]
             self.other_dataset = [(ind, r[0]) for ind, r in enumerate(targetset)]
         else:
             # Merge targetset
-            self.merged_dataset = self._merge_dataset(targetset, self.target_attr_index)
+            self.merged_indices = self._merge_dataset(targetset, self.target_attr_index)
+            self.merged_dataset = [(ind, targetset[ind][0]) for ind in self.merged_indices]
             self.other_dataset = [(ind, r[0]) for ind, r in enumerate(refset)]
 
     def _merge_dataset(self, dataset, attr_index):
-        """ Merge a dataset
+        """ Merge a dataset, and return the sorted array of the indexes
+        of the kept records
         """
+        if self.score_index is not None:
+            return self._merge_scores(dataset, attr_index)
         merged_dataset_dict = {}
         for ind, record in enumerate(dataset):
             score = self.score_func(record)
             if record[attr_index] not in merged_dataset_dict:
                 # Create new entry
-                merged_dataset_dict[record[attr_index]] = (ind, record, score)
-            elif (record[attr_index] in merged_dataset_dict
-                  and merged_dataset_dict[record[attr_index]][2] < score):
+                merged_dataset_dict[record[attr_index]] = (ind, score)
+            elif merged_dataset_dict[record[attr_index]][1] < score:
                 # Change current score
-                merged_dataset_dict[record[attr_index]] = (ind, record, score)
-        return [(ind, r[0]) for ind, r, score in merged_dataset_dict.itervalues()]
+                merged_dataset_dict[record[attr_index]] = (ind, score)
+        return np.array(sorted(ind for ind, score in merged_dataset_dict.itervalues()),
+                        dtype=np.int64)
+
+    def _merge_scores(self, dataset, attr_index):
+        """ Merge a dataset using a group-by-argmax on the scores
+        """
+        value_ids = {}
+        codes = np.array([value_ids.setdefault(r[attr_index], len(value_ids))
+                          for r in dataset], dtype=np.int64)
+        scores = np.array([r[self.score_index] for r in dataset], dtype=np.float64)
+        # Sort on the codes, then on the decreasing scores (the sort being
+        # stable, the first record is kept in case of equal scores)
+        order = np.lexsort((-scores, codes))
+        sorted_codes = codes[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = sorted_codes[1:] != sorted_codes[:-1]
+        return np.sort(order[first])
+
+    def _iter_array_blocks(self):
+        """ Iteration over the blocks of indexes arrays
+        """
+        other_indices = np.arange(len(self.other_dataset))
+        if self.ref_attr_index is not None:
+            yield self.merged_indices, other_indices
+        else:
+            yield other_indices, self.merged_indices
 
     def _iter_blocks(self):
         """ Iterator over the different possible blocks.
@@ -430,6 +1803,7 @@ class MergeBlocking(BaseBlocking):
     def _cleanup(self):
         """ Cleanup blocking for further use (e.g. in pipeline)
         """
+        self.merged_indices = None
         self.merged_dataset = None
         self.other_dataset = None
 
@@ -439,34 +1813,157 @@ class MergeBlocking(BaseBlocking):
 ###############################################################################
 class KmeansBlocking(BaseBlocking):
     """ A blocking technique based on Kmeans
+
+    The reference set is clustered, and each target record is assigned
+    to its closest cluster(s). Three modes are available:
+
+    - 'full': classical Kmeans, fitted on the whole reference set.
+
+    - 'minibatch': Kmeans fitted on mini-batches of the reference set,
+      which is much faster on large datasets.
+
+    - 'bisecting': hierarchical clustering, recursively splitting the largest
+      clusters in two (using mini-batch Kmeans), until their size is below
+      `target_block_size`. The fit time is then nearly linear in the size of
+      the reference set.
     """
 
-    def __init__(self, ref_attr_index, target_attr_index, n_clusters=None):
+    def __init__(self, ref_attr_index, target_attr_index, n_clusters=None,
+                 mode='full', target_block_size=None, top_n=1,
+                 batch_size=1000, chunk_size=10000, random_state=None):
+        """ Build the blocking object
+
+        Parameters
+        ----------
+
+        ref_attr_index: index of the attribute of interest in a record
+                        for the reference dataset
+
+        target_attr_index: index of the attribute of interest in a record
+                           for the target dataset
+
+        n_clusters: number of clusters. If not given, it is derived from
+                    `target_block_size`, or is len(refset)/10.
+
+        mode: 'full', 'minibatch' or 'bisecting'
+
+        target_block_size: expected number of reference records in a block
+
+        top_n: number of closest clusters each target record is assigned to
+
+        batch_size: size of the mini-batches ('minibatch' and 'bisecting' modes)
+
+        chunk_size: number of target records assigned at once
+
+        random_state: seed of the clusterings
+        """
+        if mode not in ('full', 'minibatch', 'bisecting'):
+            raise ValueError("Unknown mode %s, should be 'full', 'minibatch' "
+                             "or 'bisecting'" % mode)
         super(KmeansBlocking, self).__init__(ref_attr_index, target_attr_index)
         self.n_clusters = n_clusters
+        self.mode = mode
+        self.target_block_size = target_block_size
+        self.top_n = top_n
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.random_state = random_state
         self.kmeans = None
+        self.labels = None
+        self.centers = None
         self.predicted = None
         from sklearn import cluster
         self.cluster_class = cluster.KMeans
+        self.minibatch_class = cluster.MiniBatchKMeans
+
+    def _points(self, dataset, attr_index, idelement):
+        """ Return the array of the points of (a part of) a dataset
+        """
+        # If an element is None (missing), use instead the identity element.
+        return np.array([elt[attr_index] or idelement for elt in dataset],
+                        dtype=np.float64)
+
+    def _build_kmeans(self, n_clusters):
+        """ Return a Kmeans object of the current mode
+        """
+        if self.mode == 'full':
+            try:
+                return self.cluster_class(n_clusters=n_clusters,
+                                          random_state=self.random_state)
+            except TypeError:
+                # Try older API version of sklearn
+                return self.cluster_class(k=n_clusters)
+        return self.minibatch_class(n_clusters=n_clusters, batch_size=self.batch_size,
+                                    random_state=self.random_state)
+
+    def _bisect(self, points, n_clusters):
+        """ Hierarchical clustering of the points, splitting the largest
+        clusters first. Return the labels of the points.
+        """
+        target_size = self.target_block_size or max(len(points) // n_clusters, 1)
+        heap = [(-len(points), 0, np.arange(len(points)))]
+        leaves = []
+        nb_splits = 0
+        while heap:
+            size, _, indices = heapq.heappop(heap)
+            if -size <= target_size or len(heap) + len(leaves) + 1 >= n_clusters:
+                leaves.append(indices)
+                continue
+            sublabels = self._build_kmeans(2).fit(points[indices]).labels_
+            if sublabels.min() == sublabels.max():
+                # The cluster could not be split
+                leaves.append(indices)
+                continue
+            for label in (0, 1):
+                nb_splits += 1
+                subindices = indices[sublabels == label]
+                heapq.heappush(heap, (-len(subindices), nb_splits, subindices))
+        labels = np.empty(len(points), dtype=np.int64)
+        for label, indices in enumerate(leaves):
+            labels[indices] = label
+        return labels
+
+    def _predict(self, points):
+        """ Return the `top_n` closest clusters of the given points
+        """
+        distances = (-2 * np.dot(points, self.centers.T)
+                     + (self.centers ** 2).sum(axis=1))
+        if self.top_n == 1:
+            return distances.argmin(axis=1)[:, None]
+        top_n = min(self.top_n, len(self.centers))
+        return np.argpartition(distances, top_n - 1, axis=1)[:, :top_n]
 
     def _fit(self, refset, targetset):
         """ Fit the reference dataset.
         """
-        # If an element is None (missing), use instead the identity element.
         # The identity element is defined as the 0-vector
         idelement = tuple([0 for _ in xrange(len(refset[0][self.ref_attr_index]))])
         # We assume here that there are at least 2 elements in the refset
-        n_clusters = self.n_clusters or (len(refset)/10 or len(refset)/2)
-        try:
-            kmeans =  self.cluster_class(n_clusters=n_clusters)
-        except TypeError:
-            # Try older API version of sklearn
-            kmeans =  self.cluster_class(k=n_clusters)
-        kmeans.fit([elt[self.ref_attr_index] or idelement for elt in refset])
-        self.kmeans = kmeans
-        # Predict on targetset
-        self.predicted = self.kmeans.predict([elt[self.target_attr_index]
-                                              or idelement for elt in targetset])
+        if self.n_clusters:
+            n_clusters = self.n_clusters
+        elif self.target_block_size:
+            n_clusters = max(int(np.ceil(len(refset) / float(self.target_block_size))), 1)
+        else:
+            n_clusters = len(refset)/10 or len(refset)/2
+        points = self._points(refset, self.ref_attr_index, idelement)
+        if self.mode == 'bisecting':
+            self.labels = self._bisect(points, n_clusters)
+            # The centers are the means of the leaves
+            nb_labels = self.labels.max() + 1
+            self.centers = (np.array([np.bincount(self.labels, weights=points[:, dim],
+                                                  minlength=nb_labels)
+                                      for dim in xrange(points.shape[1])]).T
+                            / np.bincount(self.labels, minlength=nb_labels)[:, None])
+        else:
+            self.kmeans = self._build_kmeans(n_clusters)
+            self.kmeans.fit(points)
+            self.labels = np.asarray(self.kmeans.labels_, dtype=np.int64)
+            self.centers = np.asarray(self.kmeans.cluster_centers_, dtype=np.float64)
+        # Predict on targetset, by chunks
+        self.predicted = np.concatenate([
+            self._predict(self._points(targetset[start:start+self.chunk_size],
+                                       self.target_attr_index, idelement))
+            for start in xrange(0, len(targetset), self.chunk_size)])
 
     def _iter_blocks(self):
         """ Iterator over the different possible blocks.
@@ -478,35 +1975,213 @@ class KmeansBlocking(BaseBlocking):
                           and containts the indexes of the record in the
                           corresponding dataset.
         """
-        n_clusters = self.kmeans.n_clusters if hasattr(self.kmeans, 'n_clusters') else self.kmeans.k
-        neighbours = [[[], []] for _ in xrange(n_clusters)]
-        for ind, li in enumerate(self.predicted):
-            neighbours[li][1].append(self.targetids[ind])
-        for ind, li in enumerate(self.kmeans.labels_):
-            neighbours[li][0].append(self.refids[ind])
-        for block1, block2 in neighbours:
+        nb_labels = len(self.centers)
+        ref_order = np.argsort(self.labels, kind='mergesort')
+        ref_bounds = np.r_[0, np.cumsum(np.bincount(self.labels, minlength=nb_labels))]
+        target_labels = self.predicted.ravel()
+        target_order = np.argsort(target_labels, kind='mergesort') // self.predicted.shape[1]
+        target_bounds = np.r_[0, np.cumsum(np.bincount(target_labels, minlength=nb_labels))]
+        for label in xrange(nb_labels):
+            block1 = ref_order[ref_bounds[label]:ref_bounds[label+1]]
+            block2 = target_order[target_bounds[label]:target_bounds[label+1]]
             if len(block1) and len(block2):
-                yield block1, block2
+                yield ([self.refids[i] for i in block1],
+                       [self.targetids[i] for i in block2])
 
     def _cleanup(self):
         """ Cleanup blocking for further use (e.g. in pipeline)
         """
         self.kmeans = None
+        self.labels = None
+        self.centers = None
         self.predicted = None
 
 
+class CanopyBlocking(BaseBlocking):
+    """ A blocking technique based on canopy clustering.
+
+    The attributes of both datasets are turned into TF-IDF vectors. A record
+    not yet removed is taken as the center of a new canopy, which contains all
+    the records whose cosine similarity with the center is above the loose
+    threshold; the records above the tight threshold cannot be the center of
+    another canopy. Each canopy is returned as a block, so blocks may overlap.
+
+    The similarities with a center are computed through the inverted index
+    (term -> records) of the TF-IDF matrix, so only the records sharing a term
+    with the center are considered.
+
+    Additional information:
+
+       A. McCallum, K. Nigam and L. Ungar, Efficient clustering of
+       high-dimensional data sets with application to reference matching, KDD 2000
+    """
+
+    def __init__(self, ref_attr_index, target_attr_index, loose_threshold=0.5,
+                 tight_threshold=0.8, analyzer='word', ngram_size=1, tokenizer=None):
+        """ Build the blocking object
+
+        Parameters
+        ----------
+
+        ref_attr_index: index of the attribute of interest in a record
+                        for the reference dataset
+
+        target_attr_index: index of the attribute of interest in a record
+                           for the target dataset
+
+        loose_threshold: minimal cosine similarity with the center
+                         of a canopy to be in the canopy
+
+        tight_threshold: minimal cosine similarity with the center of a canopy
+                         to be removed from the possible centers
+
+        analyzer: 'word' or 'char', terms used in the TF-IDF vectors
+
+        ngram_size: size of the (word or char) n-grams
+
+        tokenizer: tokenizer used for the 'word' analyzer
+        """
+        if loose_threshold > tight_threshold:
+            raise ValueError('The loose threshold should be lower than the tight one')
+        super(CanopyBlocking, self).__init__(ref_attr_index, target_attr_index)
+        self.loose_threshold = loose_threshold
+        self.tight_threshold = tight_threshold
+        self.analyzer = analyzer
+        self.ngram_size = ngram_size
+        self.tokenizer = tokenizer
+        self.matrix = None
+        self.inverted_index = None
+        self.nb_elements = None
+
+    def _fit(self, refset, targetset):
+        """ Compute the TF-IDF vectors of the union of both datasets
+        """
+        texts = ([r[self.ref_attr_index] for r in refset]
+                 + [r[self.target_attr_index] for r in targetset])
+        self.matrix, _ = tfidf_matrix(texts, self.analyzer, self.ngram_size,
+                                      self.tokenizer)
+        self.inverted_index = self.matrix.tocsc()
+        self.nb_elements = len(refset)
+
+    def _similarities(self, center):
+        """ Return the records sharing a term with the center,
+        and their cosine similarities
+        """
+        start, stop = self.matrix.indptr[center], self.matrix.indptr[center+1]
+        postings = self.inverted_index[:, self.matrix.indices[start:stop]].tocoo()
+        records, inverse = np.unique(postings.row, return_inverse=True)
+        weights = postings.data * self.matrix.data[start:stop][postings.col]
+        return records, np.bincount(inverse, weights=weights)
+
+    def _iter_blocks(self):
+        """ Iterator over the different possible blocks.
+
+        Returns
+        -------
+
+        (block1, block2): The blocks are always (reference_block, target_block)
+                          and containts the indexes of the record in the
+                          corresponding dataset.
+        """
+        candidates = np.diff(self.matrix.indptr) > 0
+        for center in xrange(self.matrix.shape[0]):
+            if not candidates[center]:
+                continue
+            records, similarities = self._similarities(center)
+            candidates[records[similarities >= self.tight_threshold]] = False
+            candidates[center] = False
+            canopy = records[similarities >= self.loose_threshold]
+            block1 = canopy[canopy < self.nb_elements]
+            block2 = canopy[canopy >= self.nb_elements] - self.nb_elements
+            if len(block1) and len(block2):
+                yield ([self.refids[i] for i in block1],
+                       [self.targetids[i] for i in block2])
+
+    def _cleanup(self):
+        """ Cleanup blocking for further use (e.g. in pipeline)
+        """
+        self.matrix = None
+        self.inverted_index = None
+        self.nb_elements = None
+
+
 ###############################################################################
 ### KDTREE BLOCKINGS ##########################################################
 ###############################################################################
 class KdTreeBlocking(BaseBlocking):
     """ A blocking technique based on KdTree
+
+    The reference points are queried by chunks against the KdTree of the target
+    points, and the blocks of a chunk are returned before querying the next one.
     """
-    def __init__(self, ref_attr_index, target_attr_index, threshold=0.1):
+    def __init__(self, ref_attr_index, target_attr_index, threshold=0.1,
+                 chunk_size=10000, n_jobs=1, return_distances=False, distance_func=None,
+                 in_radians=False, planet_radius=6371009, units='m'):
+        """ Build the blocking object
+
+        Parameters
+        ----------
+
+        ref_attr_index: index of the attribute of interest in a record
+                        for the reference dataset
+
+        target_attr_index: index of the attribute of interest in a record
+                           for the target dataset
+
+        threshold: radius of the neighbourhood of a reference point
+
+        chunk_size: number of reference points queried at once
+
+        n_jobs: number of parallel jobs used by the KdTree queries
+                (-1 to use all the CPUs)
+
+        return_distances: if True, the distances between each reference point
+                          and its neighbours are stored in the `distances`
+                          attribute while iterating over the blocks, as a dict
+                          {ref index: (sorted target indexes, distances)}.
+                          It may be given to a processing (see the `precomputed`
+                          argument of GeographicalProcessing), so the distances
+                          are not computed again by the aligner.
+
+        distance_func: vectorized distance, taking two (n, d) arrays of points,
+                       used when return_distances is True. Default is
+                       distances.geographical_array, for (latitude, longitude)
+                       points, with the following settings.
+
+        in_radians, planet_radius, units: settings of the stored distances
+                                          (see distances.geographical). A given
+                                          distance_func should use the same ones,
+                                          as they are checked by the
+                                          GeographicalProcessing using them.
+        """
         super(KdTreeBlocking, self).__init__(ref_attr_index, target_attr_index)
         self.threshold = threshold
-        self.reftree = None
+        self.chunk_size = chunk_size
+        self.n_jobs = n_jobs
+        self.return_distances = return_distances
+        self.distance_settings = {'in_radians': in_radians,
+                                  'planet_radius': planet_radius,
+                                  'units': units}
+        if distance_func is None:
+            distance_func = partial(geographical_array, **self.distance_settings)
+        self.distance_func = distance_func
+        self.refpoints = None
         self.targettree = None
         self.nb_elements = None
+        self.distances = {}
+
+    def _points(self, dataset, attr_index, idsize):
+        """ Return the array of the points of a dataset
+        """
+        # If an element is None (missing), use instead the identity element.
+        idelement = (0,) * idsize
+        if idsize == 1:
+            # KDTree is expecting a two-dimensional array
+            points = [(elt[attr_index],) if elt[attr_index] is not None else idelement
+                      for elt in dataset]
+        else:
+            points = [elt[attr_index] or idelement for elt in dataset]
+        return np.array(points, dtype=np.float64).reshape(len(dataset), idsize)
 
     def _fit(self, refset, targetset):
         """ Fit the blocking
@@ -514,14 +2189,32 @@ class KdTreeBlocking(BaseBlocking):
         firstelement = refset[0][self.ref_attr_index]
         self.nb_elements = len(refset)
         idsize = len(firstelement) if isinstance(firstelement, (tuple, list)) else 1
-        idelement = (0,) * idsize
-        # KDTree is expecting a two-dimensional array
-        if idsize == 1:
-            self.reftree  = KDTree([(elt[self.ref_attr_index],) or idelement for elt in refset])
-            self.targettree = KDTree([(elt[self.target_attr_index],) or idelement for elt in targetset])
-        else:
-            self.reftree = KDTree([elt[self.ref_attr_index] or idelement for elt in refset])
-            self.targettree = KDTree([elt[self.target_attr_index] or idelement for elt in targetset])
+        self.refpoints = self._points(refset, self.ref_attr_index, idsize)
+        self.targettree = cKDTree(self._points(targetset, self.target_attr_index, idsize))
+        self.distances = {}
+
+    def _query(self, points):
+        """ Query the neighbours of the given points in the target tree
+        """
+        if self.n_jobs == 1:
+            return self.targettree.query_ball_point(points, self.threshold)
+        try:
+            return self.targettree.query_ball_point(points, self.threshold,
+                                                    workers=self.n_jobs)
+        except TypeError:
+            # Older API version of scipy
+            return self.targettree.query_ball_point(points, self.threshold,
+                                                    n_jobs=self.n_jobs)
+
+    def _compute_distances(self, refs, neighbours):
+        """ Compute the distances between the points of a chunk
+        and their neighbours
+        """
+        sizes = [len(n) for n in neighbours]
+        ref_points = self.refpoints[np.repeat(refs, sizes)]
+        target_points = self.targettree.data[np.concatenate(neighbours)]
+        distances = np.asarray(self.distance_func(ref_points, target_points))
+        return np.split(distances, np.cumsum(sizes)[:-1])
 
     def _iter_blocks(self):
         """ Iterator over the different possible blocks.
@@ -533,24 +2226,374 @@ class KdTreeBlocking(BaseBlocking):
                           and containts the indexes of the record in the
                           corresponding dataset.
         """
-        extraneighbours = self.reftree.query_ball_tree(self.targettree, self.threshold)
-        neighbours = []
-        for ind in xrange(self.nb_elements):
-            if not extraneighbours[ind]:
+        for start in xrange(0, self.nb_elements, self.chunk_size):
+            extraneighbours = self._query(self.refpoints[start:start+self.chunk_size])
+            refs = [start + offset for offset, n in enumerate(extraneighbours) if len(n)]
+            neighbours = [np.sort(np.asarray(extraneighbours[ind - start], dtype=np.int64))
+                          for ind in refs]
+            if not refs:
                 continue
-            _ref = [self.refids[ind],]
-            _target = [self.targetids[v] for v in extraneighbours[ind]]
-            neighbours.append((_ref, _target))
-        for block1, block2 in neighbours:
-            if len(block1) and len(block2):
-                yield block1, block2
+            if self.return_distances:
+                for ind, targets, distances in zip(refs, neighbours,
+                                                   self._compute_distances(refs, neighbours)):
+                    self.distances[ind] = (targets, distances)
+            for ind, targets in zip(refs, neighbours):
+                yield [self.refids[ind],], [self.targetids[v] for v in targets]
 
     def _cleanup(self):
         """ Cleanup blocking for further use (e.g. in pipeline)
         """
-        self.reftree = None
+        self.refpoints = None
         self.targettree = None
         self.nb_elements = None
+        self.distances = {}
+
+
+class GeoGridBlocking(BaseBlocking):
+    """ A geographical blocking technique based on a grid of cells.
+
+    The (latitude, longitude) points are mapped to the cells of a grid, made of
+    latitude bands whose height is the threshold, each band being split in
+    longitude cells whose width is at least the threshold (on the side of the
+    band closest to the pole). Thus, the points closer than the threshold
+    (following distances.geographical) are always in the same or in
+    neighbouring cells, and each cell of the reference points is blocked with
+    the target points of its neighbouring cells.
+    """
+
+    def __init__(self, ref_attr_index, target_attr_index, threshold=1000,
+                 in_radians=False, planet_radius=6371009, units='m'):
+        """ Build the blocking object
+
+        Parameters
+        ----------
+
+        ref_attr_index: index of the (latitude, longitude) attribute
+                        for the reference dataset
+
+        target_attr_index: index of the (latitude, longitude) attribute
+                           for the target dataset
+
+        threshold: distance (in `units`) below which two points
+                   should be in the same block
+
+        in_radians: True if latitudes and longitudes are in radians
+
+        planet_radius: the planet's radius in meters
+
+        units: units of the threshold, 'm' (meters) or 'km' (kilometers)
+        """
+        if units not in ('m', 'km'):
+            raise ValueError("unsupported units, should be in m or km")
+        super(GeoGridBlocking, self).__init__(ref_attr_index, target_attr_index)
+        self.threshold = threshold
+        self.in_radians = in_radians
+        self.planet_radius = planet_radius
+        self.units = units
+        self.band_height = None
+        self.band_cells = None
+        self.band_offsets = None
+        self.ref_cells = None
+        self.target_cells = None
+
+    def _build_grid(self):
+        """ Compute the number of longitude cells of each latitude band
+        """
+        threshold = self.threshold * (1. if self.units == 'm' else 1000.)
+        self.band_height = min(threshold / self.planet_radius, np.pi)
+        nb_bands = int(np.ceil(np.pi / self.band_height))
+        lower = np.arange(nb_bands) * self.band_height - np.pi / 2
+        # Use the latitude of the side of the band closest to the pole, with
+        # a margin of one band for the points of the neighbouring bands
+        maxlat = np.maximum(np.abs(lower), np.abs(lower + self.band_height)) + self.band_height
+        circumference = 2 * np.pi * self.planet_radius * np.cos(np.minimum(maxlat, np.pi / 2))
+        self.band_cells = np.maximum(np.floor(circumference / threshold), 1).astype(np.int64)
+        self.band_offsets = np.r_[0, np.cumsum(self.band_cells)[:-1]]
+
+    def _locate(self, dataset, attr_index):
+        """ Return the bands and longitudes (in radians) of the points
+        of a dataset (band -1 for missing points)
+        """
+        points = np.array([r[attr_index] if r[attr_index] is not None else (np.nan, np.nan)
+                           for r in dataset], dtype=np.float64).reshape(len(dataset), 2)
+        if not self.in_radians:
+            points *= np.pi / 180.
+        missing = np.isnan(points).any(axis=1)
+        points[missing] = 0
+        bands = np.floor((points[:, 0] + np.pi / 2) / self.band_height).astype(np.int64)
+        bands = np.clip(bands, 0, len(self.band_cells) - 1)
+        bands[missing] = -1
+        return bands, points[:, 1]
+
+    def _cell(self, bands, longitudes):
+        """ Return the cell (in the band) of the given longitudes
+        """
+        width = 2 * np.pi / self.band_cells[bands]
+        return np.floor((longitudes + np.pi) / width).astype(np.int64) % self.band_cells[bands]
+
+    def _fit(self, refset, targetset):
+        """ Fit the two sets (reference set and target set)
+        """
+        self._build_grid()
+        cells = []
+        for dataset, attr_index in ((refset, self.ref_attr_index),
+                                    (targetset, self.target_attr_index)):
+            bands, longitudes = self._locate(dataset, attr_index)
+            valid = bands >= 0
+            dataset_cells = np.repeat(-1, len(dataset))
+            dataset_cells[valid] = (self.band_offsets[bands[valid]]
+                                    + self._cell(bands[valid], longitudes[valid]))
+            cells.append(dataset_cells)
+        self.ref_cells, self.target_cells = cells
+
+    def _neighbour_cells(self, band, cell):
+        """ Return the cells neighbouring a cell of a band
+        (including the cell itself)
+        """
+        width = 2 * np.pi / self.band_cells[band]
+        minlon, maxlon = cell * width - np.pi, (cell + 1) * width - np.pi
+        neighbours = []
+        for nband in (band - 1, band, band + 1):
+            if nband < 0 or nband >= len(self.band_cells):
+                continue
+            nb_cells = self.band_cells[nband]
+            nwidth = 2 * np.pi / nb_cells
+            first = int(np.floor((minlon - nwidth + np.pi) / nwidth))
+            last = int(np.floor((maxlon + nwidth + np.pi) / nwidth))
+            if last - first + 1 >= nb_cells:
+                ncells = np.arange(nb_cells)
+            else:
+                ncells = np.unique(np.arange(first, last + 1) % nb_cells)
+            neighbours.append(self.band_offsets[nband] + ncells)
+        return np.concatenate(neighbours)
+
+    def _iter_blocks(self):
+        """ Iterator over the different possible blocks.
+
+        Returns
+        -------
+
+        (block1, block2): The blocks are always (reference_block, target_block)
+                          and containts the indexes of the record in the
+                          corresponding dataset.
+        """
+        target_order = np.argsort(self.target_cells, kind='mergesort')
+        target_sorted = self.target_cells[target_order]
+        ref_order = np.argsort(self.ref_cells, kind='mergesort')
+        ref_sorted = self.ref_cells[ref_order]
+        cells, starts = np.unique(ref_sorted, return_index=True)
+        stops = np.r_[starts[1:], len(ref_sorted)]
+        for cell, start, stop in zip(cells, starts, stops):
+            if cell < 0:
+                continue
+            band = np.searchsorted(self.band_offsets, cell, side='right') - 1
+            neighbours = self._neighbour_cells(band, cell - self.band_offsets[band])
+            lower = np.searchsorted(target_sorted, neighbours, side='left')
+            upper = np.searchsorted(target_sorted, neighbours, side='right')
+            block2 = np.sort(np.concatenate([target_order[l:u] for l, u in zip(lower, upper)]))
+            if len(block2):
+                yield ([self.refids[i] for i in ref_order[start:stop]],
+                       [self.targetids[i] for i in block2])
+
+    def _cleanup(self):
+        """ Cleanup blocking for further use (e.g. in pipeline)
+        """
+        self.band_height = None
+        self.band_cells = None
+        self.band_offsets = None
+        self.ref_cells = None
+        self.target_cells = None
+
+
+###############################################################################
+### SIMILARITY JOIN BLOCKINGS #################################################
+###############################################################################
+class TfidfBlocking(BaseBlocking):
+    """ A blocking technique based on an exact cosine similarity join
+    of the TF-IDF vectors of the attributes.
+
+    The sparse TF-IDF matrix of the reference records is multiplied by the one
+    of the target records by chunks of rows, and each reference is blocked with
+    the targets whose cosine similarity is above the threshold (only the
+    `top_n` most similar ones if it is given).
+    """
+
+    def __init__(self, ref_attr_index, target_attr_index, threshold=0.5, top_n=None,
+                 analyzer='char', ngram_size=3, tokenizer=None, chunk_size=1000,
+                 return_similarities=False):
+        """ Build the blocking object
+
+        Parameters
+        ----------
+
+        ref_attr_index: index of the attribute of interest in a record
+                        for the reference dataset
+
+        target_attr_index: index of the attribute of interest in a record
+                           for the target dataset
+
+        threshold: minimal cosine similarity of the pairs
+
+        top_n: if given, maximal number of targets of a reference
+
+        analyzer: 'word' or 'char', terms used in the TF-IDF vectors
+
+        ngram_size: size of the (word or char) n-grams
+
+        tokenizer: tokenizer used for the 'word' analyzer
+
+        chunk_size: number of reference rows multiplied at once
+
+        return_similarities: if True, the similarities between each reference
+                             and its targets are stored in the `similarities`
+                             attribute while iterating over the blocks, as a
+                             dict {ref index: (sorted target indexes, similarities)}
+        """
+        super(TfidfBlocking, self).__init__(ref_attr_index, target_attr_index)
+        self.threshold = threshold
+        self.top_n = top_n
+        self.analyzer = analyzer
+        self.ngram_size = ngram_size
+        self.tokenizer = tokenizer
+        self.chunk_size = chunk_size
+        self.return_similarities = return_similarities
+        self.ref_matrix = None
+        self.target_matrix = None
+        self.similarities = {}
+
+    def _fit(self, refset, targetset):
+        """ Compute the TF-IDF vectors of both datasets (with the document
+        frequencies of their union)
+        """
+        texts = ([r[self.ref_attr_index] for r in refset]
+                 + [r[self.target_attr_index] for r in targetset])
+        matrix, _ = tfidf_matrix(texts, self.analyzer, self.ngram_size, self.tokenizer)
+        self.ref_matrix = matrix[:len(refset)]
+        # Transposed target matrix, for the (ref x target) products
+        self.target_matrix = matrix[len(refset):].T.tocsr()
+        self.similarities = {}
+
+    def _chunk_pairs(self, start):
+        """ Return the pairs (refs, targets, similarities) of a chunk
+        of references, sorted by reference and target
+        """
+        product = (self.ref_matrix[start:start+self.chunk_size]
+                   * self.target_matrix).tocoo()
+        kept = product.data >= self.threshold
+        refs, targets = product.row[kept] + start, product.col[kept]
+        similarities = product.data[kept]
+        if self.top_n is not None and len(refs):
+            # Rank of the targets of each reference by decreasing similarity
+            order = np.lexsort((-similarities, refs))
+            starts = np.searchsorted(refs[order], refs[order])
+            order = order[np.arange(len(order)) - starts < self.top_n]
+            refs, targets, similarities = refs[order], targets[order], similarities[order]
+        order = np.lexsort((targets, refs))
+        return refs[order], targets[order], similarities[order]
+
+    def _iter_blocks(self):
+        """ Iterator over the different possible blocks.
+
+        Returns
+        -------
+
+        (block1, block2): The blocks are always (reference_block, target_block)
+                          and containts the indexes of the record in the
+                          corresponding dataset.
+        """
+        for start in xrange(0, self.ref_matrix.shape[0], self.chunk_size):
+            refs, targets, similarities = self._chunk_pairs(start)
+            if not len(refs):
+                continue
+            bounds = np.flatnonzero(np.diff(refs)) + 1
+            for block_targets, block_similarities, ind in zip(
+                    np.split(targets, bounds), np.split(similarities, bounds),
+                    refs[np.r_[0, bounds]]):
+                if self.return_similarities:
+                    self.similarities[ind] = (block_targets, block_similarities)
+                yield [self.refids[ind],], [self.targetids[i] for i in block_targets]
+
+    def _cleanup(self):
+        """ Cleanup blocking for further use (e.g. in pipeline)
+        """
+        self.ref_matrix = None
+        self.target_matrix = None
+        self.similarities = {}
+
+
+class PPJoinBlocking(BaseBlocking):
+    """ A blocking technique based on an exact Jaccard set-similarity join
+    of the tokens of the attributes (see set_similarity_join).
+
+    Each reference is blocked with the targets whose jaccard distance (as
+    computed by distances.jaccard) is below 1 - threshold, so the blocks
+    may be used as the final matches of a JaccardProcessing.
+    """
+
+    def __init__(self, ref_attr_index, target_attr_index, threshold=0.5,
+                 tokenizer=None, return_similarities=False):
+        """ Build the blocking object
+
+        Parameters
+        ----------
+
+        ref_attr_index: index of the attribute of interest in a record
+                        for the reference dataset
+
+        target_attr_index: index of the attribute of interest in a record
+                           for the target dataset
+
+        threshold: minimal Jaccard similarity of the pairs
+
+        tokenizer: tokenizer of the attributes
+
+        return_similarities: if True, the similarities between each reference
+                             and its targets are stored in the `similarities`
+                             attribute while iterating over the blocks, as a
+                             dict {ref index: (sorted target indexes, similarities)}
+        """
+        if not 0 < threshold <= 1:
+            raise ValueError('The threshold should be in ]0, 1]')
+        super(PPJoinBlocking, self).__init__(ref_attr_index, target_attr_index)
+        self.threshold = threshold
+        self.tokenizer = tokenizer
+        self.return_similarities = return_similarities
+        self.ref_tokens = None
+        self.target_tokens = None
+        self.similarities = {}
+
+    def _fit(self, refset, targetset):
+        """ Tokenize the attributes of both datasets
+        """
+        self.ref_tokens = [tokenize(r[self.ref_attr_index], self.tokenizer)
+                           if r[self.ref_attr_index] else () for r in refset]
+        self.target_tokens = [tokenize(r[self.target_attr_index], self.tokenizer)
+                              if r[self.target_attr_index] else () for r in targetset]
+        self.similarities = {}
+
+    def _iter_blocks(self):
+        """ Iterator over the different possible blocks.
+
+        Returns
+        -------
+
+        (block1, block2): The blocks are always (reference_block, target_block)
+                          and containts the indexes of the record in the
+                          corresponding dataset.
+        """
+        for ind, targets, similarities in set_similarity_join(self.ref_tokens,
+                                                              self.target_tokens,
+                                                              self.threshold):
+            if self.return_similarities:
+                self.similarities[ind] = (targets, similarities)
+            yield [self.refids[ind],], [self.targetids[i] for i in targets]
+
+    def _cleanup(self):
+        """ Cleanup blocking for further use (e.g. in pipeline)
+        """
+        self.ref_tokens = None
+        self.target_tokens = None
+        self.similarities = {}
 
 
 ###############################################################################
@@ -603,6 +2646,18 @@ class MinHashingBlocking(BaseBlocking):
             if len(block1) and len(block2):
                 yield block1, block2
 
+    def _dump(self):
+        """ Export the signature matrix
+        """
+        return {'sigmatrix': self.minhasher.sigmatrix}, {'nb_elements': self.nb_elements}
+
+    def _load(self, arrays, metadata):
+        """ Import the signature matrix
+        """
+        self.minhasher.sigmatrix = arrays['sigmatrix']
+        self.minhasher._trained = True
+        self.nb_elements = metadata['nb_elements']
+
     def _cleanup(self):
         """ Cleanup blocking for further use (e.g. in pipeline)
         """
@@ -610,62 +2665,689 @@ class MinHashingBlocking(BaseBlocking):
         self.nb_elements = None
 
 
+###############################################################################
+### META-BLOCKING #############################################################
+###############################################################################
+class MetaBlocking(BaseBlocking):
+    """ Meta-blocking, restructuring the blocks of another blocking.
+
+    The blocks of the underlying blocking are turned into a (ref, target)
+    candidate pairs graph, where the weight of an edge is computed from the
+    blocks shared by the two records. The lowest weighted edges are then pruned,
+    and the blocks are rebuilt from the remaining edges (one block per
+    reference record).
+
+    The graph is kept as flat arrays (pair code, weight), so the redundant
+    comparisons of overlapping blocks are removed as well. It is built by
+    chunks of about `chunk_size` pair codes, each chunk being merged into the
+    sorted edges of the graph: the memory used is thus bounded by the number of
+    distinct edges plus the size of a chunk, and not by the total number of
+    pairs of the underlying blocks.
+
+    Additional information:
+
+       G. Papadakis et al., Meta-Blocking: Taking Entity Resolution
+       to the Next Level, IEEE TKDE 2014
+    """
+    weighting_schemes = ('cbs', 'ecbs', 'jaccard', 'arcs')
+    pruning_schemes = ('wep', 'cep', 'wnp', 'cnp')
+
+    def __init__(self, blocking, weighting='cbs', pruning='wep', cardinality=None,
+                 chunk_size=1000000):
+        """ Build the blocking object
+
+        Parameters
+        ----------
+
+        blocking: the underlying blocking object
+
+        weighting: weighting scheme of the edges:
+                   - 'cbs': number of common blocks
+                   - 'ecbs': number of common blocks, weighted by the inverse
+                     frequency of the blocks of each record
+                   - 'jaccard': jaccard similarity of the sets of blocks
+                   - 'arcs': sum of the inverse of the number of comparisons
+                     of the common blocks
+
+        pruning: pruning scheme of the edges:
+                 - 'wep': weighted edge pruning, keep the edges
+                   with a weight above the mean weight
+                 - 'cep': cardinality edge pruning, keep the `cardinality`
+                   top weighted edges
+                 - 'wnp': weighted node pruning, keep the edges with a weight
+                   above the mean weight of the edges of one of their nodes
+                 - 'cnp': cardinality node pruning, keep the `cardinality`
+                   top weighted edges of each node
+
+        cardinality: number of edges kept by the 'cep' and 'cnp' pruning. If not
+                     given, it is derived from the sizes of the blocks.
+
+        chunk_size: approximative number of pair codes gathered from the blocks
+                    before being merged into the graph
+        """
+        if weighting not in self.weighting_schemes:
+            raise ValueError('Unknown weighting scheme %s, should be in %s'
+                             % (weighting, self.weighting_schemes))
+        if pruning not in self.pruning_schemes:
+            raise ValueError('Unknown pruning scheme %s, should be in %s'
+                             % (pruning, self.pruning_schemes))
+        super(MetaBlocking, self).__init__(blocking.ref_attr_index,
+                                           blocking.target_attr_index)
+        self.blocking = blocking
+        self.weighting = weighting
+        self.pruning = pruning
+        self.cardinality = cardinality
+        self.chunk_size = chunk_size
+        self.ref_pairs = None
+        self.target_pairs = None
+        self.weights = None
+
+    def _fit(self, refset, targetset):
+        """ Build and prune the blocking graph
+        """
+        self.blocking.cleanup()
+        self.blocking.fit(refset, targetset)
+        nb_targets = len(targetset)
+        ref_blocks = np.zeros(len(refset), dtype=np.int64)
+        target_blocks = np.zeros(nb_targets, dtype=np.int64)
+        # Sorted edges of the graph: pair codes, counts of common blocks and
+        # arcs weights (only for the 'arcs' weighting)
+        edges = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                 np.zeros(0) if self.weighting == 'arcs' else None)
+        codes, contributions = [], []
+        nb_blocks, blocks_size, nb_codes = 0, 0, 0
+        for block1, block2 in self.blocking.iter_indice_blocks():
+            block1 = np.asarray(block1, dtype=np.int64)
+            block2 = np.asarray(block2, dtype=np.int64)
+            ref_blocks[block1] += 1
+            target_blocks[block2] += 1
+            nb_blocks += 1
+            blocks_size += len(block1) + len(block2)
+            if not len(block2):
+                continue
+            # Split the blocks bigger than a chunk on the references
+            step = max(self.chunk_size // len(block2), 1)
+            for start in xrange(0, len(block1), step):
+                codes.append((block1[start:start+step, None] * nb_targets + block2).ravel())
+                if self.weighting == 'arcs':
+                    contributions.append(np.repeat(1. / (len(block1) * len(block2)),
+                                                   codes[-1].size))
+                nb_codes += codes[-1].size
+                if nb_codes >= self.chunk_size:
+                    edges = self._merge_edges(edges, codes, contributions)
+                    codes, contributions, nb_codes = [], [], 0
+        if codes:
+            edges = self._merge_edges(edges, codes, contributions)
+        codes, counts, arcs = edges
+        if not len(codes):
+            self.ref_pairs = self.target_pairs = np.zeros(0, dtype=np.int64)
+            self.weights = np.zeros(0)
+            return
+        refs, targets = codes // nb_targets, codes % nb_targets
+        weights = self._weights(refs, targets, counts, arcs,
+                                ref_blocks, target_blocks, nb_blocks)
+        kept = self._prune(refs, targets, weights, blocks_size)
+        self.ref_pairs = refs[kept]
+        self.target_pairs = targets[kept]
+        self.weights = weights[kept]
+        self.logger.info('Meta-blocking : %s edges kept out of %s'
+                         % (len(self.weights), len(weights)))
+
+    def _merge_edges(self, edges, codes, contributions):
+        """ Merge a chunk of pair codes (and their arcs contributions)
+        into the sorted edges (codes, counts, arcs)
+        """
+        chunk_codes, inverse, chunk_counts = np.unique(np.concatenate(codes),
+                                                       return_inverse=True,
+                                                       return_counts=True)
+        # Both arrays of codes are sorted and unique, so the merge sort is
+        # linear and the codes common to both are consecutive
+        all_codes = np.concatenate((edges[0], chunk_codes))
+        order = np.argsort(all_codes, kind='mergesort')
+        all_codes = all_codes[order]
+        starts = np.flatnonzero(np.r_[True, all_codes[1:] != all_codes[:-1]])
+        counts = np.add.reduceat(np.concatenate((edges[1], chunk_counts))[order], starts)
+        arcs = edges[2]
+        if arcs is not None:
+            chunk_arcs = np.bincount(inverse, weights=np.concatenate(contributions))
+            arcs = np.add.reduceat(np.concatenate((arcs, chunk_arcs))[order], starts)
+        return all_codes[starts], counts, arcs
+
+    def _weights(self, refs, targets, counts, arcs,
+                 ref_blocks, target_blocks, nb_blocks):
+        """ Compute the weights of the edges
+        """
+        if self.weighting == 'cbs':
+            return counts.astype(np.float64)
+        elif self.weighting == 'ecbs':
+            return (counts * np.log(float(nb_blocks) / ref_blocks[refs])
+                    * np.log(float(nb_blocks) / target_blocks[targets]))
+        elif self.weighting == 'jaccard':
+            return counts / (ref_blocks[refs] + target_blocks[targets]
+                             - counts).astype(np.float64)
+        # arcs
+        return arcs
+
+    def _node_ranks(self, nodes, weights):
+        """ Return the rank of each edge among the edges of its node,
+        by decreasing weight
+        """
+        order = np.lexsort((-weights, nodes))
+        sorted_nodes = nodes[order]
+        starts = np.flatnonzero(np.r_[True, sorted_nodes[1:] != sorted_nodes[:-1]])
+        group_sizes = np.diff(np.r_[starts, len(nodes)])
+        ranks = np.empty(len(nodes), dtype=np.int64)
+        ranks[order] = np.arange(len(nodes)) - np.repeat(starts, group_sizes)
+        return ranks
+
+    def _prune(self, refs, targets, weights, blocks_size):
+        """ Return the mask of the kept edges
+        """
+        if self.pruning == 'wep':
+            return weights >= weights.mean()
+        elif self.pruning == 'cep':
+            cardinality = self.cardinality or max(blocks_size // 2, 1)
+            if cardinality >= len(weights):
+                return np.ones(len(weights), dtype=bool)
+            kept = np.zeros(len(weights), dtype=bool)
+            kept[np.argsort(-weights, kind='mergesort')[:cardinality]] = True
+            return kept
+        elif self.pruning == 'wnp':
+            kept = np.zeros(len(weights), dtype=bool)
+            for nodes in (refs, targets):
+                means = np.bincount(nodes, weights=weights) / np.maximum(np.bincount(nodes), 1)
+                kept |= weights >= means[nodes]
+            return kept
+        # cnp
+        nb_nodes = len(np.unique(refs)) + len(np.unique(targets))
+        cardinality = self.cardinality or max(blocks_size // nb_nodes, 1)
+        return ((self._node_ranks(refs, weights) < cardinality)
+                | (self._node_ranks(targets, weights) < cardinality))
+
+    def _iter_blocks(self):
+        """ Iterator over the different possible blocks.
+
+        Returns
+        -------
+
+        (block1, block2): The blocks are always (reference_block, target_block)
+                          and containts the indexes of the record in the
+                          corresponding dataset.
+        """
+        # Edges are sorted by reference record
+        starts = np.flatnonzero(np.r_[True, self.ref_pairs[1:] != self.ref_pairs[:-1]])
+        stops = np.r_[starts[1:], len(self.ref_pairs)]
+        for start, stop in zip(starts, stops):
+            if start == stop:
+                continue
+            yield ([self.refids[self.ref_pairs[start]]],
+                   [self.targetids[i] for i in self.target_pairs[start:stop]])
+
+    def _cleanup(self):
+        """ Cleanup blocking for further use (e.g. in pipeline)
+        """
+        self.blocking.cleanup()
+        self.ref_pairs = None
+        self.target_pairs = None
+        self.weights = None
+
+
 ###############################################################################
 ### BLOCKING PIPELINE #########################################################
 ###############################################################################
 class PipelineBlocking(BaseBlocking):
     """ Pipeline multiple blocking techniques
+
+    Each blocking is applied on the blocks of the previous one. The blocks are
+    computed lazily, while iterating over them.
+
+    The key-based blockings (i.e. the blockings having a `compute_keys` method,
+    like KeyBlocking or NGramBlocking) compute their keys once on the whole
+    datasets, and the blocks of the previous blocking are refined by grouping
+    their records on these keys. The other blockings are fitted again on each
+    block of the previous one.
     """
 
-    def __init__(self, blockings, collect_stats=False):
+    def __init__(self, blockings, collect_stats=False, n_jobs=1, chunksize=1):
         """ Build the blocking object
 
         Parameters
         ----------
 
         blockings: ordered list of blocking objects
+
+        collect_stats: if True, the sizes of the blocks of each blocking
+                       are stored in the stats attribute while iterating
+                       (the stats being reset at each iteration)
+
+        n_jobs: number of processes used to compute the blocks of the second
+                and later blockings (-1 to use all the CPUs). The first-level
+                blocks are dispatched to a process pool, and the final blocks
+                are returned in the same order as with a single process.
+
+        chunksize: number of first-level blocks sent to a process at once
         """
+        super(PipelineBlocking, self).__init__(None, None)
         self.blockings = blockings
-        self.stored_blocks = []
         self.collect_stats = collect_stats
+        self.n_jobs = n_jobs
+        self.chunksize = chunksize
         self.stats = {}
+        self.refset = None
+        self.targetset = None
+        self.ref_codes = {}
+        self.target_codes = {}
+
+    def _is_key_based(self, blocking):
+        """ Return True if the blocks of the blocking may be computed
+        by grouping precomputed keys
+        """
+        return (hasattr(blocking, 'compute_keys')
+                and getattr(blocking, 'split_callback', None) is None)
+
+    def _encode_keys(self, blocking, keys, key_ids, extend):
+        """ Encode keys as an array of integer codes (-1 for ignored keys)
+        """
+        ignore_none = getattr(blocking, 'ignore_none', False)
+        codes = np.empty(len(keys), dtype=np.int64)
+        for ind, key in enumerate(keys):
+            if not key and ignore_none:
+                codes[ind] = -1
+            elif extend:
+                codes[ind] = key_ids.setdefault(key, len(key_ids))
+            else:
+                codes[ind] = key_ids.get(key, -1)
+        return codes
 
     def _fit(self, refset, targetset):
         """ Internal fit of the pipeline """
-        self._recursive_fit(refset, targetset, range(len(refset)), range(len(targetset)), 0)
-
-    def _recursive_fit(self, refset, targetset, ref_index, target_index, ind):
-        """ Recursive fit of the blockings.
-        Blocks are stored in the stored_blocks attribute.
-        """
-        if ind < len(self.blockings) - 1:
-            # There are other blockings after this one
-            blocking = self.blockings[ind]
-            blocking.cleanup()
-            blocking.fit([refset[i] for i in ref_index],
-                         [targetset[i] for i in target_index])
-            for block1, block2 in blocking.iter_indice_blocks():
-                ind_block1 = [ref_index[i] for i in block1]
-                ind_block2 = [target_index[i] for i in block2]
-                if self.collect_stats:
-                    self.stats.setdefault(ind, []).append((len(block1), len(block2)))
-                self._recursive_fit(refset, targetset, ind_block1, ind_block2, ind+1)
+        self.refset = refset
+        self.targetset = targetset
+        self.stats = {}
+        self.ref_codes = {}
+        self.target_codes = {}
+        for ind, blocking in enumerate(self.blockings):
+            if not self._is_key_based(blocking):
+                continue
+            key_ids = {}
+            self.ref_codes[ind] = self._encode_keys(
+                blocking, blocking.compute_keys(refset, blocking.ref_attr_index),
+                key_ids, True)
+            self.target_codes[ind] = self._encode_keys(
+                blocking, blocking.compute_keys(targetset, blocking.target_attr_index),
+                key_ids, False)
+
+    def _group_blocks(self, ind, ref_index, target_index):
+        """ Refine a block by grouping its records on the precomputed keys
+        of the blocking `ind`
+        """
+        max_comparisons = getattr(self.blockings[ind], 'max_comparisons', None)
+        groups = []
+        for index, codes in ((ref_index, self.ref_codes[ind]),
+                             (target_index, self.target_codes[ind])):
+            codes = codes[index]
+            order = np.argsort(codes, kind='mergesort')
+            keys, starts = np.unique(codes[order], return_index=True)
+            groups.append((index[order], keys, starts,
+                           np.r_[starts[1:], len(codes)]))
+        (sorted1, keys1, starts1, stops1), (sorted2, keys2, starts2, stops2) = groups
+        positions = np.searchsorted(keys2, keys1)
+        for ind1, ind2 in enumerate(positions):
+            if ind2 >= len(keys2) or keys2[ind2] != keys1[ind1] or keys1[ind1] < 0:
+                continue
+            block1 = sorted1[starts1[ind1]:stops1[ind1]]
+            block2 = sorted2[starts2[ind2]:stops2[ind2]]
+            if max_comparisons is not None and len(block1) * len(block2) > max_comparisons:
+                continue
+            yield block1, block2
+
+    def _fit_blocks(self, ind, ref_index, target_index):
+        """ Compute the blocks of a block by fitting the blocking `ind` on it
+        """
+        blocking = self.blockings[ind]
+        blocking.cleanup()
+        blocking.fit([self.refset[i] for i in ref_index],
+                     [self.targetset[i] for i in target_index])
+        for block1, block2 in blocking.iter_indice_blocks():
+            yield (ref_index[np.asarray(block1, dtype=np.int64)],
+                   target_index[np.asarray(block2, dtype=np.int64)])
+
+    def _stage_blocks(self, ind, ref_index, target_index):
+        """ Iterator over the non-empty blocks of the blocking `ind`
+        computed on the given block
+        """
+        if ind in self.ref_codes:
+            blocks = self._group_blocks(ind, ref_index, target_index)
         else:
-            # This is the final blocking
-            blocking = self.blockings[ind]
-            blocking.cleanup()
-            blocking.fit([refset[i] for i in ref_index],
-                         [targetset[i] for i in target_index])
-            for block1, block2 in blocking.iter_blocks():
-                ind_block1 = [(ref_index[i], _id) for i, _id in block1]
-                ind_block2 = [(target_index[i], _id) for i, _id in block2]
-                if self.collect_stats:
-                    self.stats.setdefault(ind, []).append((len(block1), len(block2)))
-                self.stored_blocks.append((ind_block1, ind_block2))
+            blocks = self._fit_blocks(ind, ref_index, target_index)
+        for block1, block2 in blocks:
+            if not len(block1) or not len(block2):
+                continue
+            if self.collect_stats:
+                self.stats.setdefault(ind, []).append((len(block1), len(block2)))
+            yield block1, block2
+
+    def _iter_stage(self, ref_index, target_index, ind):
+        """ Recursive iteration over the blocks of the blockings,
+        from the blocking `ind`
+        """
+        for block1, block2 in self._stage_blocks(ind, ref_index, target_index):
+            if ind < len(self.blockings) - 1:
+                # There are other blockings after this one
+                for subblock1, subblock2 in self._iter_stage(block1, block2, ind+1):
+                    yield subblock1, subblock2
+            else:
+                yield block1, block2
+
+    def _iter_parallel_blocks(self, ref_index, target_index):
+        """ Iteration over the blocks, the blocks of the first blocking
+        being dispatched to a pool of processes
+        """
+        first_blocks = self._stage_blocks(0, ref_index, target_index)
+        tasks = iter(lambda: list(islice(first_blocks, self.chunksize)), [])
+        n_jobs = self.n_jobs if self.n_jobs > 0 else multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(n_jobs, _init_pipeline_worker, (self,))
+        try:
+            for blocks, stats in pool.imap(_pipeline_worker, tasks):
+                for ind, sizes in stats.iteritems():
+                    self.stats.setdefault(ind, []).extend(sizes)
+                for block1, block2 in blocks:
+                    yield block1, block2
+        finally:
+            pool.terminate()
+
+    def _iter_array_blocks(self):
+        """ Iteration over the blocks of indexes arrays
+        """
+        ref_index = np.arange(len(self.refset))
+        target_index = np.arange(len(self.targetset))
+        self.stats = {}
+        if self.n_jobs != 1 and len(self.blockings) > 1:
+            return self._iter_parallel_blocks(ref_index, target_index)
+        return self._iter_stage(ref_index, target_index, 0)
 
     def _iter_blocks(self):
         """ Internal iteration function over blocks
         """
-        for block1, block2 in self.stored_blocks:
-            if block1 and block2:
-                yield block1, block2
+        for block1, block2 in self._iter_array_blocks():
+            yield ([self.refids[i] for i in block1],
+                   [self.targetids[i] for i in block2])
+
+    def _block_sizes(self):
+        """ Blocks sizes, computed without building the blocks of ids
+        """
+        sizes = np.array([(len(block1), len(block2))
+                          for block1, block2 in self._iter_array_blocks()],
+                         dtype=np.int64).reshape(-1, 2)
+        return None, sizes[:, 0], sizes[:, 1]
+
+    def _cleanup(self):
+        """ Cleanup blocking for further use (e.g. in pipeline)
+        """
+        self.refset = None
+        self.targetset = None
+        self.ref_codes = {}
+        self.target_codes = {}
+
+
+# The pipeline is given to the processes of the pool when they are created
+# (and is thus not pickled), and the tasks are only arrays of indexes.
+_WORKER_PIPELINE = None
+
+def _init_pipeline_worker(pipeline):
+    """ Initialize a process of the PipelineBlocking pool
+    """
+    global _WORKER_PIPELINE
+    _WORKER_PIPELINE = pipeline
+    pipeline.stats = {}
+
+def _pipeline_worker(blocks):
+    """ Compute the final blocks of a chunk of first-level blocks
+    """
+    results = []
+    for block1, block2 in blocks:
+        results.extend(_WORKER_PIPELINE._iter_stage(block1, block2, 1))
+    stats, _WORKER_PIPELINE.stats = _WORKER_PIPELINE.stats, {}
+    return results, stats
+
+
+###############################################################################
+### BLOCKING REPORT ###########################################################
+###############################################################################
+def pairs_completeness(blocking, true_pairs):
+    """ Return the ratio of the true pairs (id_reference, id_target)
+    that are in a same block of a fitted blocking
+    """
+    true_pairs = list(true_pairs)
+    if not true_pairs:
+        return 1.
+    ref_blocks = dict((pair[0], set()) for pair in true_pairs)
+    target_blocks = dict((pair[1], set()) for pair in true_pairs)
+    for nb, (block1, block2) in enumerate(blocking.iter_id_blocks()):
+        for ids, blocks in ((block1, ref_blocks), (block2, target_blocks)):
+            for _id in ids:
+                if _id in blocks:
+                    blocks[_id].add(nb)
+    found = sum(1 for ref, target in true_pairs
+                if ref_blocks[ref] & target_blocks[target])
+    return found / float(len(true_pairs))
+
+def blocking_report(blocking, true_pairs=None, percentiles=(50, 90, 99, 100),
+                    nb_largest=10, pair_cost=None):
+    """ Compute the quality and efficiency statistics of a fitted blocking,
+    from the sizes of its blocks (i.e. without iterating over the pairs).
+    The number of candidate pairs is given by `blocking.count_pairs()`
+    (e.g. the deduplicated pairs of the multi-key blockings).
+
+    Parameters
+    ----------
+
+    blocking: a fitted blocking object
+
+    true_pairs: an optional sample of true pairs (id_reference, id_target),
+                used to compute the pairs completeness
+
+    percentiles: percentiles of the distribution of the blocks sizes
+                 (number of records of the blocks)
+
+    nb_largest: number of the largest blocks (in comparisons) to report
+
+    pair_cost: estimated time (in seconds) of a pair evaluation, used to
+               estimate the time of the alignment
+
+    Returns
+    -------
+
+    A dictionnary of statistics:
+
+    nb_blocks: number of blocks
+
+    candidate_pairs: number of pairs in the blocks, i.e. of pair evaluations
+                     (see `blocking.count_pairs()`)
+
+    reduction_ratio: 1 - candidate_pairs / (len(refset) * len(targetset))
+
+    size_percentiles: list of (percentile, block size)
+
+    largest_blocks: list of (key, len(block1), len(block2)), the key being
+                    the number of the block for blockings without keys
+
+    pairs_completeness: if true_pairs is given, the ratio of the true pairs
+                        that are in a same block
+
+    estimated_time: if pair_cost is given, the estimated time of the pair
+                    evaluations
+    """
+    keys, sizes1, sizes2 = blocking.block_sizes()
+    comparisons = sizes1 * sizes2
+    # Count the pairs from the sizes, without computing the blocks again
+    candidate_pairs = blocking._count_pairs(sizes1, sizes2)
+    total_pairs = len(blocking.refids) * len(blocking.targetids)
+    report = {'nb_blocks': len(comparisons),
+              'candidate_pairs': candidate_pairs,
+              'reduction_ratio': (1 - candidate_pairs / float(total_pairs)
+                                  if total_pairs else 0.)}
+    if len(comparisons):
+        values = np.percentile(sizes1 + sizes2, list(percentiles))
+        report['size_percentiles'] = zip(percentiles, values)
+    else:
+        report['size_percentiles'] = [(percentile, 0) for percentile in percentiles]
+    largest = np.argsort(-comparisons, kind='mergesort')[:nb_largest]
+    report['largest_blocks'] = [(keys[i] if keys is not None else i,
+                                 int(sizes1[i]), int(sizes2[i])) for i in largest]
+    if true_pairs is not None:
+        report['pairs_completeness'] = pairs_completeness(blocking, true_pairs)
+    if pair_cost is not None:
+        report['estimated_time'] = candidate_pairs * pair_cost
+    blocking.logger.info('Blocks : %(nb_blocks)s, candidate pairs : %(candidate_pairs)s, '
+                         'reduction ratio : %(reduction_ratio).4f' % report)
+    return report
+
+
+###############################################################################
+### BLOCKING KEY SELECTION ####################################################
+###############################################################################
+def prefix_key(value, length):
+    """ Blocking key: the `length` first characters of a string value
+    """
+    if not isinstance(value, basestring) or not value.strip():
+        return None
+    return value.strip().lower()[:length]
+
+def phonetic_key(value, encoding='soundex', language='french'):
+    """ Blocking key: the phonetic code of a string value
+    (see distances.PHONETIC_CODES)
+    """
+    if not isinstance(value, basestring) or not value.strip():
+        return None
+    if encoding == 'soundex':
+        return soundexcode(value, language)
+    return PHONETIC_CODES[encoding](value)
+
+def rounding_key(value, precision=0):
+    """ Blocking key: the rounded value of a numerical value
+    (e.g. precision=-2 to round to hundreds). Note that the values rounded
+    to 0 are not blocked by a KeyBlocking with ignore_none=True.
+    """
+    try:
+        return round(float(value), precision)
+    except (TypeError, ValueError):
+        return None
+
+# Default candidate key functions of select_key_blocking
+KEY_FUNCTIONS = [('prefix%s' % length, partial(prefix_key, length=length))
+                 for length in (1, 2, 3, 4)]
+KEY_FUNCTIONS.extend([('soundex', partial(phonetic_key, language='french')),
+                      ('soundex_english', partial(phonetic_key, language='english')),
+                      ('metaphone', partial(phonetic_key, encoding='metaphone')),
+                      ('nysiis', partial(phonetic_key, encoding='nysiis'))])
+KEY_FUNCTIONS.extend(('rounding%s' % precision, partial(rounding_key, precision=precision))
+                     for precision in (1, 0, -1, -2))
+
+
+def _key_scores(ref_keys, target_keys, true_pairs, nb_pairs):
+    """ Return the (pairs completeness, reduction ratio) of blocking keys,
+    computed from the keys histograms. As in KeyBlocking(ignore_none=True),
+    the false keys (None, '', 0...) are ignored.
+    """
+    ref_counts, target_counts = {}, {}
+    for keys, counts in ((ref_keys, ref_counts), (target_keys, target_counts)):
+        for key in keys:
+            if key:
+                counts[key] = counts.get(key, 0) + 1
+    comparisons = sum(count * target_counts.get(key, 0)
+                      for key, count in ref_counts.iteritems())
+    found = sum(1 for ref, target in true_pairs
+                if ref_keys[ref] and ref_keys[ref] == target_keys[target])
+    return (found / float(len(true_pairs)) if true_pairs else 1.,
+            1 - comparisons / float(nb_pairs) if nb_pairs else 0.)
+
+def select_key_blocking(refset, targetset, true_pairs, attributes=None,
+                        key_functions=None, min_completeness=0.95, nb_combined=5):
+    """ Select the blocking key with the best trade-off between the pairs
+    completeness and the reduction ratio, on a sample of true pairs.
+
+    Each candidate key (an attributes pair and a key function) is evaluated
+    from the histograms of its keys on both datasets. The best keys are also
+    combined two by two (i.e. a pipeline of two KeyBlockings).
+
+    Parameters
+    ----------
+
+    refset: the reference dataset (list of records)
+
+    targetset: the target dataset (list of records)
+
+    true_pairs: sample of true pairs (id_reference, id_target)
+
+    attributes: list of the (ref_attr_index, target_attr_index) to evaluate,
+                default is all the common attributes (but the ids)
+
+    key_functions: list of the (name, function) to evaluate,
+                   default is KEY_FUNCTIONS. The functions should return
+                   None for the values that cannot be blocked. As in the
+                   returned KeyBlockings (with ignore_none=True), all the
+                   false keys (e.g. '' or 0.) are ignored.
+
+    min_completeness: minimal pairs completeness of the selected key. The key
+                      with the best reduction ratio above it is selected
+                      (or the one with the best completeness if there is none).
+
+    nb_combined: number of the best keys that are combined two by two
+
+    Returns
+    -------
+
+    (blocking, scores): the configured (not fitted) KeyBlocking or
+                        PipelineBlocking, and the sorted list (best first) of
+                        the (names, pairs completeness, reduction ratio) of
+                        the candidates, names being the list of
+                        (ref_attr_index, target_attr_index, function name)
+    """
+    if attributes is None:
+        nb_attributes = min(len(refset[0]), len(targetset[0]))
+        attributes = [(ind, ind) for ind in xrange(1, nb_attributes)]
+    key_functions = key_functions or KEY_FUNCTIONS
+    ref_ids = dict((r[0], ind) for ind, r in enumerate(refset))
+    target_ids = dict((r[0], ind) for ind, r in enumerate(targetset))
+    true_pairs = [(ref_ids[ref], target_ids[target]) for ref, target in true_pairs]
+    nb_pairs = len(refset) * len(targetset)
+    # Keys of the candidates
+    candidates = []
+    for ref_attr_index, target_attr_index in attributes:
+        for name, function in key_functions:
+            candidates.append((((ref_attr_index, target_attr_index, name),),
+                               (function,),
+                               [function(r[ref_attr_index]) for r in refset],
+                               [function(r[target_attr_index]) for r in targetset]))
+
+    def sort_key(score):
+        completeness, reduction, _ = score
+        if completeness >= min_completeness:
+            return (1, reduction, completeness)
+        return (0, completeness, reduction)
+
+    scores = [_key_scores(ref_keys, target_keys, true_pairs, nb_pairs) + (ind,)
+              for ind, (_, _, ref_keys, target_keys) in enumerate(candidates)]
+    scores.sort(key=sort_key, reverse=True)
+    # Combinations of the best candidates
+    best = [candidates[ind] for _, _, ind in scores[:nb_combined]]
+    for ind, (names1, functions1, ref_keys1, target_keys1) in enumerate(best):
+        for names2, functions2, ref_keys2, target_keys2 in best[ind+1:]:
+            ref_keys = [(k1, k2) if k1 and k2 else None
+                        for k1, k2 in zip(ref_keys1, ref_keys2)]
+            target_keys = [(k1, k2) if k1 and k2 else None
+                           for k1, k2 in zip(target_keys1, target_keys2)]
+            candidates.append((names1 + names2, functions1 + functions2,
+                               ref_keys, target_keys))
+            scores.append(_key_scores(ref_keys, target_keys, true_pairs, nb_pairs)
+                          + (len(candidates) - 1,))
+    # The sort being stable, single keys are preferred to equivalent combinations
+    scores.sort(key=sort_key, reverse=True)
+    names, functions, _, _ = candidates[scores[0][2]]
+    blockings = [KeyBlocking(ref_attr_index, target_attr_index, function, ignore_none=True)
+                 for (ref_attr_index, target_attr_index, _), function
+                 in zip(names, functions)]
+    blocking = blockings[0] if len(blockings) == 1 else PipelineBlocking(blockings)
+    return blocking, [(list(candidates[ind][0]), completeness, reduction)
+                      for completeness, reduction, ind in scores]
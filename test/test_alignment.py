@@ -25,10 +25,13 @@ import random
 random.seed(6) ### Make sure tests are repeatable
 from os import path
 
+import numpy as np
+
 from nazca.utils.normalize import simplify
 import nazca.rl.aligner as alig
 import nazca.rl.blocking as blo
-from nazca.utils.distances import LevenshteinProcessing, GeographicalProcessing
+from nazca.utils.distances import (LevenshteinProcessing, GeographicalProcessing,
+                                   SoundexProcessing)
 
 
 TESTDIR = path.dirname(__file__)
@@ -55,6 +58,46 @@ class AlignerTestCase(unittest.TestCase):
             for v, distance in values:
                 self.assertIn((k,v), true_matched)
 
+    def test_align_restores_processings(self):
+        refset = [['R1', 'victor hugo'], ['R2', 'albert camus']]
+        targetset = [['T1', 'victor hugo'], ['T2', 'jean giono']]
+        processing = LevenshteinProcessing(1, 1)
+        aligner = alig.BaseAligner(threshold=1, processings=(processing,))
+        mat, matched = aligner.align(refset, targetset)
+        self.assertEqual(dict(matched), {0: [(0, 0.)]})
+        # The distances are bounded during the alignment only
+        self.assertEqual(processing.max_dist, None)
+        self.assertEqual(processing.cdist(refset, targetset)[1, 1], 5)
+
+    def test_align_resets_processings(self):
+        refset = [['R1', u'Robert'], ['R2', u'Rubin']]
+        targetset = [['T1', u'Rupert'], ['T2', u'Pugo']]
+        processing = SoundexProcessing(1, 1, language='english')
+        aligner = alig.BaseAligner(threshold=0.5, processings=(processing,))
+        mat, matched = aligner.align(refset, targetset)
+        self.assertEqual(dict(matched), {0: [(0, 0.)]})
+        self.assertEqual(processing.dataset_codes, {})
+        # A dataset changed in place is not aligned with stale codes
+        targetset[1][1] = u'Ruben'
+        mat, matched = aligner.align(refset, targetset)
+        self.assertEqual(dict(matched), {0: [(0, 0.)], 1: [(1, 0.)]})
+
+    def test_align_custom_processing(self):
+        class ExactProcessing(object):
+            # A processing providing only cdist and weight
+            weight = 1
+            def cdist(self, refset, targetset, ref_indexes=None, target_indexes=None):
+                ref_indexes = ref_indexes or range(len(refset))
+                target_indexes = target_indexes or range(len(targetset))
+                return np.array([[0 if refset[i][1] == targetset[j][1] else 1
+                                  for j in target_indexes] for i in ref_indexes],
+                                dtype='float32')
+        refset = [['R1', 'hugo'], ['R2', 'camus']]
+        targetset = [['T1', 'camus'], ['T2', 'giono']]
+        aligner = alig.BaseAligner(threshold=0.5, processings=(ExactProcessing(),))
+        mat, matched = aligner.align(refset, targetset)
+        self.assertEqual(dict(matched), {1: [(0, 0.)]})
+
     def test_blocking_align(self):
         refset = [['V1', 'label1', (6.14194444444, 48.67)],
                   ['V2', 'label2', (6.2, 49)],
@@ -105,6 +148,38 @@ class AlignerTestCase(unittest.TestCase):
                 predict_matched.add((k, v))
         self.assertEqual(true_matched, predict_matched)
 
+    def test_blocking_align_precomputed(self):
+        refset = [['V1', 'label1', (48.67, 6.14194444444)],
+                  ['V2', 'label2', (49, 6.2)],
+                  ['V3', 'label3', (48, 5.1)],
+                  ['V4', 'label4', (48.1, 5.2)],
+                  ]
+        targetset = [['T1', 'labelt1', (48.7, 6.17)],
+                     ['T2', 'labelt2', (48.2, 5.3)],
+                     ['T3', 'labelt3', (48.91, 6.25)],
+                     ]
+        matches = []
+        for return_distances in (False, True):
+            blocking = blo.KdTreeBlocking(ref_attr_index=2, target_attr_index=2,
+                                          threshold=0.3, units='km',
+                                          return_distances=return_distances)
+            precomputed = blocking if return_distances else None
+            processings = (GeographicalProcessing(2, 2, units='km',
+                                                  precomputed=precomputed),)
+            aligner = alig.BaseAligner(threshold=30, processings=processings)
+            aligner.register_blocking(blocking)
+            global_mat, global_matched = aligner.align(refset, targetset)
+            matches.append(dict((k, sorted((v, round(d, 3)) for v, d in values))
+                                for k, values in global_matched.iteritems()))
+        self.assertTrue(matches[0])
+        self.assertEqual(matches[0], matches[1])
+
+    def test_precomputed_units_mismatch(self):
+        blocking = blo.KdTreeBlocking(ref_attr_index=2, target_attr_index=2,
+                                      return_distances=True, units='km')
+        self.assertRaises(ValueError, GeographicalProcessing, 2, 2, units='m',
+                          precomputed=blocking)
+
     def test_unique_align(self):
         refset = [['V1', 'label1', (6.14194444444, 48.67)],
                     ['V2', 'label2', (6.2, 49)],
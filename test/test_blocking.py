@@ -17,22 +17,36 @@
 # with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import sys
+import shutil
 if sys.version_info >= (2, 7):
     import unittest
 else:
     import unittest2 as unittest
 from os import path
+from tempfile import mkdtemp
 from functools import partial
+from fractions import Fraction
 import random
 random.seed(6) ### Make sure tests are repeatable / Minhashing
 
+import numpy as np
+
 from nazca.utils.distances import (levenshtein, soundex, soundexcode,   \
-                                       jaccard, euclidean, geographical)
+                                       jaccard, euclidean, geographical,
+                                       unpack_soundexcode)
 from nazca.rl.blocking import (KeyBlocking, SortedNeighborhoodBlocking,
                                MergeBlocking,
                                NGramBlocking, PipelineBlocking,
                                SoundexBlocking, KmeansBlocking,
-                               MinHashingBlocking, KdTreeBlocking)
+                               MinHashingBlocking, KdTreeBlocking,
+                               MultiKeyBlocking, TokenBlocking, MetaBlocking,
+                               GeoGridBlocking, CanopyBlocking, QGramBlocking,
+                               SuffixArrayBlocking, ExternalSortedNeighborhoodBlocking,
+                               TfidfBlocking, PPJoinBlocking, set_similarity_join,
+                               suffix_ranks,
+                               PhoneticBlocking, select_key_blocking, prefix_key,
+                               blocking_report,
+                               pairs_completeness)
 from nazca.utils.normalize import SimplifyNormalizer
 from nazca.data import FRENCH_LEMMAS
 
@@ -170,6 +184,201 @@ class KeyBlockingTest(unittest.TestCase):
         for pair in SOUNDEX_PAIRS:
             self.assertIn(pair, pairs)
 
+    def test_soundex_packed_keys(self):
+        blocking = SoundexBlocking(ref_attr_index=1, target_attr_index=1,
+                                   language='english')
+        blocking.fit(SOUNDEX_REFSET, SOUNDEX_TARGETSET)
+        keys = blocking.compute_keys(SOUNDEX_REFSET, 1)
+        self.assertEqual([unpack_soundexcode(key) for key in keys],
+                         [soundexcode(rec[1], 'english') for rec in SOUNDEX_REFSET])
+        self.assertEqual(sorted(blocking.reference_index),
+                         sorted(set(keys)))
+
+    def test_keyblocking_purge(self):
+        blocking = SoundexBlocking(ref_attr_index=1, target_attr_index=1,
+                                   language='english', max_comparisons=3)
+        blocking.fit(SOUNDEX_REFSET, SOUNDEX_TARGETSET)
+        blocks = list(blocking.iter_id_blocks())
+        self.assertEqual(len(blocks), 2)
+        self.assertIn((['a2', 'a5'], ['b4']), blocks)
+        self.assertIn((['a3'], ['b1', 'b2']), blocks)
+        self.assertEqual(blocking.purge_stats['purged_blocks'], 1)
+        self.assertEqual(blocking.purge_stats['purged_comparisons'], 4)
+
+    def test_keyblocking_purge_split(self):
+        blocking = SoundexBlocking(ref_attr_index=1, target_attr_index=1,
+                                   language='english', max_comparisons=3,
+                                   split_callback=lambda x: x[:2])
+        blocking.fit(SOUNDEX_REFSET, SOUNDEX_TARGETSET)
+        blocks = list(blocking.iter_id_blocks())
+        self.assertEqual(len(blocks), 4)
+        self.assertIn((['a1'], ['b3']), blocks)
+        self.assertIn((['a7'], ['b6']), blocks)
+        self.assertEqual(blocking.purge_stats['split_blocks'], 1)
+        self.assertEqual(blocking.purge_stats['purged_blocks'], 0)
+
+
+class MultiKeyBlockingTest(unittest.TestCase):
+    refset = (('a1', 'victor marie hugo'),
+              ('a2', 'victor hugo'),
+              ('a3', 'jean de la fontaine'),
+              ('a4', 'emile zola'))
+    targetset = (('b1', 'hugo victor'),
+                 ('b2', 'fontaine'),
+                 ('b3', 'marie curie'),
+                 ('b4', None))
+
+    def test_token_blocks(self):
+        blocking = TokenBlocking(ref_attr_index=1, target_attr_index=1,
+                                 deduplicate=False)
+        blocking.fit(self.refset, self.targetset)
+        blocks = list(blocking.iter_id_blocks())
+        self.assertEqual(len(blocks), 4)
+        self.assertIn((['a1', 'a2'], ['b1']), blocks)
+        self.assertIn((['a1'], ['b3']), blocks)
+        self.assertIn((['a3'], ['b2']), blocks)
+        pairs = list(blocking.iter_id_pairs())
+        self.assertEqual(len(pairs), 6)
+        self.assertEqual(blocking.count_pairs(), 6)
+
+    def test_token_deduplicated_pairs(self):
+        blocking = TokenBlocking(ref_attr_index=1, target_attr_index=1)
+        blocking.fit(self.refset, self.targetset)
+        pairs = list(blocking.iter_id_pairs())
+        self.assertEqual(sorted(pairs), [('a1', 'b1'), ('a1', 'b3'),
+                                         ('a2', 'b1'), ('a3', 'b2')])
+        self.assertEqual(blocking.count_pairs(), 4)
+        self.assertEqual(blocking.count_pairs(chunk_size=1), 4)
+        self.assertEqual(len(blocking.pair_arrays()[0]), 4)
+
+    def test_token_purge(self):
+        blocking = TokenBlocking(ref_attr_index=1, target_attr_index=1,
+                                 max_comparisons=1)
+        blocking.fit(self.refset, self.targetset)
+        pairs = list(blocking.iter_id_pairs())
+        self.assertEqual(sorted(pairs), [('a1', 'b3'), ('a3', 'b2')])
+        self.assertEqual(blocking.purge_stats['purged_blocks'], 2)
+
+    def test_multikey_callback(self):
+        blocking = MultiKeyBlocking(ref_attr_index=1, target_attr_index=1,
+                                    callback=lambda x: [w[:2] for w in x.split()])
+        blocking.fit(SOUNDEX_REFSET, SOUNDEX_TARGETSET)
+        blocks = list(blocking.iter_id_blocks())
+        self.assertEqual(len(blocks), 5)
+        self.assertIn((['a1', 'a4'], ['b3']), blocks)
+        self.assertIn((['a7'], ['b6']), blocks)
+
+
+class PhoneticBlockingTest(unittest.TestCase):
+    refset = (('a1', 'Jean Gauthier'), ('a2', 'Marie Beaumont'),
+              ('a3', ''), ('a4', None))
+    targetset = (('b1', 'Gautier'), ('b2', 'Baumont Marie'), ('b3', 'Jeanne Dupont'))
+
+    def test_phonex_blocks(self):
+        blocking = PhoneticBlocking(ref_attr_index=1, target_attr_index=1,
+                                    encoding='phonex')
+        blocking.fit(self.refset, self.targetset)
+        blocks = list(blocking.iter_id_blocks())
+        self.assertEqual(sorted(blocks), [(['a1'], ['b1']), (['a2'], ['b2'])])
+
+    def test_encodings(self):
+        for encoding in ('soundex', 'metaphone', 'nysiis'):
+            blocking = PhoneticBlocking(ref_attr_index=1, target_attr_index=1,
+                                        encoding=encoding)
+            blocking.fit(self.refset, self.targetset)
+            pairs = set(blocking.iter_id_pairs())
+            self.assertIn(('a2', 'b2'), pairs)
+            self.assertEqual(blocking.token_codes, {})
+        self.assertRaises(ValueError, PhoneticBlocking, 1, 1, encoding='unknown')
+
+
+class SuffixArrayBlockingTest(unittest.TestCase):
+
+    def test_suffix_blocks(self):
+        refset = (('a1', 'ISBN-2070409341'), ('a2', 'les miserables'),
+                  ('a3', 'notre dame de paris'))
+        targetset = (('b1', '2070409341'), ('b2', 'miserables'),
+                     ('b3', 'paris'), ('b4', 'madame bovary'))
+        blocking = SuffixArrayBlocking(ref_attr_index=1, target_attr_index=1,
+                                       min_suffix_length=5)
+        blocking.fit(refset, targetset)
+        pairs = list(blocking.iter_id_pairs())
+        self.assertEqual(sorted(pairs), [('a1', 'b1'), ('a2', 'b2'), ('a3', 'b3')])
+
+    def test_suffix_ranks(self):
+        values = ['banana', '', 'ana', u'bandana', 'a']
+        records, offsets, ranks = suffix_ranks(values)
+        suffixes = [values[r][o:] for r, o in zip(records, offsets)]
+        self.assertEqual(sorted(suffixes), [suffixes[i] for i in np.argsort(ranks)])
+        for i, suffix in enumerate(suffixes):
+            for j, other in enumerate(suffixes):
+                self.assertEqual(ranks[i] == ranks[j], suffix == other)
+
+    def test_suffix_keys(self):
+        refset = (('a1', 'les miserables'), ('a2', None))
+        targetset = (('b1', 'miserables'), ('b2', 'tables'))
+        blocking = SuffixArrayBlocking(ref_attr_index=1, target_attr_index=1,
+                                       min_suffix_length=5)
+        blocking.fit(refset, targetset)
+        keys, sizes1, sizes2 = blocking.block_sizes()
+        self.assertEqual(keys, ['ables', 'erables', 'iserables', 'miserables',
+                                'rables', 'serables'])
+        self.assertEqual(sizes2.tolist(), [2, 1, 1, 1, 1, 1])
+        self.assertEqual(blocking.count_pairs(), 2)
+
+    def test_suffix_max_block_size(self):
+        refset = (('a1', 'victor hugo'), ('a2', 'pierre loti'), ('a3', 'emile zola'))
+        targetset = (('b1', 'jean hugo'), ('b2', 'francois hugo'), ('b3', 'emile zola'))
+        blocking = SuffixArrayBlocking(ref_attr_index=1, target_attr_index=1,
+                                       min_suffix_length=4, max_block_size=2)
+        blocking.fit(refset, targetset)
+        pairs = list(blocking.iter_id_pairs())
+        self.assertEqual(pairs, [('a3', 'b3')])
+
+
+class MetaBlockingTest(unittest.TestCase):
+    refset = MultiKeyBlockingTest.refset
+    targetset = MultiKeyBlockingTest.targetset
+
+    def test_cbs_wep(self):
+        blocking = MetaBlocking(TokenBlocking(ref_attr_index=1, target_attr_index=1,
+                                              deduplicate=False))
+        blocking.fit(self.refset, self.targetset)
+        blocks = list(blocking.iter_id_blocks())
+        self.assertEqual(blocks, [(['a1'], ['b1']), (['a2'], ['b1'])])
+        self.assertEqual(list(blocking.weights), [2, 2])
+
+    def test_jaccard_wep(self):
+        blocking = MetaBlocking(TokenBlocking(ref_attr_index=1, target_attr_index=1,
+                                              deduplicate=False),
+                                weighting='jaccard')
+        blocking.fit(self.refset, self.targetset)
+        pairs = list(blocking.iter_id_pairs())
+        self.assertEqual(pairs, [('a2', 'b1'), ('a3', 'b2')])
+
+    def test_cnp(self):
+        blocking = MetaBlocking(TokenBlocking(ref_attr_index=1, target_attr_index=1),
+                                weighting='arcs', pruning='cnp', cardinality=1)
+        blocking.fit(self.refset, self.targetset)
+        pairs = list(blocking.iter_id_pairs())
+        self.assertEqual(pairs, [('a1', 'b1'), ('a1', 'b3'), ('a2', 'b1'), ('a3', 'b2')])
+
+    def test_chunks(self):
+        for weighting in MetaBlocking.weighting_schemes:
+            results = []
+            for chunk_size in (1000000, 1):
+                blocking = MetaBlocking(TokenBlocking(ref_attr_index=1, target_attr_index=1,
+                                                      deduplicate=False),
+                                        weighting=weighting, pruning='wnp',
+                                        chunk_size=chunk_size)
+                blocking.fit(self.refset, self.targetset)
+                results.append((list(blocking.iter_id_pairs()),
+                                [round(w, 6) for w in blocking.weights]))
+            self.assertEqual(results[0], results[1])
+
+    def test_unknown_scheme(self):
+        self.assertRaises(ValueError, MetaBlocking, TokenBlocking(1, 1), weighting='foo')
+
 
 class NGramBlockingTest(unittest.TestCase):
 
@@ -206,6 +415,47 @@ class NGramBlockingTest(unittest.TestCase):
         self.assertEqual(len(pairs), len(true_pairs))
 
 
+class QGramBlockingTest(unittest.TestCase):
+
+    def test_qgram_blocks(self):
+        refset = (('a1', 'smith'), ('a2', 'xmyth'), ('a3', 'meier'), ('a4', None))
+        targetset = (('b1', 'smyth'), ('b2', 'schmidt'), ('b3', 'meyer'), ('b4', 'xsmith'))
+        blocking = QGramBlocking(ref_attr_index=1, target_attr_index=1,
+                                 q=2, max_distance=1)
+        blocking.fit(refset, targetset)
+        blocks = list(blocking.iter_id_blocks())
+        # The typo in the first character of 'xmyth' does not lose the match
+        self.assertEqual(blocks, [(['a1'], ['b1', 'b4']), (['a2'], ['b1']), (['a3'], ['b3'])])
+
+    def test_qgram_count_filtering(self):
+        letters = 'abcd'
+        refset = [(i, ''.join(random.choice(letters) for _ in range(6)))
+                  for i in range(60)]
+        targetset = [(i, ''.join(random.choice(letters) for _ in range(random.randint(5, 7))))
+                     for i in range(60)]
+        blocking = QGramBlocking(ref_attr_index=1, target_attr_index=1,
+                                 q=2, max_distance=2, chunk_size=7)
+        blocking.fit(refset, targetset)
+        pairs = set(blocking.iter_indice_pairs())
+        for i, (_, stra) in enumerate(refset):
+            for j, (_, strb) in enumerate(targetset):
+                if levenshtein(stra, strb) <= 2:
+                    self.assertIn((i, j), pairs)
+        self.assertTrue(len(pairs) < len(refset) * len(targetset))
+
+    def test_qgram_min_common(self):
+        refset = (('a1', 'smith'), ('a2', 'meier'))
+        targetset = (('b1', 'smyth'), ('b2', 'xsmith'), ('b3', 'meyer'))
+        blocking = QGramBlocking(ref_attr_index=1, target_attr_index=1,
+                                 q=2, min_common=5)
+        blocking.fit(refset, targetset)
+        self.assertEqual(list(blocking.iter_id_pairs()), [('a1', 'b2')])
+
+    def test_qgram_parameters(self):
+        self.assertRaises(ValueError, QGramBlocking, 1, 1)
+        self.assertRaises(ValueError, QGramBlocking, 1, 1, max_distance=1, min_common=2)
+
+
 class SortedNeighborhoodBlockingTest(unittest.TestCase):
 
     def test_sorted_neighborhood_blocks(self):
@@ -233,6 +483,34 @@ class SortedNeighborhoodBlockingTest(unittest.TestCase):
         for block in true_blocks:
             self.assertIn(block, blocks)
 
+    def test_external_sorted_neighborhood(self):
+        for key_func in (lambda x: x, lambda x: x[::-1]):
+            for window_width in (1, 3, 20):
+                blocking = SortedNeighborhoodBlocking(1, 1, key_func=key_func,
+                                                      window_width=window_width)
+                blocking.fit(SOUNDEX_REFSET, SOUNDEX_TARGETSET)
+                external = ExternalSortedNeighborhoodBlocking(1, 1, key_func=key_func,
+                                                              window_width=window_width,
+                                                              buffer_size=3)
+                external.fit(SOUNDEX_REFSET, SOUNDEX_TARGETSET)
+                self.assertEqual(len(external.runs), 5)
+                self.assertEqual(list(external.iter_blocks()), list(blocking.iter_blocks()))
+                rundir = external.rundir
+                external.cleanup()
+                self.assertFalse(path.exists(rundir))
+
+    def test_external_sorted_neighborhood_ids(self):
+        blocking = ExternalSortedNeighborhoodBlocking(1, 1, window_width=2)
+        blocking.fit(SOUNDEX_REFSET, SOUNDEX_TARGETSET)
+        self.assertIs(blocking.refids.dataset, SOUNDEX_REFSET)
+        self.assertEqual(list(blocking.targetids),
+                         [(i, r[0]) for i, r in enumerate(SOUNDEX_TARGETSET)])
+        self.assertEqual(blocking.refids[2], (2, SOUNDEX_REFSET[2][0]))
+        rundir = blocking.rundir
+        self.assertTrue(path.exists(rundir))
+        del blocking
+        self.assertFalse(path.exists(rundir))
+
 
 class MergeBlockingTest(unittest.TestCase):
 
@@ -273,6 +551,37 @@ class MergeBlockingTest(unittest.TestCase):
         for block in true_blocks:
             self.assertIn(block, blocks)
 
+    def test_merge_blocks_score_index(self):
+        refset = [('http://fr.wikipedia.org/wiki/Paris_%28Texas%29', 'Paris', 25898),
+                  ('http://fr.wikipedia.org/wiki/Paris', 'Paris', 12223100),
+                  ('http://fr.wikipedia.org/wiki/Saint-Malo', 'Saint-Malo', 46342),
+                  ('http://fr.wikipedia.org/wiki/Saint-Malo_%28bis%29', 'Saint-Malo', 46342)]
+        targetset = [('Paris (Texas)', 25000),
+                     ('Paris (France)', 12000000)]
+        blocking = MergeBlocking(ref_attr_index=1, target_attr_index=None,
+                                 score_index=2)
+        blocking.fit(refset, targetset)
+        self.assertEqual(list(blocking.iter_indice_blocks()), [([1, 2], [0, 1])])
+        blocking = MergeBlocking(ref_attr_index=1, target_attr_index=None,
+                                 score_func=lambda x: x[2])
+        blocking.fit(refset, targetset)
+        self.assertEqual(list(blocking.iter_indice_blocks()), [([1, 2], [0, 1])])
+
+    def test_merge_pipeline(self):
+        refset = [('a1', 'Paris', 25898, 'Paris'),
+                  ('a2', 'Paris', 12223100, 'Paris'),
+                  ('a3', 'Saint-Malo', 46342, 'Saint Malo')]
+        targetset = [('b1', 'Paris'),
+                     ('b2', 'Saint Malo'),
+                     ('b3', 'Saint Denis')]
+        blocking = PipelineBlocking((MergeBlocking(1, None, score_index=2),
+                                     KeyBlocking(3, 1, callback=lambda x: x[0])))
+        blocking.fit(refset, targetset)
+        blocks = list(blocking.iter_id_blocks())
+        self.assertEqual(len(blocks), 2)
+        self.assertIn((['a2'], ['b1']), blocks)
+        self.assertIn((['a3'], ['b2', 'b3']), blocks)
+
 
 class KmeansBlockingTest(unittest.TestCase):
 
@@ -305,6 +614,39 @@ class KmeansBlockingTest(unittest.TestCase):
         for pair in ((0, 0), (0, 2), (1, 0), (1, 2), (2, 1), (3, 1)):
             self.assertIn(pair, pairs)
 
+    def test_clustering_blocking_scalable(self):
+        refset = [['V1', 'label1', (6.14194444444, 48.67)],
+                  ['V2', 'label2', (6.2, 49)],
+                  ['V3', 'label3', (5.1, 48)],
+                  ['V4', 'label4', (5.2, 48.1)],
+                  ]
+        targetset = [['T1', 'labelt1', (6.2, 48.9)],
+                     ['T2', 'labelt2', (5.3, 48.2)],
+                     ['T3', 'labelt3', (6.25, 48.91)],
+                     ]
+        try:
+            import sklearn as skl
+        except ImportError:
+            self.skipTest('Scikit learn does not seem to be installed')
+        for mode in ('minibatch', 'bisecting'):
+            blocking = KmeansBlocking(ref_attr_index=2, target_attr_index=2,
+                                      mode=mode, target_block_size=2,
+                                      chunk_size=2, random_state=0)
+            blocking.fit(refset, targetset)
+            blocks = list(blocking.iter_indice_blocks())
+            self.assertEqual(len(blocks), 2)
+            self.assertIn(([0, 1], [0, 2]), blocks)
+            self.assertIn(([2, 3], [1]), blocks)
+        # Assign targets to their 2 closest clusters
+        blocking = KmeansBlocking(ref_attr_index=2, target_attr_index=2,
+                                  mode='bisecting', target_block_size=2, top_n=2,
+                                  random_state=0)
+        blocking.fit(refset, targetset)
+        blocks = list(blocking.iter_indice_blocks())
+        self.assertEqual(len(blocks), 2)
+        self.assertIn(([0, 1], [0, 1, 2]), blocks)
+        self.assertIn(([2, 3], [0, 1, 2]), blocks)
+
 
 class MinHashingBlockingTest(unittest.TestCase):
 
@@ -329,6 +671,117 @@ class MinHashingBlockingTest(unittest.TestCase):
             self.assertIn(align, blocks)
 
 
+class CanopyBlockingTest(unittest.TestCase):
+
+    def test_canopy(self):
+        refset = [['V1', u"les miserables de victor hugo"],
+                  ['V2', u"notre dame de paris"],
+                  ['V3', u"le rouge et le noir"],
+                  ['V4', None]]
+        targetset = [['T1', u"victor hugo les miserables"],
+                     ['T2', u"notre dame de paris"],
+                     ['T3', u"stendhal le rouge et le noir"],
+                     ['T4', u"germinal"]]
+        blocking = CanopyBlocking(ref_attr_index=1, target_attr_index=1,
+                                  loose_threshold=0.3, tight_threshold=0.6)
+        blocking.fit(refset, targetset)
+        blocks = list(blocking.iter_id_blocks())
+        self.assertEqual(blocks, [(['V1'], ['T1']), (['V2'], ['T2']), (['V3'], ['T3'])])
+
+    def test_canopy_char_ngrams(self):
+        blocking = CanopyBlocking(ref_attr_index=1, target_attr_index=1,
+                                  loose_threshold=0.4, tight_threshold=0.8,
+                                  analyzer='char', ngram_size=3)
+        blocking.fit(SOUNDEX_REFSET, SOUNDEX_TARGETSET)
+        pairs = list(blocking.iter_id_pairs())
+        for pair in (('a3', 'b1'), ('a3', 'b2'), ('a1', 'b3'), ('a4', 'b3'), ('a5', 'b4')):
+            self.assertIn(pair, pairs)
+        self.assertNotIn(('a1', 'b1'), pairs)
+
+
+class TfidfBlockingTest(unittest.TestCase):
+    refset = (('a1', 'victor hugo'), ('a2', 'emile zola'),
+              ('a3', 'jean de la fontaine'), ('a4', None))
+    targetset = (('b1', 'victor hugo'), ('b2', 'hugo victor'),
+                 ('b3', 'emile zolla'), ('b4', 'la fontaine'), ('b5', 'marcel proust'))
+
+    def test_tfidf_blocks(self):
+        blocking = TfidfBlocking(ref_attr_index=1, target_attr_index=1,
+                                 threshold=0.5, chunk_size=2)
+        blocking.fit(self.refset, self.targetset)
+        blocks = list(blocking.iter_id_blocks())
+        self.assertEqual(blocks, [(['a1'], ['b1', 'b2']), (['a2'], ['b3']),
+                                  (['a3'], ['b4'])])
+
+    def test_tfidf_top_n_similarities(self):
+        blocking = TfidfBlocking(ref_attr_index=1, target_attr_index=1,
+                                 threshold=0.1, top_n=1, analyzer='word', ngram_size=1,
+                                 return_similarities=True)
+        blocking.fit(self.refset, self.targetset)
+        blocks = list(blocking.iter_id_blocks())
+        self.assertEqual(len(blocks), 3)
+        self.assertIn((['a3'], ['b4']), blocks)
+        targets, similarities = blocking.similarities[0]
+        self.assertEqual(len(targets), 1)
+        self.assertAlmostEqual(similarities[0], 1)
+
+
+class PPJoinBlockingTest(unittest.TestCase):
+
+    def test_set_similarity_join_exact(self):
+        words = ['jean', 'de', 'la', 'fontaine', 'victor', 'hugo', 'emile', 'zola']
+        rgen = random.Random(12)
+        refs = [rgen.sample(words, rgen.randint(0, 5)) for _ in xrange(40)]
+        targets = [rgen.sample(words, rgen.randint(1, 5)) for _ in xrange(40)]
+        for threshold in (0.2, 0.5, 0.8, 1):
+            pairs = set()
+            for ref, matches, similarities in set_similarity_join(refs, targets, threshold):
+                for target, similarity in zip(matches, similarities):
+                    self.assertAlmostEqual(
+                        1 - similarity, jaccard(' '.join(refs[ref]), ' '.join(targets[target])))
+                    pairs.add((ref, target))
+            true_pairs = set((i, j) for i, ref in enumerate(refs) if ref
+                             for j, target in enumerate(targets)
+                             if jaccard(' '.join(ref), ' '.join(target)) <= 1 - threshold + 1e-9)
+            self.assertEqual(pairs, true_pairs)
+
+    def test_set_similarity_join_at_threshold(self):
+        # Jaccard of 3/15 = 0.2, exactly at the threshold
+        ref = ['w%s' % i for i in xrange(9)]
+        target = ['w%s' % i for i in xrange(6, 15)]
+        results = list(set_similarity_join([ref], [target], 0.2))
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0][1].tolist(), [0])
+        # Brute force comparison with exact rational similarities
+        words = ['w%s' % i for i in xrange(20)]
+        rgen = random.Random(3)
+        refs = [rgen.sample(words, rgen.randint(1, 12)) for _ in xrange(60)]
+        targets = [rgen.sample(words, rgen.randint(1, 12)) for _ in xrange(60)]
+        for threshold in ('0.2', '0.25', '0.4', '0.6', '0.75'):
+            pairs = set()
+            for ref, matches, _ in set_similarity_join(refs, targets, float(threshold)):
+                pairs.update((ref, target) for target in matches)
+            true_pairs = set()
+            for i, ref in enumerate(refs):
+                for j, target in enumerate(targets):
+                    common = len(set(ref) & set(target))
+                    union = len(set(ref) | set(target))
+                    if Fraction(common, union) >= Fraction(threshold):
+                        true_pairs.add((i, j))
+            self.assertEqual(pairs, true_pairs)
+
+    def test_ppjoin_blocks(self):
+        refset = (('a1', 'victor marie hugo'), ('a2', 'emile zola'), ('a3', None))
+        targetset = (('b1', 'hugo victor'), ('b2', 'zola'), ('b3', 'marie curie'))
+        blocking = PPJoinBlocking(ref_attr_index=1, target_attr_index=1, threshold=0.5,
+                                  return_similarities=True)
+        blocking.fit(refset, targetset)
+        blocks = list(blocking.iter_id_blocks())
+        self.assertEqual(blocks, [(['a1'], ['b1']), (['a2'], ['b2'])])
+        self.assertAlmostEqual(blocking.similarities[0][1][0], 2 / 3.)
+        self.assertRaises(ValueError, PPJoinBlocking, 1, 1, threshold=0)
+
+
 class KdTreeBlockingTest(unittest.TestCase):
 
     def test_kdtree(self):
@@ -349,6 +802,64 @@ class KdTreeBlockingTest(unittest.TestCase):
                           (['V3'], ['T2']),
                           (['V4'], ['T2'])], blocks)
 
+    def test_kdtree_chunks_distances(self):
+        refset = [['V1', 'label1', (48.67, 6.14194444444)],
+                  ['V2', 'label2', (49, 6.2)],
+                  ['V3', 'label3', (48, 5.1)],
+                  ['V4', 'label4', (48.1, 5.2)],
+                  ]
+        targetset = [['T1', 'labelt1', (48.9, 6.2)],
+                     ['T2', 'labelt2', (48.2, 5.3)],
+                     ['T3', 'labelt3', (48.91, 6.25)],
+                     ]
+        blocking = KdTreeBlocking(threshold=0.3, ref_attr_index=2, target_attr_index=2,
+                                  chunk_size=3, return_distances=True, units='km')
+        blocking.fit(refset, targetset)
+        blocks = list(blocking.iter_id_blocks())
+        self.assertEqual([(['V1'], ['T1', 'T3']),
+                          (['V2'], ['T1', 'T3']),
+                          (['V3'], ['T2']),
+                          (['V4'], ['T2'])], blocks)
+        self.assertEqual(sorted(blocking.distances), [0, 1, 2, 3])
+        targets, distances = blocking.distances[1]
+        self.assertEqual(list(targets), [0, 2])
+        self.assertAlmostEqual(distances[1], geographical(refset[1][2], targetset[2][2],
+                                                          units='km'), 5)
+
+
+class GeoGridBlockingTest(unittest.TestCase):
+
+    def test_geogrid(self):
+        refset = [['paris', (48.856578, 2.351828)],
+                  ['london', (51.504872, -0.07857)],
+                  ['lyon', (45.76, 4.84)],
+                  ['nowhere', None]]
+        targetset = [['paris-1', (48.85, 2.36)],
+                     ['lyon-1', (45.75, 4.85)],
+                     ['paris-2', (48.86, 2.34)],
+                     ['marseille', (43.29, 5.37)]]
+        blocking = GeoGridBlocking(ref_attr_index=1, target_attr_index=1,
+                                   threshold=5, units='km')
+        blocking.fit(refset, targetset)
+        pairs = list(blocking.iter_id_pairs())
+        for pair in (('paris', 'paris-1'), ('paris', 'paris-2'), ('lyon', 'lyon-1')):
+            self.assertIn(pair, pairs)
+        self.assertNotIn(('paris', 'lyon-1'), pairs)
+        self.assertNotIn(('lyon', 'marseille'), pairs)
+
+    def test_geogrid_completeness(self):
+        points = [(str(i), (random.uniform(60, 89), random.uniform(-180, 180)))
+                  for i in range(300)]
+        blocking = GeoGridBlocking(ref_attr_index=1, target_attr_index=1,
+                                   threshold=300, units='km')
+        blocking.fit(points, points)
+        pairs = set(blocking.iter_indice_pairs())
+        for i, (_, pointa) in enumerate(points):
+            for j, (_, pointb) in enumerate(points):
+                if geographical(pointa, pointb, units='km') <= 300:
+                    self.assertIn((i, j), pairs)
+        self.assertTrue(len(pairs) < len(points) ** 2 / 2)
+
 
 class PipelineBlockingTest(unittest.TestCase):
 
@@ -394,6 +905,261 @@ class PipelineBlockingTest(unittest.TestCase):
         for pair in true_pairs:
             self.assertIn(pair, pairs)
 
+    def test_pipeline_keys_computed_once(self):
+        calls = []
+        def callback(value):
+            calls.append(value)
+            return value[0]
+        blocking_1 = KeyBlocking(ref_attr_index=1, target_attr_index=1,
+                                 callback=callback)
+        blocking_2 = KeyBlocking(ref_attr_index=1, target_attr_index=1,
+                                 callback=partial(soundexcode, language='english'))
+        blocking = PipelineBlocking((blocking_1, blocking_2), collect_stats=True)
+        blocking.fit(SOUNDEX_REFSET, SOUNDEX_TARGETSET)
+        pairs = list(blocking.iter_id_pairs())
+        self.assertEqual(len(calls), len(SOUNDEX_REFSET) + len(SOUNDEX_TARGETSET))
+        self.assertEqual(sorted(pairs), sorted(SOUNDEX_PAIRS))
+        self.assertEqual(sorted(blocking.stats[0]), [(1, 1), (1, 2), (2, 1), (3, 2)])
+        # A new iteration does not accumulate the stats
+        list(blocking.iter_blocks())
+        self.assertEqual(sorted(blocking.stats[0]), [(1, 1), (1, 2), (2, 1), (3, 2)])
+
+    def test_pipeline_parallel(self):
+        blockings = (KeyBlocking(ref_attr_index=1, target_attr_index=1,
+                                 callback=lambda x: x[0]),
+                     SortedNeighborhoodBlocking(ref_attr_index=1, target_attr_index=1,
+                                                window_width=1))
+        blocking = PipelineBlocking(blockings, collect_stats=True)
+        blocking.fit(SOUNDEX_REFSET, SOUNDEX_TARGETSET)
+        blocks = list(blocking.iter_blocks())
+        stats = blocking.stats
+        blocking = PipelineBlocking(blockings, collect_stats=True, n_jobs=2)
+        blocking.fit(SOUNDEX_REFSET, SOUNDEX_TARGETSET)
+        self.assertEqual(list(blocking.iter_blocks()), blocks)
+        self.assertEqual(blocking.stats, stats)
+
+    def test_pipeline_refit_blocking(self):
+        blocking_1 = KeyBlocking(ref_attr_index=1, target_attr_index=1,
+                                 callback=lambda x: x[0])
+        blocking_2 = SortedNeighborhoodBlocking(ref_attr_index=1, target_attr_index=1,
+                                                window_width=1)
+        blocking = PipelineBlocking((blocking_1, blocking_2))
+        blocking.fit(SOUNDEX_REFSET, SOUNDEX_TARGETSET)
+        blocks = list(blocking.iter_blocks())
+        self.assertEqual(len(blocks), 6)
+        self.assertIn(([(4, 'a5')], [(3, 'b4')]), blocks)
+        self.assertIn(([(2, 'a3')], [(0, 'b1')]), blocks)
+        self.assertIn(([(6, 'a7')], [(5, 'b6')]), blocks)
+        self.assertIn(([(0, 'a1')], [(5, 'b6'), (2, 'b3')]), blocks)
+
+
+
+class ArrayBlocksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.blocking = KeyBlocking(ref_attr_index=1, target_attr_index=1,
+                                    callback=partial(soundexcode, language='english'))
+        self.blocking.fit(SOUNDEX_REFSET, SOUNDEX_TARGETSET)
+
+    def test_array_blocks(self):
+        blocks = [(block1.tolist(), block2.tolist())
+                  for block1, block2 in self.blocking.iter_array_blocks()]
+        self.assertEqual(blocks, list(self.blocking.iter_indice_blocks()))
+
+    def test_block_membership(self):
+        ref_ptr, ref_indices, target_ptr, target_indices = self.blocking.block_membership()
+        blocks = [(ref_indices[ref_ptr[i]:ref_ptr[i+1]].tolist(),
+                   target_indices[target_ptr[i]:target_ptr[i+1]].tolist())
+                  for i in xrange(len(ref_ptr) - 1)]
+        self.assertEqual(blocks, list(self.blocking.iter_indice_blocks()))
+
+    def test_pair_arrays(self):
+        refs, targets = self.blocking.pair_arrays()
+        self.assertEqual(refs.dtype, np.int32)
+        self.assertEqual(zip(refs.tolist(), targets.tolist()),
+                         list(self.blocking.iter_indice_pairs()))
+        self.assertEqual(self.blocking.count_pairs(), 8)
+
+    def test_pair_arrays_chunks(self):
+        chunks = list(self.blocking.iter_pair_arrays(chunk_size=3))
+        self.assertTrue(all(len(refs) <= 4 for refs, _ in chunks))
+        pairs = [pair for refs, targets in chunks
+                 for pair in zip(refs.tolist(), targets.tolist())]
+        self.assertEqual(pairs, list(self.blocking.iter_indice_pairs()))
+
+    def test_pipeline_array_blocks(self):
+        blocking = PipelineBlocking((SoundexBlocking(1, 1, language='english'),
+                                     NGramBlocking(1, 1, depth=1)))
+        blocking.fit(SOUNDEX_REFSET, SOUNDEX_TARGETSET)
+        refs, targets = blocking.pair_arrays()
+        self.assertEqual(zip(refs.tolist(), targets.tolist()),
+                         list(blocking.iter_indice_pairs()))
+        self.assertEqual(blocking.count_pairs(), len(refs))
+
+
+class BlockingPersistenceTest(unittest.TestCase):
+
+    def assertSavedBlocks(self, blocking, new_blocking, mmap=True):
+        blocking.fit(SOUNDEX_REFSET, SOUNDEX_TARGETSET)
+        temp = mkdtemp()
+        try:
+            blocking.save(temp)
+            new_blocking.load(temp, mmap=mmap)
+            self.assertEqual(sorted(new_blocking.iter_blocks()),
+                             sorted(blocking.iter_blocks()))
+        finally:
+            shutil.rmtree(temp)
+
+    def test_load_fit(self):
+        callback = partial(soundexcode, language='english')
+        for build in (lambda: KeyBlocking(1, 1, callback), lambda: NGramBlocking(1, 1),
+                      lambda: SortedNeighborhoodBlocking(1, 1, window_width=2)):
+            new_blocking = build()
+            self.assertSavedBlocks(build(), new_blocking)
+            # A loaded blocking may be fitted again on other datasets
+            new_blocking.fit(SOUNDEX_TARGETSET, SOUNDEX_REFSET)
+            blocking = build()
+            blocking.fit(SOUNDEX_TARGETSET, SOUNDEX_REFSET)
+            self.assertEqual(sorted(new_blocking.iter_blocks()),
+                             sorted(blocking.iter_blocks()))
+
+    def test_save_keyblocking(self):
+        callback = partial(soundexcode, language='english')
+        self.assertSavedBlocks(KeyBlocking(1, 1, callback), KeyBlocking(1, 1, callback))
+        self.assertSavedBlocks(KeyBlocking(1, 1, callback), KeyBlocking(1, 1, callback),
+                               mmap=False)
+
+    def test_save_ngramblocking(self):
+        self.assertSavedBlocks(NGramBlocking(1, 1), NGramBlocking(1, 1))
+
+    def test_save_sortedneighborhood(self):
+        self.assertSavedBlocks(SortedNeighborhoodBlocking(1, 1, window_width=2),
+                               SortedNeighborhoodBlocking(1, 1, window_width=2))
+
+    def test_save_external_sorted_neighborhood(self):
+        for new_blocking in (ExternalSortedNeighborhoodBlocking(1, 1, window_width=2),
+                             SortedNeighborhoodBlocking(1, 1, window_width=2)):
+            blocking = ExternalSortedNeighborhoodBlocking(1, 1, window_width=2,
+                                                          buffer_size=3)
+            self.assertSavedBlocks(blocking, new_blocking)
+            blocking.cleanup()
+        reference = SortedNeighborhoodBlocking(1, 1, window_width=2)
+        reference.fit(SOUNDEX_REFSET, SOUNDEX_TARGETSET)
+        self.assertEqual(list(new_blocking.iter_blocks()), list(reference.iter_blocks()))
+
+    def test_save_minhashing(self):
+        self.assertSavedBlocks(MinHashingBlocking(1, 1, threshold=0.4),
+                               MinHashingBlocking(1, 1, threshold=0.4))
+
+
+class BlockingReportTest(unittest.TestCase):
+
+    def test_key_report(self):
+        blocking = KeyBlocking(ref_attr_index=1, target_attr_index=1,
+                               callback=partial(soundexcode, language='english'))
+        blocking.fit(SOUNDEX_REFSET, SOUNDEX_TARGETSET)
+        report = blocking_report(blocking, true_pairs=[('a1', 'b3'), ('a6', 'b5')],
+                                 percentiles=(0, 100), nb_largest=1, pair_cost=0.5)
+        self.assertEqual(report['nb_blocks'], 3)
+        self.assertEqual(report['candidate_pairs'], 8)
+        self.assertAlmostEqual(report['reduction_ratio'], 1 - 8 / 49.)
+        self.assertEqual(report['size_percentiles'], [(0, 3), (100, 4)])
+        self.assertEqual(report['largest_blocks'],
+                         [(soundexcode('smith', 'english'), 2, 2)])
+        self.assertEqual(report['pairs_completeness'], 0.5)
+        self.assertEqual(report['estimated_time'], 4)
+
+    def test_report_without_keys(self):
+        blocking = SortedNeighborhoodBlocking(ref_attr_index=1, target_attr_index=1,
+                                              window_width=1)
+        blocking.fit(SOUNDEX_REFSET, SOUNDEX_TARGETSET)
+        report = blocking_report(blocking)
+        self.assertEqual(report['candidate_pairs'],
+                         len(list(blocking.iter_pairs())))
+        self.assertNotIn('pairs_completeness', report)
+        nb, size1, size2 = report['largest_blocks'][0]
+        block1, block2 = list(blocking.iter_blocks())[nb]
+        self.assertEqual((len(block1), len(block2)), (size1, size2))
+
+    def test_pipeline_report(self):
+        blocking = PipelineBlocking((SoundexBlocking(1, 1, language='english'),
+                                     NGramBlocking(1, 1, depth=1)))
+        blocking.fit(SOUNDEX_REFSET, SOUNDEX_TARGETSET)
+        iterations = []
+        iter_array_blocks = blocking._iter_array_blocks
+        def counted_iter_array_blocks():
+            iterations.append(1)
+            return iter_array_blocks()
+        blocking._iter_array_blocks = counted_iter_array_blocks
+        report = blocking_report(blocking)
+        # The blocks of the pipeline are only computed once
+        self.assertEqual(len(iterations), 1)
+        self.assertEqual(report['candidate_pairs'], len(list(blocking.iter_pairs())))
+
+    def test_multikey_report(self):
+        blocking = TokenBlocking(ref_attr_index=1, target_attr_index=1)
+        blocking.fit(MultiKeyBlockingTest.refset, MultiKeyBlockingTest.targetset)
+        report = blocking_report(blocking)
+        self.assertEqual(report['candidate_pairs'], 4)
+
+    def test_pairs_completeness(self):
+        blocking = TokenBlocking(ref_attr_index=1, target_attr_index=1)
+        blocking.fit(MultiKeyBlockingTest.refset, MultiKeyBlockingTest.targetset)
+        self.assertEqual(pairs_completeness(blocking, list(blocking.iter_id_pairs())), 1)
+        self.assertEqual(pairs_completeness(blocking, []), 1)
+
+
+class KeySelectionTest(unittest.TestCase):
+    refset = (('a1', 'smith', 'paris', 1902), ('a2', 'meier', 'lyon', 1850),
+              ('a3', 'nguyen', 'paris', 1902), ('a4', 'faulkner', 'nice', 1897),
+              ('a5', 'sandy', 'lyon', 1960), ('a6', 'smithers', 'paris', 1931))
+    targetset = (('b1', 'smyth', 'paris', 1902), ('b2', 'meyer', 'lyon', 1850),
+                 ('b3', 'nguyen', 'paris', 1903), ('b4', 'fawkner', 'nice', 1897),
+                 ('b5', 'santi', 'lyon', 1960), ('b6', 'smith', 'nice', 1931))
+    true_pairs = [('a1', 'b1'), ('a2', 'b2'), ('a3', 'b3'), ('a4', 'b4'), ('a5', 'b5')]
+
+    def test_select_key(self):
+        blocking, scores = select_key_blocking(self.refset, self.targetset,
+                                               self.true_pairs, min_completeness=1)
+        names, completeness, reduction = scores[0]
+        self.assertEqual(completeness, 1)
+        self.assertTrue(all(score[2] <= reduction for score in scores if score[1] == 1))
+        blocking.fit(self.refset, self.targetset)
+        self.assertEqual(pairs_completeness(blocking, self.true_pairs), 1)
+        self.assertAlmostEqual(1 - blocking.count_pairs() / 36., reduction)
+
+    def test_select_combined_keys(self):
+        key_functions = [('prefix1', partial(prefix_key, length=1)),
+                         ('exact', lambda x: x)]
+        blocking, scores = select_key_blocking(self.refset, self.targetset,
+                                               self.true_pairs, attributes=[(1, 1), (2, 2)],
+                                               key_functions=key_functions,
+                                               min_completeness=1)
+        names, completeness, reduction = scores[0]
+        self.assertEqual(len(names), 2)
+        self.assertEqual(names[0], (1, 1, 'prefix1'))
+        self.assertEqual(names[1][:2], (2, 2))
+        self.assertIsInstance(blocking, PipelineBlocking)
+        blocking.fit(self.refset, self.targetset)
+        self.assertEqual(sorted(blocking.iter_id_pairs()),
+                         self.true_pairs + [('a6', 'b1')])
+        self.assertAlmostEqual(reduction, 1 - 6 / 36.)
+
+    def test_select_false_keys(self):
+        # The false keys are ignored both in the scores and in the blocking
+        key_functions = [('parity', lambda x: x % 2),
+                         ('empty', lambda x: '' if x < 1900 else 'modern')]
+        blocking, scores = select_key_blocking(self.refset, self.targetset,
+                                               self.true_pairs, attributes=[(3, 3)],
+                                               key_functions=key_functions,
+                                               nb_combined=0)
+        for names, completeness, reduction in scores:
+            blocking = KeyBlocking(3, 3, dict(key_functions)[names[0][2]],
+                                   ignore_none=True)
+            blocking.fit(self.refset, self.targetset)
+            self.assertAlmostEqual(pairs_completeness(blocking, self.true_pairs),
+                                   completeness)
+            self.assertAlmostEqual(1 - blocking.count_pairs() / 36., reduction)
 
 
 
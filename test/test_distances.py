@@ -23,11 +23,16 @@ else:
     import unittest2 as unittest
 import random
 random.seed(6) ### Make sure tests are repeatable
+import numpy as np
 from dateutil import parser as dateparser
 
 from nazca.utils.distances import (levenshtein, soundex, soundexcode,
                                    difflib_match,
                                    jaccard, euclidean, geographical,
+                                   geographical_array, metaphonecode, nysiiscode,
+                                   phonexcode, bounded_levenshtein, levenshtein_batch,
+                                   MultiTokenDistance, pack_soundexcode,
+                                   unpack_soundexcode, soundex_codes,
                                    ExactMatchProcessing, GeographicalProcessing,
                                    LevenshteinProcessing, SoundexProcessing,
                                    JaccardProcessing, DifflibProcessing,
@@ -52,6 +57,47 @@ class DistancesTest(unittest.TestCase):
         self.assertEqual(levenshtein('Victor Hugo', 'Vitor Wugo'),
                          levenshtein('Vitor Wugo', 'Victor Hugo'))
 
+    def test_multitoken_distance(self):
+        distance = MultiTokenDistance(levenshtein)
+        pairs = [('Victor Hugo', 'Hugo Victor'), ('Victor Jean Hugo', 'Victor Hugo'),
+                 ('Victor Hugo', 'Vitor Wugo'), ('niche', 'chiens'),
+                 ('Jean Hugo', 'Jean Victor Hugo')]
+        for stra, strb in pairs:
+            self.assertEqual(distance(stra, strb), levenshtein(stra, strb))
+        # Each string is tokenized once, and each pair of tokens computed once
+        self.assertEqual(len(distance.tokens_cache), 6)
+        self.assertEqual(distance.distances_cache[('Jean', 'Jean')], 0)
+        self.assertNotIn('niche', distance.tokens_cache)
+
+    def test_multitoken_distance_cache_size(self):
+        distance = MultiTokenDistance(soundex, cache_size=3, language='english')
+        self.assertEqual(distance('Robert Ugo', 'Rubert Ugo'), 0)
+        self.assertEqual(distance('Robert Ugo', 'Rubert Pugo'), 1)
+        self.assertLessEqual(len(distance.tokens_cache), 3)
+        self.assertLessEqual(len(distance.distances_cache), 3)
+
+    def test_levenshtein_batch(self):
+        rgen = random.Random(5)
+        strings = [''.join(rgen.choice('abcd') for _ in xrange(rgen.randint(0, 70)))
+                   for _ in xrange(40)]
+        for pattern in ('', 'abcd', 'dacbbadc' * 8, 'dacbbadc' * 9):
+            self.assertEqual(levenshtein_batch(pattern, strings).tolist(),
+                             [bounded_levenshtein(pattern, string, 200)
+                              for string in strings])
+        self.assertEqual(levenshtein_batch('niche', ['chiens', 'niche']).tolist(), [5, 0])
+
+    def test_bounded_levenshtein(self):
+        self.assertEqual(levenshtein('niche', 'chiens', max_dist=2), 3)
+        self.assertEqual(levenshtein('bonjour', 'bonjour !', max_dist=1), 1)
+        self.assertEqual(levenshtein('Victor Hugo', 'Vitor Wugo', max_dist=0), 1)
+        rgen = random.Random(3)
+        words = [''.join(rgen.choice('abc') for _ in xrange(rgen.randint(0, 8)))
+                 for _ in xrange(60)]
+        for max_dist in xrange(5):
+            for stra, strb in zip(words[:30], words[30:]):
+                self.assertEqual(bounded_levenshtein(stra, strb, max_dist),
+                                 min(levenshtein(stra, strb), max_dist + 1))
+
     def test_soundex(self):
         ##     Test extracted from Wikipedia en :
         #Using this algorithm :
@@ -79,6 +125,42 @@ class DistancesTest(unittest.TestCase):
         self.assertEqual(soundex('Rubert', 'Robert', 'english'), 0)
         self.assertEqual(soundex('Rubin', 'Robert', 'english'), 1)
 
+        self.assertEqual(soundexcode(''), '')
+        self.assertEqual(soundex('Victor Hugo', 'Hugo'), 1)
+
+    def test_packed_soundexcode(self):
+        for word in (u'Robert', u'Rupert', u'Lukasiewicz', u'Éric', u''):
+            code = soundexcode(word, 'english')
+            self.assertEqual(unpack_soundexcode(pack_soundexcode(code)), code)
+        codes = soundex_codes([u'Robert', u'Rupert', None, u'Rubin', u''], 'english')
+        self.assertEqual(codes.dtype, np.int64)
+        self.assertEqual(codes[0], codes[1])
+        self.assertNotEqual(codes[0], codes[3])
+        self.assertEqual(codes[2], 0)
+        self.assertEqual(codes[4], 0)
+
+    def test_metaphone(self):
+        self.assertEqual(metaphonecode('Knight'), 'NT')
+        self.assertEqual(metaphonecode('Smith'), 'SM0')
+        self.assertEqual(metaphonecode('Wright'), 'RT')
+        self.assertEqual(metaphonecode('Philip'), 'FLP')
+        self.assertEqual(metaphonecode(''), '')
+
+    def test_nysiis(self):
+        self.assertEqual(nysiiscode('Knuth'), 'NAT')
+        self.assertEqual(nysiiscode('Mitchell'), 'MATCAL')
+        self.assertEqual(nysiiscode('Macintosh', max_length=6), 'MCANT')
+        self.assertEqual(nysiiscode('Brown'), nysiiscode('Browne'))
+        self.assertEqual(nysiiscode(''), '')
+
+    def test_phonex(self):
+        self.assertEqual(phonexcode(u'Gauthier'), phonexcode(u'Gautier'))
+        self.assertEqual(phonexcode(u'Beaumont'), phonexcode(u'Baumont'))
+        self.assertEqual(phonexcode(u'Dupont'), phonexcode(u'Dupond'))
+        self.assertEqual(phonexcode(u'Lefèvre'), phonexcode(u'Lefèvre'.encode('utf-8')))
+        self.assertNotEqual(phonexcode(u'Dupont'), phonexcode(u'Durand'))
+        self.assertEqual(phonexcode(''), '')
+
     def test_jaccard(self):
         #The jaccard indice between two words is the ratio of the number of
         #identical letters and the total number of letters
@@ -166,6 +248,25 @@ class GeographicalTestCase(unittest.TestCase):
         pdist = processing.pdist(_input)
         self.assertEqual([341.56415945105], pdist)
 
+    def test_geographical_array(self):
+        distances = geographical_array([(48.856578, 2.351828), (0, 0)],
+                                       [(51.504872, -0.07857), (0, 0)], units='km')
+        self.assertAlmostEqual(distances[0], 341.56415945105, 5)
+        self.assertEqual(distances[1], 0)
+
+    def test_geographical_precomputed(self):
+        refset = [('paris', (48.856578, 2.351828)), ('lyon', (45.76, 4.84))]
+        targetset = [('london', (51.504872, -0.07857)), ('paris', (48.85, 2.35))]
+        # Fake distance for (paris, london), (lyon, paris) is missing
+        precomputed = {0: (np.array([0, 1]), np.array([10., 0.8]))}
+        processing = GeographicalProcessing(ref_attr_index=1, target_attr_index=1,
+                                            units='km', precomputed=precomputed)
+        distmatrix = processing.cdist(refset, targetset)
+        self.assertAlmostEqual(distmatrix[0, 0], 10., 4)
+        self.assertAlmostEqual(distmatrix[0, 1], 0.8, 4)
+        self.assertAlmostEqual(distmatrix[1, 1], geographical(refset[1][1], targetset[1][1],
+                                                              units='km'), 1)
+
 
 class ExactMatchTestCase(unittest.TestCase):
 
@@ -221,6 +322,34 @@ class LevenshteinTestCase(unittest.TestCase):
         pdist = processing.pdist(_input)
         self.assertEqual([6, 6, 1], pdist)
 
+    def test_cdist_batch(self):
+        input1 = [u'Victor', 'Hugo', u'Albert Camus', None, 'Jean']
+        input2 = [u'Vicor', 'Albert Camu', None, 'hugo', '']
+        processing = LevenshteinProcessing()
+        matrix = processing.cdist(input1, input2, [0, 1, 2, 4], [0, 1, 3, 4])
+        expected = processing.cdist([input1[i] for i in (0, 1, 2, 4)],
+                                    [input2[j] for j in (0, 1, 3, 4)])
+        self.assertTrue((matrix == expected).all())
+        for i, ref in enumerate((u'Victor', 'Hugo', u'Albert Camus', 'Jean')):
+            for j, target in enumerate((u'Vicor', 'Albert Camu', 'hugo', '')):
+                self.assertEqual(matrix[i, j], levenshtein(ref, target) if target else 1)
+
+    def test_threshold(self):
+        processing = LevenshteinProcessing()
+        processing.set_threshold(2.5)
+        self.assertEqual(processing.max_dist, 2)
+        matrix = processing.cdist(self.input1, self.input2)
+        self.assertTrue((matrix == np.minimum(self.matrix, 3)).all())
+        processing.set_threshold(None)
+        self.assertEqual(processing.max_dist, None)
+        self.assertTrue((processing.cdist(self.input1, self.input2) == self.matrix).all())
+        processing = LevenshteinProcessing(matrix_normalized=True)
+        processing.set_threshold(0.5)
+        self.assertEqual(processing.max_dist, 1)
+        processing = LevenshteinProcessing(max_dist=4)
+        processing.set_threshold(2.5)
+        self.assertEqual(processing.max_dist, 4)
+
 
 class SoundexTestCase(unittest.TestCase):
 
@@ -230,6 +359,35 @@ class SoundexTestCase(unittest.TestCase):
         pdist = processing.pdist(_input)
         self.assertEqual([0, 1, 1], pdist)
 
+    def test_cdist(self):
+        processing = SoundexProcessing(ref_attr_index=1, target_attr_index=0,
+                                       language='english')
+        refset = [['a1', u'Robert'], None, ['a3', u'Robert Ugo'], ['a4', u'Rubin']]
+        targetset = [[u'Rupert'], [u'Rubert Ugo'], [u'Rubin'], [u'Pugo']]
+        distmatrix = processing.cdist(refset, targetset)
+        for i, ref in enumerate(refset):
+            for j, target in enumerate(targetset):
+                if ref:
+                    self.assertEqual(distmatrix[i, j],
+                                     soundex(ref[1], target[0], 'english'))
+                else:
+                    self.assertEqual(distmatrix[i, j], 1)
+        # Blocks reuse the codes of the datasets
+        codes = processing.dataset_codes['ref'][1]
+        distmatrix = processing.cdist(refset, targetset, [3, 0], [2, 0])
+        self.assertIs(processing.dataset_codes['ref'][1], codes)
+        self.assertEqual(distmatrix.tolist(), [[0, 1], [1, 0]])
+
+    def test_cdist_normalized(self):
+        processing = SoundexProcessing(ref_attr_index=1, target_attr_index=0,
+                                       language='english', matrix_normalized=True)
+        refset = [['a1', u'Robert'], ['a2', None], None]
+        targetset = [[u'Rupert'], [u'Rubin'], [None]]
+        distmatrix = processing.cdist(refset, targetset)
+        self.assertEqual(distmatrix[0].tolist(), [0, 0.5, 1])
+        self.assertEqual(distmatrix[1].tolist(), [1, 1, 1])
+        self.assertEqual(distmatrix[2].tolist(), [1, 1, 1])
+
 
 class JaccardTestCase(unittest.TestCase):
 
@@ -241,6 +399,41 @@ class JaccardTestCase(unittest.TestCase):
         for ind, value in enumerate(pdist):
             self.assertAlmostEqual(results[ind], value, 2)
 
+    def test_cdist(self):
+        processing = JaccardProcessing(ref_attr_index=1, target_attr_index=0)
+        refset = [['a1', u'Victor Hugo'], None, ['a3', u'Jean Victor Marie Hugo'],
+                  ['a4', u'']]
+        targetset = [[u'Hugo Victor'], [u'Victor Jean'], [u'Marie Curie'], [u'']]
+        distmatrix = processing.cdist(refset, targetset)
+        self.assertEqual(distmatrix.shape, (4, 4))
+        for i, ref in enumerate(refset):
+            for j, target in enumerate(targetset):
+                if ref and ref[1] and target[0]:
+                    self.assertAlmostEqual(distmatrix[i, j],
+                                           jaccard(ref[1], target[0]), 5)
+                else:
+                    self.assertEqual(distmatrix[i, j], 1)
+        # The blocks reuse the tokens of the datasets, until the reset
+        matrix = processing.token_matrices['ref'][1][0]
+        distmatrix = processing.cdist(refset, targetset, [2, 0], [1])
+        self.assertIs(processing.token_matrices['ref'][1][0], matrix)
+        self.assertAlmostEqual(distmatrix[0, 0], 0.5, 5)
+        self.assertAlmostEqual(distmatrix[1, 0], 2./3, 5)
+        processing.reset()
+        self.assertEqual(processing.token_matrices, {})
+        self.assertEqual(processing.vocabulary, {})
+
+    def test_cdist_normalized(self):
+        processing = JaccardProcessing(ref_attr_index=1, target_attr_index=0,
+                                       matrix_normalized=True)
+        refset = [['a1', u'Victor Hugo'], None]
+        targetset = [[u'Hugo Victor'], [u'Marie Curie'], None]
+        distmatrix = processing.cdist(refset, targetset)
+        self.assertAlmostEqual(distmatrix[0, 0], 0, 5)
+        self.assertAlmostEqual(distmatrix[0, 1], 0.5, 5)
+        self.assertEqual(distmatrix[1].tolist(), [1, 1, 1])
+        self.assertEqual(distmatrix[:, 2].tolist(), [1, 1])
+
 
 class DifflibTestCase(unittest.TestCase):
 
@@ -16,14 +16,17 @@
 # with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import difflib
+import re
 from functools import partial
-from math import cos, sqrt, pi #Needed for geographical distance
+from math import cos, sqrt, pi, floor #Needed for geographical distance
 try:
     from dateutil import parser as dateparser
     DATEUTIL_ENABLED = True
 except ImportError:
     DATEUTIL_ENABLED = False
-from scipy import matrix, empty
+import numpy as np
+from scipy import empty
+from scipy.sparse import csr_matrix
 
 from nazca.utils.normalize import tokenize
 
@@ -92,13 +95,81 @@ def _handlespaces(stra, strb, distance, tokenizer=None, **kwargs):
         maxt = toka if len(toka)>len(tokb) else tokb
         mint.extend(['' for i in range(len(maxt)-len(mint))])
 
-    listmatrix = []
-    for i in xrange(len(toka)):
-        listmatrix.append([distance(toka[i], tokb[j], **kwargs) for j in xrange(len(tokb))])
-    m = matrix(listmatrix)
-    minlist = [m[i,:].min() for i in xrange(m.shape[0])]
-    minlist.extend([m[:,i].min() for i in xrange(m.shape[1])])
-    return max(minlist)
+    m = np.array([[distance(ta, tb, **kwargs) for tb in tokb] for ta in toka])
+    return max(m.min(axis=1).max(), m.min(axis=0).max())
+
+
+class MultiTokenDistance(object):
+    """ A distance callback handling the multi-tokens strings as
+    _handlespaces does, with the distance between single tokens given by
+    ``distance`` (called with the extra kwargs).
+
+    The tokens of each string are computed once, and the distances between
+    tokens are cached, as the same tokens (first names, particles...) are
+    found in many pairs. Both caches are emptied when they reach
+    ``cache_size`` entries, and the token distance matrices are computed in a
+    preallocated buffer.
+
+    Parameters
+    ----------
+
+    distance: the distance between single tokens (e.g. levenshtein)
+
+    tokenizer: the tokenizer used to split the strings
+
+    cache_size: the maximal number of strings (resp. pairs of tokens) kept in
+                the tokens (resp. distances) cache
+    """
+
+    def __init__(self, distance, tokenizer=None, cache_size=100000, **kwargs):
+        self.distance = distance
+        self.tokenizer = tokenizer
+        self.cache_size = cache_size
+        self.kwargs = kwargs
+        self.tokens_cache = {}
+        self.distances_cache = {}
+        self.buffer = np.empty((8, 8))
+
+    def tokens(self, string):
+        """ Return the tokens of string, as _handlespaces does
+        """
+        tokens = self.tokens_cache.get(string)
+        if tokens is None:
+            if len(self.tokens_cache) >= self.cache_size:
+                self.tokens_cache.clear()
+            value = string if ' ' in string else string + ' '
+            tokens = tuple(tokenize(value, self.tokenizer))
+            self.tokens_cache[string] = tokens
+        return tokens
+
+    def token_distance(self, toka, tokb):
+        """ Return the (cached) distance between the tokens toka and tokb
+        """
+        key = (toka, tokb)
+        d = self.distances_cache.get(key)
+        if d is None:
+            if len(self.distances_cache) >= self.cache_size:
+                self.distances_cache.clear()
+            d = self.distances_cache[key] = self.distance(toka, tokb, **self.kwargs)
+        return d
+
+    def __call__(self, stra, strb):
+        if ' ' not in stra and ' ' not in strb:
+            return self.distance(stra, strb, **self.kwargs)
+        toka, tokb = self.tokens(stra), self.tokens(strb)
+        # If not same number of tokens, complete the smallest one with empty strings
+        size = max(len(toka), len(tokb))
+        if not size:
+            return 0
+        toka += ('',) * (size - len(toka))
+        tokb += ('',) * (size - len(tokb))
+        if self.buffer.shape[0] < size:
+            self.buffer = np.empty((2*size, 2*size))
+        m = self.buffer[:size, :size]
+        for i, ta in enumerate(toka):
+            for j, tb in enumerate(tokb):
+                m[i, j] = self.token_distance(ta, tb)
+        return max(m.min(axis=1).max(), m.min(axis=0).max())
 
 
 ###############################################################################
@@ -122,7 +193,7 @@ def exact_match(a, b):
     """
     return 0 if a==b else 1
 
-def levenshtein(stra, strb, tokenizer=None):
+def levenshtein(stra, strb, tokenizer=None, max_dist=None):
     """ Compute the Levenshtein distance between stra and strb.
 
     The Levenshtein distance is defined as the minimal cost to transform stra
@@ -133,9 +204,15 @@ def levenshtein(stra, strb, tokenizer=None):
 
         If spaces are found in stra or strb, this method returns
             _handlespaces(stra, strb, levenshtein)
+
+        If ``max_dist`` is given, only the distances lower or equal to it are
+        computed, and max_dist + 1 is returned for the other ones
+        (see bounded_levenshtein).
     """
     if ' ' in stra or ' ' in strb:
-        return _handlespaces(stra, strb, levenshtein, tokenizer)
+        return _handlespaces(stra, strb, levenshtein, tokenizer, max_dist=max_dist)
+    if max_dist is not None:
+        return bounded_levenshtein(stra, strb, max_dist)
 
     lenb = len(strb)
     onerowago = None
@@ -149,6 +226,128 @@ def levenshtein(stra, strb, tokenizer=None):
             thisrow[y] = min(delcost, addcost, subcost)
     return thisrow[lenb - 1]
 
+def bounded_levenshtein(stra, strb, max_dist):
+    """ Compute the Levenshtein distance between stra and strb if it is lower
+    or equal to ``max_dist``, and return max_dist + 1 otherwise.
+
+    Only the diagonal band of width 2 * max_dist + 1 of the dynamic programming
+    table is computed, and the computation stops as soon as all the cells of
+    a row are above max_dist.
+    """
+    lena, lenb = len(stra), len(strb)
+    if abs(lena - lenb) > max_dist:
+        return max_dist + 1
+    # The cells out of the band are bounded by max_dist + 1
+    bound = max_dist + 1
+    previous = [min(y, bound) for y in xrange(lenb + 1)]
+    for x in xrange(1, lena + 1):
+        current = [bound] * (lenb + 1)
+        current[0] = rowmin = min(x, bound)
+        chara = stra[x - 1]
+        for y in xrange(max(1, x - max_dist), min(lenb, x + max_dist) + 1):
+            cost = min(previous[y] + 1, current[y - 1] + 1,
+                       previous[y - 1] + (chara != strb[y - 1]), bound)
+            current[y] = cost
+            if cost < rowmin:
+                rowmin = cost
+        if rowmin > max_dist:
+            return bound
+        previous = current
+    return previous[lenb]
+
+def encode_strings(strings, alphabet):
+    """ Encode a list of strings as a (len(strings), max length) matrix
+    of characters codes (starting at 1, 0 being the padding), using and
+    extending the `alphabet` dict (character -> code).
+
+    Return the matrix and the array of the lengths of the strings.
+    """
+    lengths = np.array([len(string) for string in strings], dtype=np.int64)
+    codes = np.zeros((len(strings), lengths.max() if len(strings) else 0), dtype=np.int64)
+    for ind, string in enumerate(strings):
+        codes[ind, :len(string)] = [alphabet.setdefault(c, len(alphabet) + 1)
+                                    for c in string]
+    return codes, lengths
+
+def myers_levenshtein(pattern, codes, lengths, alphabet):
+    """ Compute the Levenshtein distances between a pattern (of at most 64
+    characters) and a batch of strings encoded by encode_strings, with the
+    bit-parallel algorithm of Myers (as formulated by Hyyro), vectorized
+    on the strings.
+
+    Additional information:
+
+       H. Hyyro, A bit-vector algorithm for computing Levenshtein and
+       Damerau edit distances, Nordic Journal of Computing, 2003
+    """
+    size = len(pattern)
+    if size > 64:
+        raise ValueError('The pattern should have at most 64 characters')
+    if not size:
+        return lengths.copy()
+    # Bitmasks of the positions of each character in the pattern
+    peq = np.zeros(max(alphabet.itervalues()) + 1 if alphabet else 1, dtype=np.uint64)
+    for position, c in enumerate(pattern):
+        if c in alphabet:
+            peq[alphabet[c]] |= np.uint64(1 << position)
+    one = np.uint64(1)
+    mask = np.uint64((1 << size) - 1)
+    highbit = np.uint64(1 << (size - 1))
+    pv = np.empty(len(lengths), dtype=np.uint64)
+    pv.fill(mask)
+    mv = np.zeros(len(lengths), dtype=np.uint64)
+    scores = np.empty(len(lengths), dtype=np.int64)
+    scores.fill(size)
+    for column in xrange(codes.shape[1]):
+        active = lengths > column
+        eq = peq[codes[:, column]]
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        scores += active & ((ph & highbit) != 0)
+        scores -= active & ((mh & highbit) != 0)
+        ph = (ph << one) | one
+        mh = mh << one
+        pv = np.where(active, (mh | ~(xv | ph)) & mask, pv)
+        mv = np.where(active, ph & xv, mv)
+    return scores
+
+def levenshtein_batch(pattern, strings):
+    """ Compute the Levenshtein distances between a pattern and a list of
+    strings (without the handling of the spaces of levenshtein), with the
+    bit-parallel algorithm for the patterns of at most 64 characters.
+    """
+    if len(pattern) > 64:
+        # Unbounded band, i.e. the whole dynamic programming table
+        return np.array([bounded_levenshtein(pattern, string,
+                                             max(len(pattern), len(string)))
+                         for string in strings], dtype=np.int64)
+    alphabet = {}
+    codes, lengths = encode_strings(strings, alphabet)
+    return myers_levenshtein(pattern, codes, lengths, alphabet)
+
+SOUNDEX_VOWELS = 'AEHIOUWY'
+SOUNDEX_CONSONNANTS = {'french': {'B': '1', 'P': '1',
+                                  'C': '2', 'K': '2', 'Q': '2',
+                                  'D': '3', 'T': '3',
+                                  'L': '4',
+                                  'M': '5', 'N': '5',
+                                  'R': '6',
+                                  'G': '7', 'J': '7',
+                                  'X': '8', 'Z': '8', 'S': '8',
+                                  'F': '9', 'V': '9'
+                                 },
+                       'english': {'B': '1', 'F': '1', 'P': '1', 'V': '1',
+                                   'C': '2', 'G': '2', 'J': '2', 'K': '2',
+                                   'Q': '2', 'S': '2', 'X': '2', 'Z': '2',
+                                   'D': '3', 'T': '3',
+                                   'L': '4',
+                                   'M': '5', 'N': '5',
+                                   'R': '6'
+                                  }
+                      }
+
 def soundexcode(word, language='french'):
     """ Return the Soundex code of the word ``word``
         For more information about soundex code see wiki_
@@ -161,32 +360,15 @@ def soundexcode(word, language='french'):
             _handlespaces(stra, strb), soundex, language=language)
     """
 
-    vowels = 'AEHIOUWY'
-    if language.lower() == 'french' :
-        consonnantscode = {'B': '1', 'P': '1',
-                           'C': '2', 'K': '2', 'Q': '2',
-                           'D': '3', 'T': '3',
-                           'L': '4',
-                           'M': '5', 'N': '5',
-                           'R': '6',
-                           'G': '7', 'J': '7',
-                           'X': '8', 'Z': '8', 'S': '8',
-                           'F': '9', 'V': '9'
-                          }
-    elif language.lower() == 'english':
-        consonnantscode = {'B': '1', 'F': '1', 'P': '1', 'V': '1',
-                           'C': '2', 'G': '2', 'J': '2', 'K': '2',
-                           'Q': '2', 'S': '2', 'X': '2', 'Z': '2',
-                           'D': '3', 'T': '3',
-                           'L': '4',
-                           'M': '5', 'N': '5',
-                           'R': '6'
-                          }
-    else:
+    consonnantscode = SOUNDEX_CONSONNANTS.get(language.lower())
+    if consonnantscode is None:
         raise NotImplementedError('Soundex code is not supported (yet ?) for'
                                   'this language (%s). '
                                   'Supported languages are french and english' % language)
+    vowels = SOUNDEX_VOWELS
     word = word.strip().upper()
+    if not word:
+        return ''
     code = word[0]
     #After this ``for`` code is
     # the first letter of ``word`` followed by all the consonnants of word,
@@ -194,7 +376,8 @@ def soundexcode(word, language='french'):
     # and from two identical consonnants separated by a W or a H, only the first
     # is kept too.
     for i in xrange(1, len(word)):
-        if word[i] in vowels:
+        if word[i] in vowels or word[i] not in consonnantscode:
+            # Vowels and non-letters characters are skipped
             continue
         if word[i - 1] not in vowels and \
            consonnantscode[word[i]] == consonnantscode.get(code[-1], ''):
@@ -211,6 +394,29 @@ def soundexcode(word, language='french'):
     ###First four letters, completed by zeros
     return code[:4] + '0'*(4 - len(code))
 
+def pack_soundexcode(code):
+    """ Pack a soundex code (a letter followed by three digits) in an integer,
+    the empty code being packed in 0.
+    """
+    if not code:
+        return 0
+    return ord(code[0]) * 1000 + int(code[1:])
+
+def unpack_soundexcode(packed):
+    """ Return the soundex code packed in an integer by pack_soundexcode
+    """
+    if not packed:
+        return ''
+    return unichr(packed // 1000) + '%03d' % (packed % 1000)
+
+def soundex_codes(values, language='french'):
+    """ Return the array of the packed soundex codes of values
+    (see pack_soundexcode), the None values being given the empty code.
+    """
+    return np.fromiter((pack_soundexcode(soundexcode(value, language))
+                        if value is not None else 0 for value in values),
+                       dtype=np.int64)
+
 def soundex(stra, strb, language='french', tokenizer=None):
     """ Return the 1/0 distance between the soundex code of stra and strb.
         0 means they have the same code, 1 they don't
@@ -252,6 +458,211 @@ def difflib_match(stra, strb):
     return 1.0 - difflib.SequenceMatcher(None, stra, strb).ratio()
 
 
+###############################################################################
+### PHONETIC CODES ############################################################
+###############################################################################
+def _letters(word):
+    """ Return the uppercase ascii letters of a word
+    """
+    return ''.join(c for c in word.upper() if 'A' <= c <= 'Z')
+
+def metaphonecode(word, max_length=None):
+    """ Return the Metaphone code of the word ``word``
+        For more information about metaphone code see wiki_
+
+        .:: wiki_ : https://en.wikipedia.org/wiki/Metaphone
+    """
+    word = _letters(word)
+    if not word:
+        return ''
+    vowels = 'AEIOU'
+    # Initial letters exceptions
+    if word[:2] in ('AE', 'GN', 'KN', 'PN', 'WR'):
+        word = word[1:]
+    elif word[0] == 'X':
+        word = 'S' + word[1:]
+    elif word[:2] == 'WH':
+        word = 'W' + word[2:]
+    code = []
+    for i, c in enumerate(word):
+        prev = word[i - 1] if i else ''
+        next1 = word[i + 1] if i + 1 < len(word) else ''
+        next2 = word[i + 2] if i + 2 < len(word) else ''
+        if c == prev and c != 'C':
+            continue
+        if c in vowels:
+            if i == 0:
+                code.append(c)
+        elif c == 'B':
+            if not (prev == 'M' and i == len(word) - 1):
+                code.append('B')
+        elif c == 'C':
+            if next1 == 'I' and next2 == 'A':
+                code.append('X')
+            elif next1 == 'H':
+                code.append('K' if prev == 'S' else 'X')
+            elif next1 in ('I', 'E', 'Y'):
+                if prev != 'S':
+                    code.append('S')
+            else:
+                code.append('K')
+        elif c == 'D':
+            code.append('J' if next1 == 'G' and next2 in ('E', 'I', 'Y') else 'T')
+        elif c == 'G':
+            if next1 == 'H' and next2 and next2 not in vowels:
+                continue
+            if next1 == 'N' and (i + 2 == len(word) or word[i+1:] == 'NED'):
+                continue
+            code.append('J' if next1 in ('I', 'E', 'Y') and prev != 'G' else 'K')
+        elif c == 'H':
+            if (prev in vowels and next1 not in vowels) or prev in ('C', 'S', 'P', 'T', 'G'):
+                continue
+            code.append('H')
+        elif c == 'K':
+            if prev != 'C':
+                code.append('K')
+        elif c == 'P':
+            code.append('F' if next1 == 'H' else 'P')
+        elif c == 'Q':
+            code.append('K')
+        elif c == 'S':
+            code.append('X' if next1 == 'H' or (next1 == 'I' and next2 in ('O', 'A'))
+                        else 'S')
+        elif c == 'T':
+            if next1 == 'I' and next2 in ('O', 'A'):
+                code.append('X')
+            elif next1 == 'H':
+                code.append('0')
+            elif not (next1 == 'C' and next2 == 'H'):
+                code.append('T')
+        elif c == 'V':
+            code.append('F')
+        elif c in ('W', 'Y'):
+            if next1 in vowels:
+                code.append(c)
+        elif c == 'X':
+            code.append('KS')
+        elif c == 'Z':
+            code.append('S')
+        else:
+            code.append(c)
+    return ''.join(code)[:max_length]
+
+def nysiiscode(word, max_length=None):
+    """ Return the NYSIIS (New York State Identification and Intelligence
+        System) code of the word ``word``
+        For more information about NYSIIS code see wiki_
+
+        .:: wiki_ : https://en.wikipedia.org/wiki/New_York_State_Identification_and_Intelligence_System
+    """
+    word = _letters(word)
+    if not word:
+        return ''
+    vowels = 'AEIOU'
+    for prefix, replacement in (('MAC', 'MCC'), ('KN', 'NN'), ('K', 'C'),
+                                ('PH', 'FF'), ('PF', 'FF'), ('SCH', 'SSS')):
+        if word.startswith(prefix):
+            word = replacement + word[len(prefix):]
+            break
+    for suffix, replacement in (('EE', 'Y'), ('IE', 'Y'), ('DT', 'D'), ('RT', 'D'),
+                                ('RD', 'D'), ('NT', 'D'), ('ND', 'D')):
+        if word.endswith(suffix):
+            word = word[:-len(suffix)] + replacement
+            break
+    # The letters are transformed in place, the following rules
+    # being applied on the transformed previous letters
+    chars = list(word)
+    code = [chars[0]]
+    i = 1
+    while i < len(chars):
+        c = chars[i]
+        prev = chars[i - 1]
+        next1 = chars[i + 1] if i + 1 < len(chars) else ''
+        length = 1
+        if c == 'E' and next1 == 'V':
+            replacement, length = 'AF', 2
+        elif c in vowels:
+            replacement = 'A'
+        elif c in 'QZM':
+            replacement = {'Q': 'G', 'Z': 'S', 'M': 'N'}[c]
+        elif c == 'K':
+            replacement, length = ('N', 2) if next1 == 'N' else ('C', 1)
+        elif c == 'S' and chars[i+1:i+3] == ['C', 'H']:
+            replacement, length = 'SSS', 3
+        elif c == 'P' and next1 == 'H':
+            replacement, length = 'FF', 2
+        elif c == 'H' and (prev not in vowels or (next1 and next1 not in vowels)):
+            replacement = prev
+        elif c == 'W' and prev in vowels:
+            replacement = prev
+        else:
+            replacement = c
+        chars[i:i+length] = list(replacement)
+        for c in replacement:
+            if c != code[-1]:
+                code.append(c)
+        i += len(replacement)
+    code = ''.join(code)
+    if len(code) > 1 and code.endswith('S'):
+        code = code[:-1]
+    if code.endswith('AY'):
+        code = code[:-2] + 'Y'
+    if len(code) > 1 and code.endswith('A'):
+        code = code[:-1]
+    return code[:max_length]
+
+_PHONEX_ACCENTS = dict((ord(a), b) for a, b in zip(u'àâäîïôöùûüçë', u'aaaiiooouuuse'))
+_PHONEX_RULES = [(re.compile(pattern, re.UNICODE), replacement) for pattern, replacement in (
+    (u'y', u'i'),
+    (u'(?<![csp])h', u''),
+    (u'ph', u'f'),
+    (u'g(ai?[nm])', u'k\\1'),
+    (u'[ae]i[nm](?=[aeiou])', u'yn'),
+    (u'eau', u'o'),
+    (u'oua', u'2'),
+    (u'[ae]i[nm]', u'4'),
+    (u'[éèê]|[ae]i', u'y'),
+    (u'e(r|ss|t)', u'y\\1'),
+    (u'[ae][nm](?![aeiou14nm])', u'1'),
+    (u'in(?![aeiou14])', u'4'),
+    (u'(?<=[aeiouy1-4])s(?=[aeiouy1-4])', u'z'),
+    (u'oe|eu', u'e'),
+    (u'au', u'o'),
+    (u'o[iy]', u'2'),
+    (u'ou', u'3'),
+    (u's?ch|sh', u'5'),
+    (u'ss|sc', u's'),
+    (u'c(?=[ei])', u's'),
+    (u'qu|gu|[cq]', u'k'),
+    (u'g(?=[ao])', u'k'),
+    (u'a', u'o'),
+    (u'[dp]', u't'),
+    (u'j', u'g'),
+    (u'[bv]', u'f'),
+    (u'm', u'n'),
+    (u'[^a-z1-5]', u''),
+    (u'(.)\\1+', u'\\1'),
+    (u'[tx]$', u''),
+    )]
+
+def phonexcode(word):
+    """ Return the Phonex code of the (french) word ``word``, i.e. the
+        letters code computed by the phonex algorithm of F. Brouard
+        (without its final conversion to a number)
+    """
+    if isinstance(word, str):
+        word = word.decode('utf-8', 'replace')
+    word = word.strip().lower().translate(_PHONEX_ACCENTS)
+    for regexp, replacement in _PHONEX_RULES:
+        word = regexp.sub(replacement, word)
+    return str(word)
+
+PHONETIC_CODES = {'soundex': soundexcode,
+                  'metaphone': metaphonecode,
+                  'nysiis': nysiiscode,
+                  'phonex': phonexcode}
+
+
 ###############################################################################
 ### TEMPORAL DISTANCES ########################################################
 ###############################################################################
@@ -340,6 +751,32 @@ def geographical(pointa, pointb, in_radians=False, planet_radius=6371009,
     coef = 1. if units == 'm' else 0.001
     return coef*planet_radius*sqrt(difflat**2 + (cos(meanlat)*difflong)**2)
 
+def geographical_array(pointsa, pointsb, in_radians=False, planet_radius=6371009,
+                       units='m'):
+    """ Vectorized version of the geographical distance.
+
+        pointsa and pointsb are arrays of shape (n, 2) of (latitude, longitude)
+        points, and the array of the n distances between pointsa[i] and
+        pointsb[i] is returned.
+
+        See ``geographical`` for the other parameters.
+    """
+    if units not in ('m', 'km'):
+        raise ValueError("unsupported units, should be in m or km")
+    pointsa = np.asarray(pointsa, dtype=np.float64)
+    pointsb = np.asarray(pointsb, dtype=np.float64)
+    difflat = pointsa[:, 0] - pointsb[:, 0]
+    difflong = pointsa[:, 1] - pointsb[:, 1]
+    meanlat = (pointsa[:, 0] + pointsb[:, 0])/2.0
+
+    if not in_radians:
+        difflat *= pi/180.0
+        difflong *= pi/180.0
+        meanlat *= pi/180.0
+
+    coef = 1. if units == 'm' else 0.001
+    return coef*planet_radius*np.sqrt(difflat**2 + (np.cos(meanlat)*difflong)**2)
+
 
 ###############################################################################
 ### BASE PROCESSING ############################################################
@@ -421,6 +858,20 @@ class BaseProcessing(object):
                      matrix_normalized=self.matrix_normalized,
                      ref_indexes=ref_indexes, target_indexes=target_indexes)
 
+    def set_threshold(self, threshold):
+        """ Give the threshold of the aligner to the processing, which may use it
+        to avoid computing exactly the distances above the threshold.
+        The distances being summed, this is only valid for non-negative distances.
+        A None threshold restores the exact distances.
+        """
+        pass
+
+    def reset(self):
+        """ Drop the data cached by the processing on the datasets
+        (called by the aligner at the end of an alignment)
+        """
+        pass
+
     def pdist(self, dataset):
         """ Compute the upper triangular matrix in a way similar
         to scipy.spatial.metric
@@ -464,47 +915,233 @@ class ExactMatchProcessing(BaseProcessing):
 
 class LevenshteinProcessing(BaseProcessing):
     """ A processing based on the levenshtein distance.
+
+    If `max_dist` is given (or computed from the threshold of the aligner),
+    the bounded levenshtein distance is used, the distances above max_dist
+    being replaced by max_dist + 1.
+
+    The multi-tokens strings are compared with a MultiTokenDistance, so that
+    the distances between their tokens are reused.
     """
 
     def __init__(self, ref_attr_index=None, target_attr_index=None,
-                 tokenizer=None, weight=1, matrix_normalized=False):
-        distance_callback = partial(levenshtein,
-                                    tokenizer=tokenizer)
+                 tokenizer=None, weight=1, matrix_normalized=False, max_dist=None):
+        distance_callback = MultiTokenDistance(levenshtein, tokenizer,
+                                               max_dist=max_dist)
         super(LevenshteinProcessing, self).__init__(ref_attr_index,
                                                    target_attr_index,
                                                    distance_callback,
                                                    weight,matrix_normalized)
+        self.tokenizer = tokenizer
+        self.max_dist = max_dist
+        self.fixed_max_dist = max_dist is not None
+
+    def set_threshold(self, threshold):
+        """ Bound the distances using the threshold of the aligner
+        (unless max_dist was given), or remove the bound if threshold is None
+        """
+        if self.fixed_max_dist:
+            return
+        if threshold is None:
+            self.max_dist = None
+            self.distance_callback = MultiTokenDistance(levenshtein, self.tokenizer)
+            return
+        if threshold < 0:
+            return
+        if self.matrix_normalized:
+            # d = 1 - 1/(1 + d) is above the threshold iff d is above:
+            if threshold >= 1:
+                return
+            threshold = threshold / (1. - threshold)
+        self.max_dist = int(floor(threshold))
+        self.distance_callback = MultiTokenDistance(levenshtein, self.tokenizer,
+                                                    max_dist=self.max_dist)
+
+    def cdist(self, refset, targetset, ref_indexes=None, target_indexes=None):
+        """ Compute the metric matrix, given two datasets and a metric.
+
+        The distances between single words (of at most 64 characters for the
+        reference) are computed in batch, from each reference to all the
+        targets, with the bit-parallel levenshtein algorithm.
+        """
+        ref_indexes = ref_indexes or xrange(len(refset))
+        target_indexes = target_indexes or xrange(len(targetset))
+        distmatrix = empty((len(ref_indexes), len(target_indexes)), dtype='float32')
+        values = [self.build_record(targetset[jref], self.target_attr_index)
+                  if targetset[jref] else None for jref in target_indexes]
+        columns = np.array([j for j, value in enumerate(values)
+                            if isinstance(value, basestring) and ' ' not in value],
+                           dtype=np.int64)
+        alphabet = {}
+        codes, lengths = encode_strings([values[j] for j in columns], alphabet)
+        for i, iref in enumerate(ref_indexes):
+            others = xrange(len(target_indexes))
+            if refset[iref]:
+                value = self.build_record(refset[iref], self.ref_attr_index)
+                if (len(columns) and isinstance(value, basestring)
+                    and ' ' not in value and len(value) <= 64):
+                    distances = myers_levenshtein(value, codes, lengths, alphabet)
+                    if self.max_dist is not None:
+                        distances = np.minimum(distances, self.max_dist + 1)
+                    if self.matrix_normalized:
+                        distances = 1 - (1.0/(1.0 + distances))
+                    distmatrix[i, columns] = distances
+                    others = np.setdiff1d(np.arange(len(target_indexes)), columns)
+            for j in others:
+                d = 1
+                jref = target_indexes[j]
+                if refset[iref] and targetset[jref]:
+                    d = self.distance(refset[iref], targetset[jref])
+                    if self.matrix_normalized:
+                        d = 1 - (1.0/(1.0 + d))
+                distmatrix[i, j] = d
+        return distmatrix
 
 
 class GeographicalProcessing(BaseProcessing):
     """ A processing based on the geographical distance.
+
+    If `precomputed` is given, it should be a dict {ref index: (sorted target
+    indexes, distances)}, or an object having such a dict as `distances`
+    attribute (e.g. a KdTreeBlocking with return_distances=True). The distances
+    found in it are used instead of being computed again. If this object has a
+    `distance_settings` attribute, its settings should be the ones of this
+    processing (in_radians, planet_radius and units), or a ValueError is raised.
     """
 
     def __init__(self, ref_attr_index=None, target_attr_index=None,
-                 in_radians=False, planet_radius=6371009, units='m', weight=1, matrix_normalized=False):
+                 in_radians=False, planet_radius=6371009, units='m', weight=1,
+                 matrix_normalized=False, precomputed=None):
         distance_callback = partial(geographical, in_radians=in_radians,
                                     planet_radius=planet_radius, units=units)
         super(GeographicalProcessing, self).__init__(ref_attr_index,
                                                     target_attr_index,
                                                     distance_callback,
                                                     weight, matrix_normalized)
+        settings = getattr(precomputed, 'distance_settings', None)
+        if settings is not None and settings != {'in_radians': in_radians,
+                                                 'planet_radius': planet_radius,
+                                                 'units': units}:
+            raise ValueError('the precomputed distances settings %s differ from '
+                             'the processing ones' % settings)
+        self.precomputed = precomputed
+
+    def cdist(self, refset, targetset, ref_indexes=None, target_indexes=None):
+        """ Compute the metric matrix, given two datasets and a metric,
+        using the precomputed distances if any.
+        """
+        if self.precomputed is None:
+            return super(GeographicalProcessing, self).cdist(refset, targetset,
+                                                             ref_indexes, target_indexes)
+        precomputed = getattr(self.precomputed, 'distances', self.precomputed)
+        ref_indexes = ref_indexes or xrange(len(refset))
+        target_indexes = target_indexes or xrange(len(targetset))
+        columns = np.asarray(target_indexes, dtype=np.int64)
+        distmatrix = empty((len(ref_indexes), len(target_indexes)), dtype='float32')
+        for i, iref in enumerate(ref_indexes):
+            found = np.zeros(len(columns), dtype=bool)
+            if iref in precomputed:
+                targets, distances = precomputed[iref]
+                positions = np.minimum(np.searchsorted(targets, columns),
+                                       max(len(targets) - 1, 0))
+                found = targets[positions] == columns
+                values = distances[positions[found]]
+                if self.matrix_normalized:
+                    values = 1 - (1.0/(1.0 + values))
+                distmatrix[i, found] = values
+            for j in np.flatnonzero(~found):
+                d = 1
+                jref = target_indexes[j]
+                if refset[iref] and targetset[jref]:
+                    d = self.distance(refset[iref], targetset[jref])
+                    if self.matrix_normalized:
+                        d = 1 - (1.0/(1.0 + d))
+                distmatrix[i, j] = d
+        return distmatrix
 
 
 class SoundexProcessing(BaseProcessing):
     """ A processing based on the soundex distance.
+
+    The soundex codes of the records of each dataset are computed once, packed
+    in integers, and the distances of a block between single words are given by
+    the comparison of the codes arrays.
     """
 
     def __init__(self, ref_attr_index=None, target_attr_index=None,
                  tokenizer=None, weight=1, language='french', matrix_normalized=False):
-        distance_callback = partial(soundex, language=language, tokenizer=tokenizer)
+        distance_callback = MultiTokenDistance(soundex, tokenizer,
+                                               language=language)
         super(SoundexProcessing, self).__init__(ref_attr_index,
                                                 target_attr_index,
                                                 distance_callback,
                                                 weight, matrix_normalized)
+        self.language = language
+        self.dataset_codes = {}
+
+    def reset(self):
+        """ Drop the codes of the datasets
+        """
+        self.dataset_codes = {}
+
+    def codes(self, dataset, attr_index, role):
+        """ Return the packed soundex codes of the records of the dataset,
+        the records without value and the multi-tokens values, only computed
+        the first time the dataset is seen in the given role ('ref' or 'target')
+        until the processing is reset (i.e. during an alignment)
+        """
+        cached = self.dataset_codes.get(role)
+        if cached is not None and cached[0] is dataset:
+            return cached[1]
+        values = [self.build_record(record, attr_index) if record else None
+                  for record in dataset]
+        missing = np.array([not isinstance(value, basestring) for value in values],
+                           dtype=bool)
+        multi = np.array([not m and ' ' in value for m, value in zip(missing, values)],
+                         dtype=bool)
+        codes = soundex_codes([None if m or mt else value for m, mt, value
+                               in zip(missing, multi, values)], self.language)
+        self.dataset_codes[role] = (dataset, (codes, missing, multi))
+        return codes, missing, multi
+
+    def cdist(self, refset, targetset, ref_indexes=None, target_indexes=None):
+        """ Compute the metric matrix, given two datasets and a metric.
+
+        The multi-tokens values are compared pair by pair.
+        """
+        ref_indexes = ref_indexes or xrange(len(refset))
+        target_indexes = target_indexes or xrange(len(targetset))
+        ref_rows = np.fromiter(ref_indexes, dtype=np.int64)
+        target_rows = np.fromiter(target_indexes, dtype=np.int64)
+        ref_codes, ref_missing, ref_multi = [array[ref_rows] for array in
+                                             self.codes(refset, self.ref_attr_index, 'ref')]
+        target_codes, target_missing, target_multi = [
+            array[target_rows] for array in
+            self.codes(targetset, self.target_attr_index, 'target')]
+        distmatrix = (ref_codes[:, np.newaxis] != target_codes[np.newaxis, :]).astype('float32')
+        for i in ref_multi.nonzero()[0]:
+            for j in (~target_missing).nonzero()[0]:
+                distmatrix[i, j] = self.distance(refset[ref_rows[i]],
+                                                 targetset[target_rows[j]])
+        for j in target_multi.nonzero()[0]:
+            for i in (~(ref_missing | ref_multi)).nonzero()[0]:
+                distmatrix[i, j] = self.distance(refset[ref_rows[i]],
+                                                 targetset[target_rows[j]])
+        if self.matrix_normalized:
+            distmatrix = 1 - (1.0/(1.0 + distmatrix))
+        # The pairs with a missing record are at 1
+        distmatrix[ref_missing, :] = 1
+        distmatrix[:, target_missing] = 1
+        return distmatrix
 
 
 class JaccardProcessing(BaseProcessing):
     """ A processing based on the jaccard distance.
+
+    The records of each dataset are tokenized once per alignment, into a
+    sparse binary matrix of token ids (kept until the processing is reset),
+    and the distance matrix of a block is computed from the intersections
+    sizes given by one sparse matrix product of the rows of its records.
     """
 
     def __init__(self, ref_attr_index=None, target_attr_index=None,
@@ -514,6 +1151,77 @@ class JaccardProcessing(BaseProcessing):
                                                 target_attr_index,
                                                 distance_callback,
                                                 weight, matrix_normalized)
+        self.tokenizer = tokenizer
+        self.reset()
+
+    def reset(self):
+        """ Drop the token matrices of the datasets, and their vocabulary
+        """
+        self.vocabulary = {}
+        self.token_matrices = {}
+
+    def token_matrix(self, dataset, attr_index, role):
+        """ Return the sparse binary matrix (records x tokens) of the dataset,
+        and the boolean array of its missing records, only computed the first
+        time the dataset is seen in the given role ('ref' or 'target')
+        until the processing is reset (i.e. during an alignment)
+        """
+        cached = self.token_matrices.get(role)
+        if cached is not None and cached[0] is dataset:
+            matrix, missing = cached[1]
+        else:
+            indices, indptr = [], [0]
+            missing = np.zeros(len(dataset), dtype=bool)
+            for ind, record in enumerate(dataset):
+                if not record:
+                    missing[ind] = True
+                else:
+                    value = self.build_record(record, attr_index)
+                    if value:
+                        tokens = set(tokenize(value, self.tokenizer))
+                        indices.extend(self.vocabulary.setdefault(token, len(self.vocabulary))
+                                       for token in tokens)
+                indptr.append(len(indices))
+            matrix = csr_matrix((np.ones(len(indices)), indices, indptr),
+                                shape=(len(dataset), len(self.vocabulary)))
+            self.token_matrices[role] = (dataset, (matrix, missing))
+        return matrix, missing
+
+    def cdist(self, refset, targetset, ref_indexes=None, target_indexes=None):
+        """ Compute the metric matrix, given two datasets and a metric.
+
+        The intersections sizes are given by the product of the token
+        matrices, and the unions sizes by the number of tokens of the records.
+        """
+        ref_indexes = ref_indexes or xrange(len(refset))
+        target_indexes = target_indexes or xrange(len(targetset))
+        blocks = []
+        for dataset, attr_index, role, indexes in (
+            (refset, self.ref_attr_index, 'ref', ref_indexes),
+            (targetset, self.target_attr_index, 'target', target_indexes)):
+            matrix, missing = self.token_matrix(dataset, attr_index, role)
+            rows = np.fromiter(indexes, dtype=np.int64)
+            matrix = matrix[rows]
+            blocks.append((matrix, missing[rows]))
+        # The rows of both datasets, with the size of the whole vocabulary
+        # (new tokens may have been found after the first dataset)
+        (ref_matrix, ref_missing), (target_matrix, target_missing) = [
+            (csr_matrix((matrix.data, matrix.indices, matrix.indptr),
+                        shape=(matrix.shape[0], len(self.vocabulary))), missing)
+            for matrix, missing in blocks]
+        intersections = (ref_matrix * target_matrix.T).toarray()
+        unions = (np.diff(ref_matrix.indptr)[:, np.newaxis]
+                  + np.diff(target_matrix.indptr)[np.newaxis, :] - intersections)
+        distmatrix = np.ones(intersections.shape, dtype='float32')
+        nonempty = unions > 0
+        distances = 1. - intersections[nonempty] / unions[nonempty]
+        if self.matrix_normalized:
+            distances = 1 - (1.0/(1.0 + distances))
+        distmatrix[nonempty] = distances
+        # The pairs with a missing record (or without any token) are at 1
+        distmatrix[ref_missing, :] = 1
+        distmatrix[:, target_missing] = 1
+        return distmatrix
 
 
 class DifflibProcessing(BaseProcessing):